@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from openai import RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+from azure.core.exceptions import HttpResponseError, ServiceRequestError
+
+# Errors worth retrying: rate limits, timeouts and transient server errors
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError, ServiceRequestError)
+RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+def retry_after(error) -> float:
+    """Return the delay requested by the service in a Retry-After header, if any."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+def call_with_retry(function, *args, max_retries: int = 5, base_delay: float = 1.0, max_delay: float = 60.0, **kwargs):
+    """
+    Call a function, retrying with exponential backoff on rate limits and transient errors.
+
+    Args:
+        function: The function to call with the remaining arguments.
+        max_retries (int): The maximum number of retries.
+        base_delay (float): The delay before the first retry, in seconds.
+        max_delay (float): The maximum delay between two retries, in seconds.
+
+    Returns:
+        The result of the function.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return function(*args, **kwargs)
+        except Exception as e:
+            retryable = isinstance(e, RETRYABLE_ERRORS) or (
+                isinstance(e, HttpResponseError) and e.status_code in RETRYABLE_STATUS_CODES
+            )
+            if not retryable or attempt == max_retries:
+                raise
+
+            # Honour the delay requested by the service, otherwise back off with jitter
+            delay = retry_after(e) or min(max_delay, base_delay * 2 ** attempt) * (0.5 + random.random())
+            print(f"Retrying in {delay:.1f}s after error: {e}")
+            time.sleep(delay)
+
+def process_concurrently(items, function, concurrency: int = 4):
+    """
+    Apply a function to a stream of items with a pool of worker threads.
+
+    At most twice `concurrency` items are in flight at any time, so the items can
+    be read lazily. Each call is retried with `call_with_retry`.
+
+    Args:
+        items: An iterable of (key, payload) pairs.
+        function: The function applied to each payload.
+        concurrency (int): The number of worker threads.
+
+    Yields:
+        tuple: (key, result, error) for each item as it completes, with either
+        the result or the raised exception set.
+    """
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        in_flight = {}
+
+        def submit_next():
+            item = next(items, None)
+            if item is None:
+                return False
+            key, payload = item
+            in_flight[executor.submit(call_with_retry, function, payload)] = key
+            return True
+
+        while len(in_flight) < 2 * concurrency and submit_next():
+            pass
+
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = in_flight.pop(future)
+                error = future.exception()
+                yield key, (None if error else future.result()), error
+                submit_next()
+
+def load_checkpoint(checkpoint_path: str) -> dict:
+    """
+    Load the results recorded in a JSONL checkpoint file.
+
+    Args:
+        checkpoint_path (str): The path of the checkpoint file.
+
+    Returns:
+        dict: The recorded result of each key, empty if the file does not exist.
+    """
+    results = {}
+    if not os.path.exists(checkpoint_path):
+        return results
+
+    with open(checkpoint_path) as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue # Ignore a line truncated by a crash
+            results[record["key"]] = record["result"]
+
+    return results
+
+def run_batch(items, function, checkpoint_path: str, concurrency: int = 4) -> dict:
+    """
+    Run a function over a batch of items, checkpointing each result.
+
+    Every result is appended to the JSONL checkpoint file as soon as it is
+    available. Items already in the checkpoint are skipped, so an interrupted
+    run resumes where it stopped. Failed items are reported and left out of the
+    checkpoint, to be retried by the next run.
+
+    Args:
+        items: An iterable of (key, payload) pairs.
+        function: The function applied to each payload.
+        checkpoint_path (str): The path of the checkpoint file.
+        concurrency (int): The number of worker threads.
+
+    Returns:
+        dict: The result of each completed key, including the resumed ones.
+    """
+    results = load_checkpoint(checkpoint_path)
+    if results:
+        print(f"Resuming from {checkpoint_path}: {len(results)} items already processed")
+
+    pending = ((str(key), payload) for key, payload in items if str(key) not in results)
+
+    directory = os.path.dirname(checkpoint_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    failed = []
+    with open(checkpoint_path, "a") as checkpoint:
+        for key, result, error in process_concurrently(pending, function, concurrency):
+            if error is not None:
+                print(f"Failed to process {key}: {error}")
+                failed.append(key)
+                continue
+
+            checkpoint.write(json.dumps({"key": key, "result": result}) + "\n")
+            checkpoint.flush()
+            results[key] = result
+
+    if failed:
+        print(f"{len(failed)} items failed and will be retried on the next run: {failed}")
+
+    return results
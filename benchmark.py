@@ -0,0 +1,358 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import hashlib
+import argparse
+import resource
+import threading
+import tracemalloc
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# Benchmarks measure the pipeline itself: caches would turn repeated runs into lookups
+os.environ.setdefault("EMBEDDING_CACHE_PATH", "")
+os.environ.setdefault("LLM_CACHE_PATH", "")
+
+import resources
+import semantic_tagging
+from search_backends import SearchBackend
+
+class StageTimer:
+    """Thread-safe record of the durations of each stage of the pipeline."""
+
+    def __init__(self):
+        self.durations = {}
+        self.lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float):
+        with self.lock:
+            self.durations.setdefault(stage, []).append(seconds)
+
+    def wrap(self, stage: str, function):
+        """Return a version of a function recording its duration under the given stage."""
+        if asyncio.iscoroutinefunction(function):
+            async def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    self.record(stage, time.perf_counter() - start)
+        else:
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.record(stage, time.perf_counter() - start)
+        return timed
+
+    def summary(self) -> dict:
+        """Return the count and latency percentiles of each stage, in milliseconds."""
+        return {stage: percentiles(durations) for stage, durations in self.durations.items()}
+
+def percentiles(durations: list) -> dict:
+    """Return the count, mean and p50/p90/p99 of durations in seconds, in milliseconds."""
+    values = np.asarray(durations) * 1000
+    return {
+        "count": len(values),
+        "mean_ms": float(values.mean()),
+        "p50_ms": float(np.percentile(values, 50)),
+        "p90_ms": float(np.percentile(values, 90)),
+        "p99_ms": float(np.percentile(values, 99)),
+    }
+
+def synthetic_response(labels: list, messages: list, count: int) -> str:
+    """Pick a deterministic list of labels for a request, as a comma-separated answer."""
+    seed = hashlib.sha256(json.dumps(messages).encode("utf-8")).digest()
+    return ", ".join(random.Random(seed).sample(labels, min(count, len(labels))))
+
+class StubOpenAI:
+    """Stand-in for the Azure OpenAI client answering with EuroVoc labels after a synthetic latency."""
+
+    def __init__(self, labels: list, latency: float):
+        self.labels = labels
+        self.latency = latency
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def response(self, messages: list):
+        content = synthetic_response(self.labels, messages, 15)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content), finish_reason="stop")],
+            usage=SimpleNamespace(prompt_tokens=len(json.dumps(messages)) // 4, completion_tokens=len(content) // 4),
+        )
+
+    def create(self, messages, **kwargs):
+        time.sleep(self.latency)
+        return self.response(messages)
+
+class StubAsyncOpenAI(StubOpenAI):
+    """Asynchronous version of `StubOpenAI`."""
+
+    async def create(self, messages, **kwargs):
+        await asyncio.sleep(self.latency)
+        return self.response(messages)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+class StubSearchBackend(SearchBackend):
+    """Stand-in for Azure AI Search returning EuroVoc labels after a synthetic latency per query."""
+
+    def __init__(self, labels: list, latency: float):
+        self.labels = labels
+        self.latency = latency
+
+    def results(self, vectors, k: int) -> list:
+        return [
+            [(label, 1.0 - rank / (2 * k)) for rank, label in enumerate(synthetic_response(self.labels, np.asarray(vector).round(3).tolist(), k).split(", "))]
+            for vector in vectors
+        ]
+
+    def search_batch_scored(self, vectors, k: int = 10) -> list:
+        # The queries of a batch are sent concurrently, as by `AzureSearchBackend`
+        time.sleep(self.latency)
+        return self.results(vectors, k)
+
+    async def asearch_batch_scored(self, vectors, k: int = 10) -> list:
+        await asyncio.sleep(self.latency)
+        return self.results(vectors, k)
+
+class StubEncoder:
+    """Stand-in for the SentenceTransformer model returning hash-seeded unit vectors."""
+
+    def __init__(self, dimension: int = 384):
+        self.dimension = dimension
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dimension
+
+    def encode(self, sentences, **kwargs) -> np.ndarray:
+        single = isinstance(sentences, str)
+        vectors = []
+        for sentence in [sentences] if single else sentences:
+            seed = int.from_bytes(hashlib.sha256(sentence.encode("utf-8")).digest()[:8], "little")
+            vector = np.random.default_rng(seed).standard_normal(self.dimension).astype(np.float32)
+            vectors.append(vector / np.linalg.norm(vector))
+        vectors = np.array(vectors, dtype=np.float32).reshape(-1, self.dimension)
+        return vectors[0] if single else vectors
+
+class TimedEncoder:
+    """Encoder proxy recording the duration of each `encode` call."""
+
+    def __init__(self, encoder, timer: StageTimer):
+        self.encoder = encoder
+        self.encode = timer.wrap("encode", encoder.encode)
+
+    def __getattr__(self, name):
+        return getattr(self.encoder, name)
+
+def install_stubs(args, timer: StageTimer) -> list:
+    """
+    Replace the external services of the pipeline with local stand-ins and time each stage.
+
+    Returns:
+        list: The EuroVoc labels used to generate synthetic responses.
+    """
+    vocabulary = resources.get("eurovoc")
+    labels = list(vocabulary)
+
+    resources.override("openai_client", StubOpenAI(labels, args.llm_latency))
+    semantic_tagging.async_openai_client = lambda: StubAsyncOpenAI(labels, args.llm_latency)
+
+    if args.search == "stub":
+        backend = StubSearchBackend(labels, args.search_latency)
+    else:
+        backend = resources.get("search_backend")
+    # The default `asearch_batch_scored` runs `search_batch_scored`, which is already timed
+    if type(backend).asearch_batch_scored is not SearchBackend.asearch_batch_scored:
+        backend.asearch_batch_scored = timer.wrap("search", backend.asearch_batch_scored)
+    backend.search_batch_scored = timer.wrap("search", backend.search_batch_scored)
+    resources.override("search_backend", backend)
+
+    encoder = StubEncoder() if args.stub_encoder else resources.get("model")
+    resources.override("model", TimedEncoder(encoder, timer))
+
+    # Time each stage of the synchronous and asynchronous pipelines
+    for stage, name in [
+        ("llm_tags", "tags_with_LLM"), ("llm_tags", "atags_with_LLM"),
+        ("resolve", "resolve_tags"),
+        ("retrieval", "perform_search_batch"), ("retrieval", "aperform_search_batch"),
+        ("document_retrieval", "retrieve_from_document"), ("document_retrieval", "aretrieve_from_document"),
+        ("filter", "filter_candidates"), ("filter", "afilter_candidates"),
+    ]:
+        setattr(semantic_tagging, name, timer.wrap(stage, getattr(semantic_tagging, name)))
+
+    return labels
+
+def synthetic_documents(labels: list, count: int) -> list:
+    """Build documents mentioning a few EuroVoc descriptors and their definitions."""
+    vocabulary = resources.get("eurovoc")
+    generator = random.Random(0)
+    documents = []
+    for _ in range(count):
+        sentences = [f"{label}: {vocabulary.definition(label) or label}." for label in generator.sample(labels, 5)]
+        documents.append(" ".join(sentences))
+    return documents
+
+def benchmark_throughput(documents: list, concurrency: int, use_async: bool) -> dict:
+    """Tag documents with the given concurrency and return the throughput and latencies."""
+    latencies = []
+
+    def tag(document):
+        start = time.perf_counter()
+        semantic_tagging.predict_tags(document)
+        latencies.append(time.perf_counter() - start)
+
+    async def atag_all():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def atag(document):
+            async with semaphore:
+                start = time.perf_counter()
+                await semantic_tagging.apredict_tags(document)
+                latencies.append(time.perf_counter() - start)
+
+        await asyncio.gather(*(atag(document) for document in documents))
+
+    start = time.perf_counter()
+    if use_async:
+        asyncio.run(atag_all())
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(tag, documents))
+    elapsed = time.perf_counter() - start
+
+    return {"documents_per_second": len(documents) / elapsed, "latency": percentiles(latencies)}
+
+def benchmark_embedding(labels: list, batch_sizes: list) -> dict:
+    """Return the encoding throughput of the model at several batch sizes."""
+    encoder = resources.get("model")
+    sentences = [f"{label} {index}" for index, label in enumerate(labels)]
+    results = {}
+    for batch_size in batch_sizes:
+        start = time.perf_counter()
+        encoder.encode(sentences, batch_size=batch_size)
+        results[str(batch_size)] = {"sentences_per_second": len(sentences) / (time.perf_counter() - start)}
+    return results
+
+def benchmark_indexing(path: str) -> dict:
+    """Return the duration of encoding the EuroVoc knowledge base."""
+    import pandas as pd
+    import indexation
+
+    eurovoc = pd.read_excel(path, sheet_name="desc_en")
+    start = time.perf_counter()
+    vectors, _ = indexation.encode_knowledge_base(eurovoc)
+    return {"documents": len(vectors), "seconds": time.perf_counter() - start}
+
+def benchmark_memory(documents: list, concurrency: int) -> dict:
+    """
+    Return the peak memory of tagging documents with the given concurrency.
+
+    Tracing allocations slows every allocation down, so it runs as a separate pass
+    after the timed ones rather than during them.
+    """
+    tracemalloc.start()
+    try:
+        benchmark_throughput(documents, concurrency, use_async=False)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "python_peak_mb": peak / 2 ** 20,
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2 ** 20 if sys.platform == "darwin" else 2 ** 10),
+    }
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Compare the results with a baseline run.
+
+    Args:
+        results (dict): The results of this run.
+        baseline (dict): The results of the baseline run.
+        tolerance (float): The relative slowdown tolerated before reporting a regression.
+
+    Returns:
+        list: A description of each regression.
+    """
+    regressions = []
+
+    def walk(current, previous, path):
+        if isinstance(current, dict) and isinstance(previous, dict):
+            for key in current.keys() & previous.keys():
+                walk(current[key], previous[key], f"{path}.{key}" if path else key)
+        elif isinstance(current, (int, float)) and isinstance(previous, (int, float)) and previous > 0:
+            # Latencies and durations should not grow, throughputs should not shrink
+            if path.endswith(("_ms", "seconds")) and current > previous * (1 + tolerance):
+                regressions.append(f"{path}: {previous:.2f} -> {current:.2f}")
+            elif path.endswith("per_second") and current < previous / (1 + tolerance):
+                regressions.append(f"{path}: {previous:.2f} -> {current:.2f}")
+
+    walk(results, baseline, "")
+    return regressions
+
+def main():
+    """
+    Benchmark the tagging pipeline against local stand-ins for Azure OpenAI and Azure AI Search.
+
+    Reports per-stage latency percentiles, throughput at several concurrency levels,
+    embedding throughput, indexing time and peak memory, and saves them as JSON.
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--documents", type=int, default=50, help="number of synthetic documents per run")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16], help="concurrency levels")
+    parser.add_argument("--llm-latency", type=float, default=0.8, help="synthetic latency of an LLM call, in seconds")
+    parser.add_argument("--search-latency", type=float, default=0.05, help="synthetic latency of a search request, in seconds")
+    parser.add_argument("--search", choices=["stub", "configured"], default="stub", help="stub search service or the configured backend")
+    parser.add_argument("--stub-encoder", action="store_true", help="replace the SentenceTransformer model with hash-seeded vectors")
+    parser.add_argument("--embedding-batch-sizes", type=int, nargs="+", default=[1, 32, 256])
+    parser.add_argument("--indexing", action="store_true", help="also time the encoding of EuroVoc.xlsx")
+    parser.add_argument("--output", default=None, help="JSON file for the results")
+    parser.add_argument("--compare", default=None, help="JSON results of a baseline run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="relative slowdown tolerated by --compare")
+    args = parser.parse_args()
+
+    timer = StageTimer()
+    labels = install_stubs(args, timer)
+    documents = synthetic_documents(labels, args.documents)
+
+    results = {"config": vars(args), "throughput": {}}
+    for mode, use_async in [("sync", False), ("async", True)]:
+        for concurrency in args.concurrency:
+            print(f"Tagging {len(documents)} documents ({mode}, concurrency {concurrency})")
+            results["throughput"][f"{mode}_{concurrency}"] = benchmark_throughput(documents, concurrency, use_async)
+
+    results["stages"] = timer.summary()
+    results["embedding"] = benchmark_embedding(labels, args.embedding_batch_sizes)
+    if args.indexing:
+        results["indexing"] = benchmark_indexing("EuroVoc.xlsx")
+
+    print(f"Measuring the peak memory of tagging {len(documents)} documents")
+    results["memory"] = benchmark_memory(documents, max(args.concurrency))
+
+    output = args.output or os.path.join("results", "benchmarks", f"benchmark_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(json.dumps({key: results[key] for key in ["throughput", "stages", "embedding", "memory"]}, indent=2))
+    print(f"Results saved to {output}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
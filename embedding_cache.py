@@ -0,0 +1,218 @@
+import os
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+import numpy as np
+from instrumentation import annotate
+
+def normalize_text(text: str) -> str:
+    """Normalise the whitespace of a text before it is hashed."""
+    return " ".join(text.split())
+
+class EmbeddingCache:
+    """
+    Content-addressed store of embeddings.
+
+    Vectors are keyed by a hash of the model name and the normalised text, kept in
+    an SQLite database on disk, with an in-memory LRU of the most recently used
+    vectors in front of it.
+    """
+
+    def __init__(self, path: str, max_memory_items: int = 20000):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        self.connection = self._connect()
+        self.connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+        self.connection.commit()
+        self.lock = threading.Lock()
+
+        self.memory = OrderedDict()
+        self.max_memory_items = max_memory_items
+        self.hits = 0
+        self.misses = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        # Wait for the writes of the other worker processes rather than failing, and let
+        # them read while one of them writes
+        connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def after_fork(self):
+        """Open a connection of the forked process, as SQLite connections cannot be shared."""
+        self.connection = self._connect()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(model_name: str, text: str) -> str:
+        """Return the cache key of a text embedded with the given model."""
+        return hashlib.sha256(f"{model_name}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, vector: np.ndarray):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+
+    def get_many(self, keys: list) -> dict:
+        """
+        Look up several keys at once.
+
+        Args:
+            keys (list): The cache keys to look up.
+
+        Returns:
+            dict: The cached vectors of the keys that were found.
+        """
+        found = {}
+        with self.lock:
+            missing = []
+            for key in dict.fromkeys(keys):
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    found[key] = self.memory[key]
+                else:
+                    missing.append(key)
+
+            # Query the disk store in chunks to stay below SQLite's parameter limit
+            for start in range(0, len(missing), 500):
+                chunk = missing[start:start + 500]
+                rows = self.connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                for key, blob in rows:
+                    vector = np.frombuffer(blob, dtype=np.float32)
+                    found[key] = vector
+                    self._remember(key, vector)
+
+            self.hits += sum(key in found for key in keys)
+            self.misses += sum(key not in found for key in keys)
+
+        return found
+
+    def put_many(self, items: dict):
+        """
+        Store several vectors at once.
+
+        Args:
+            items (dict): The vectors to store, by cache key.
+        """
+        with self.lock:
+            vectors = {key: np.asarray(vector, dtype=np.float32) for key, vector in items.items()}
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, vector.tobytes()) for key, vector in vectors.items()],
+            )
+            self.connection.commit()
+            for key, vector in vectors.items():
+                self._remember(key, vector)
+
+class CachedEncoder:
+    """
+    Wrapper of a SentenceTransformer model whose `encode` only runs the model on texts
+    missing from the embedding cache. Other attributes are delegated to the model.
+    """
+
+    def __init__(self, model, model_name: str, cache: EmbeddingCache = None):
+        self.model = model
+        self.model_name = model_name
+        self.cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def after_fork(self):
+        """Prepare the model and the cache for use in a forked process."""
+        if hasattr(self.model, "after_fork"):
+            self.model.after_fork()
+        if self.cache is not None:
+            self.cache.after_fork()
+
+    def _encode(self, sentences: list, batch_size: int, processes: int, **kwargs) -> np.ndarray:
+        # Only SentenceTransformer models can encode with several processes
+        if processes > 0 and hasattr(self.model, "start_multi_process_pool"):
+            pool = self.model.start_multi_process_pool(target_devices=["cpu"] * processes)
+            try:
+                return self.model.encode_multi_process(sentences, pool, batch_size=batch_size)
+            finally:
+                self.model.stop_multi_process_pool(pool)
+
+        return self.model.encode(sentences, batch_size=batch_size, convert_to_numpy=True, show_progress_bar=False, **kwargs)
+
+    def encode(self, sentences, batch_size: int = 32, processes: int = 0, **kwargs) -> np.ndarray:
+        """
+        Encode one or several sentences, reusing the cached embeddings.
+
+        Args:
+            sentences (str or list): The sentence or list of sentences to encode.
+            batch_size (int): The number of sentences encoded per forward pass.
+            processes (int): The number of encoding processes, 0 to encode in-process.
+
+        Returns:
+            np.ndarray: The float32 embedding, or matrix of embeddings for a list.
+        """
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+        else:
+            sentences = list(sentences)
+
+        if not sentences:
+            return np.empty((0, self.model.get_sentence_embedding_dimension()), dtype=np.float32)
+
+        # Embeddings are always returned as NumPy arrays without a progress bar
+        kwargs.pop("convert_to_numpy", None)
+        kwargs.pop("show_progress_bar", None)
+
+        # Other options may change the embeddings (e.g. normalisation) and bypass the cache
+        if self.cache is None or kwargs:
+            vectors = np.asarray(self._encode(sentences, batch_size, processes, **kwargs), dtype=np.float32)
+            return vectors[0] if single else vectors
+
+        keys = [self.cache.key(self.model_name, sentence) for sentence in sentences]
+        found = self.cache.get_many(keys)
+
+        # Encode each missing text only once
+        missing = {key: sentence for key, sentence in zip(keys, sentences) if key not in found}
+        annotate(cache_hits=len(keys) - len(missing), cache_misses=len(missing))
+        if missing:
+            vectors = self._encode(list(missing.values()), batch_size, processes)
+            encoded = dict(zip(missing.keys(), np.asarray(vectors, dtype=np.float32)))
+            self.cache.put_many(encoded)
+            found.update(encoded)
+
+        vectors = np.stack([found[key] for key in keys])
+        return vectors[0] if single else vectors
+
+def load_encoder(model_name: str, cache_path: str = None, backend: str = "pytorch", onnx_path: str = "onnx_model", quantized: bool = True) -> CachedEncoder:
+    """
+    Load a SentenceTransformer model behind the embedding cache.
+
+    Args:
+        model_name (str): The name of the SentenceTransformer model.
+        cache_path (str): The path of the SQLite cache, or None to disable caching.
+        backend (str): "pytorch" to run the model with sentence-transformers, or "onnx"
+            to run its export in `onnx_path` with ONNX Runtime, without importing torch.
+        onnx_path (str): The folder of the model exported by `onnx_encoder.export_onnx`.
+        quantized (bool): Whether the ONNX backend runs the int8-quantized model.
+
+    Returns:
+        CachedEncoder: The model wrapped with the embedding cache.
+    """
+    cache = EmbeddingCache(cache_path) if cache_path else None
+
+    if backend == "onnx":
+        from onnx_encoder import OnnxEncoder
+
+        # The embeddings of each backend are cached separately, as they differ slightly
+        return CachedEncoder(OnnxEncoder(onnx_path, quantized=quantized), f"{model_name}:onnx{'-int8' if quantized else ''}", cache)
+    if backend != "pytorch":
+        raise ValueError(f"Unknown encoder backend: {backend}")
+
+    from sentence_transformers import SentenceTransformer
+
+    return CachedEncoder(SentenceTransformer(model_name), model_name, cache)
@@ -1,9 +1,17 @@
-from semantic_tagging import predict_tags
+from semantic_tagging import predict_tags, pipeline_config
+import resources
+import instrumentation
+from batch_runner import run_batch
 import pandas as pd
 import os
+import json
+import hashlib
 
 INPUT_PATH = "PATH_TO_YOUR_FILE"
 
+# Number of articles tagged concurrently
+CONCURRENCY = int(os.environ.get("EVALUATION_CONCURRENCY", 4))
+
 def comparing_to_ground_truth(relevant_tags, ground_truth):
     """
     Compute the recall and precision of predicted tags against the ground truth tags.
@@ -36,51 +44,73 @@ def main():
     """
     Main entry point of the script for evaluating the tag prediction.
 
-    It reads the testing corpus from an Excel file, predicts tags for each article summary, 
-    coomputes recall and precision, and saves the results in a new Excel file.
+    It reads the testing corpus from an Excel file, predicts tags for the article summaries
+    concurrently, computes recall and precision, and saves the results in a new Excel file.
+
+    Predicted tags are checkpointed to a JSONL file in the output directory as soon as they
+    are available, so that an interrupted evaluation resumes where it stopped. The name of
+    the checkpoint includes a fingerprint of the pipeline configuration, so that a run with
+    another deployment, prompt, retrieval or filter configuration starts from scratch
+    rather than reusing predictions of the previous one. Delete the checkpoint to evaluate
+    the corpus again with the same configuration.
     """
+    instrumentation.serve_metrics()
     testing_corpus = pd.read_excel(INPUT_PATH)
-    
-    # Lists to store recall, precision, and predicted tags
-    recall_list, precision_list, prediction_list = [], [], []
 
-    # Loop through each row of the test corpus 
-    for index, row in testing_corpus.iterrows():
-
-        text = row["Article summary "]
+    # Create ouotput directory if it does not exist
+    output_dir = "results/"
+    os.makedirs(output_dir, exist_ok=True)
+    config = json.dumps(pipeline_config(), sort_keys=True)
+    fingerprint = hashlib.sha256(config.encode("utf-8")).hexdigest()[:12]
+    checkpoint_path = os.path.join(output_dir, f"checkpoint_{os.path.splitext(os.path.basename(INPUT_PATH))[0]}_{fingerprint}.jsonl")
+    print(f"Checkpointing predictions to {checkpoint_path} for the configuration {config}")
+
+    # Get ground truth tags and handle splitting and stripping
+    ground_truths = {
+        str(index): row["DET tags that express the main subject matter (often with post-coordination)"].split(" + ")
+        for index, row in testing_corpus.iterrows()
+    }
+
+    # Predicting tags using the provided model, skipping rows with an empty ground truth
+    items = (
+        (index, row["Article summary "])
+        for index, row in testing_corpus.iterrows()
+        if ground_truths[str(index)]
+    )
+    predictions = run_batch(items, predict_tags, checkpoint_path, concurrency=CONCURRENCY)
 
-        # Get ground truth tags and handle splitting and stripping
-        ground_truth = row["DET tags that express the main subject matter (often with post-coordination)"].split(" + ")
+    # Lists to store recall, precision, and predicted tags
+    recall_list, precision_list, prediction_list = [], [], []
 
-        # Skip if ground truth is empty
-        if not ground_truth:
-            continue
-       
-        # Predicting tags using the provided model
-        predicted_tags = predict_tags(text)
+    for index in testing_corpus.index:
+        predicted_tags = predictions.get(str(index))
 
-        # Compute recall and precision
-        recall, precision = comparing_to_ground_truth(predicted_tags, ground_truth)
+        # Leave the scores empty for rows that were skipped or failed
+        if predicted_tags is None:
+            recall, precision = None, None
+        else:
+            # Compute recall and precision
+            recall, precision = comparing_to_ground_truth(predicted_tags, ground_truths[str(index)])
 
         # Append results to respective lists
         prediction_list.append(predicted_tags)
         recall_list.append(recall)
         precision_list.append(precision)
-    
+
     # Add results to the DataFrame
     testing_corpus["Label created by Auto-tagger"] = prediction_list
     testing_corpus["Recall"] = recall_list
     testing_corpus["Precision"] = precision_list
 
-    # Create ouotput directory if it does not exist
-    output_dir = "results/"
-    os.makedirs(output_dir, exist_ok=True)
-
     # Save the results to an Excel file
     output_file = os.path.join(output_dir, "results.xlsx")
     testing_corpus.to_excel(output_file, index=False)
 
     print(f'Results saved to {output_file}')
 
+    # Report how many LLM calls were served from the response cache
+    if resources.is_loaded("llm_cache") and resources.get("llm_cache") is not None:
+        print(f'LLM response cache: {resources.get("llm_cache").stats()}')
+
 if __name__=="__main__":
     main()
\ No newline at end of file
@@ -1,9 +1,13 @@
 import pandas as pd
-from sentence_transformers import SentenceTransformer
+import numpy as np
 import os
+import sys
 import json
-import pathlib
+import hashlib
 from dotenv import load_dotenv
+from knowledge_base import save_knowledge_base, load_knowledge_base, knowledge_base_columns, iter_documents
+import resources
+from batch_runner import call_with_retry, process_concurrently
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents.indexes import SearchIndexClient
 from azure.search.documents import SearchClient
@@ -24,8 +28,6 @@ from azure.search.documents.indexes.models import (
     HnswParameters,
 )
 
-# Load pre-trained SentenceTransformer model
-MODEL = SentenceTransformer('all-MiniLM-L6-v2')
 # Load environment variables from .env file
 load_dotenv(override=True)
 
@@ -33,58 +35,135 @@ load_dotenv(override=True)
 search_endpoint = os.environ.get("SEACRH_ENDPOINT")
 index_name = os.environ.get("INDEX_NAME")
 api_key = os.environ.get("API_KEY")
-credential = AzureKeyCredential(api_key)
+# No credential is needed when only the local index is built
+credential = AzureKeyCredential(api_key) if api_key else None
+
+# Number of sentences encoded per forward pass, and number of worker processes
+# used for encoding (0 encodes in the current process)
+BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", 256))
+ENCODING_PROCESSES = int(os.environ.get("ENCODING_PROCESSES", 0))
+
+# Search backend the index is built for ("azure" or "local") and folder of the local index
+search_backend_name = os.environ.get("SEARCH_BACKEND", "azure")
+local_index_path = os.environ.get("LOCAL_INDEX_PATH", "eurovoc_index")
+# Type of the vectors stored in the knowledge base: "float32" or "float16"
+KNOWLEDGE_BASE_DTYPE = os.environ.get("KNOWLEDGE_BASE_DTYPE", "float32")
+
+# Maximum number of documents and JSON payload size of an upload request, and
+# number of concurrent upload requests
+UPLOAD_BATCH_SIZE = int(os.environ.get("UPLOAD_BATCH_SIZE", 1000))
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", 8 * 1024 * 1024))
+UPLOAD_CONCURRENCY = int(os.environ.get("UPLOAD_CONCURRENCY", 4))
+
+# Fields of the documents uploaded to the Azure index
+INDEX_FIELDS = ["id", "Label", "Definition"]
+
+def prepare_knowledge_base(file: pd.DataFrame) -> tuple:
+    """
+    Prepare the descriptors of the provided Excel file for encoding.
+
+    Only the rows with a definition are kept. Documents are keyed by DESCRIPTEUR_ID,
+    so that their ids are stable across EuroVoc releases, and carry a hash of the
+    "LIBELLE: DEF" text they are embedded from, to detect changes. Descriptors
+    without a DESCRIPTEUR_ID are keyed by a hash of their label instead.
+
+    Args:
+        file (pd.DataFrame): The DataFrame containing the data loaded from Excel.
 
-def creating_index_from_excel(file: pd.DataFrame, knowledge_base: list) -> list:
+    Returns:
+        tuple: A tuple containing:
+            - pd.DataFrame: The metadata of each document (id, Label, Definition, content_hash)
+            - list: The "LIBELLE: DEF" text to embed for each document
     """
-    Creating a knowledge base from the provided Excel file.
+    # Only process rows where 'DEF' is not NaN
+    rows = file[file["DEF"].notna() & (file["DEF"].astype(str) != "nan")]
+    labels = rows["LIBELLE"].fillna("").astype(str)
+    definitions = rows["DEF"].astype(str)
+    texts = (labels + ": " + definitions).tolist()
+
+    ids = [
+        f'{int(descriptor_id)}' if pd.notna(descriptor_id) else f'L{hashlib.sha1(label.encode("utf-8")).hexdigest()[:16]}'
+        for descriptor_id, label in zip(rows["DESCRIPTEUR_ID"], labels)
+    ]
 
-    This functino extracts data from the DataFrame, encodes the definitions using
-    a pre-trained model, and appends each document to the knowledge base list.
+    metadata = pd.DataFrame({
+        "id": ids,
+        "Label": labels.to_numpy(),
+        "Definition": definitions.to_numpy(),
+        "content_hash": [hashlib.sha256(text.encode("utf-8")).hexdigest() for text in texts],
+    })
+
+    return metadata, texts
+
+def encode_knowledge_base(file: pd.DataFrame, batch_size: int = BATCH_SIZE, processes: int = ENCODING_PROCESSES) -> tuple:
+    """
+    Encode the descriptors of the provided Excel file in batches.
+
+    The "LIBELLE: DEF" strings built by `prepare_knowledge_base` are encoded in batches
+    of `batch_size`, optionally spread over a pool of `processes` worker processes.
 
     Args:
         file (pd.DataFrame): The DataFrame containing the data loaded from Excel.
-        knowledge_base (list): The list to which each document will be appended.
+        batch_size (int): The number of sentences encoded per forward pass.
+        processes (int): The number of encoding processes, 0 to encode in-process.
 
     Returns:
-        list: The updated knowledge base list with generated documents.
+        tuple: A tuple containing:
+            - np.ndarray: A float32 matrix with one embedding per row of the metadata
+            - pd.DataFrame: The metadata of each document (id, Label, Definition, content_hash)
     """
-    id = 0
-    for index, row in file.iterrows():
-        # Only process rows where 'DEF' is not NaN
-        if not f'{row["DEF"]}'=="nan": 
-            document = {
-                "id": f'{id}',
-                "Label": (row["LIBELLE"] if not f'{row["LIBELLE"]}' == "nan" else ""),
-                "Definition": (row["DEF"] if not f'{row["DEF"]}' == "nan" else ""), 
-                "Label_def_vector": MODEL.encode(f'{row["LIBELLE"]}: {row["DEF"]}').tolist()
-            }
-            knowledge_base.append(document)
-            id += 1
+    metadata, texts = prepare_knowledge_base(file)
 
+    vectors = resources.get("model").encode(texts, batch_size=batch_size, processes=processes)
 
-    return knowledge_base
+    return np.asarray(vectors, dtype=np.float32), metadata
 
-def knowledge_base_to_json(knowledge_base):
+def encode_knowledge_base_incrementally(file: pd.DataFrame, folder_path: str, batch_size: int = BATCH_SIZE, processes: int = ENCODING_PROCESSES) -> tuple:
     """
-    Save each document in the knowledge base to a separate JSON file.
+    Encode the descriptors of the provided Excel file, reusing a previous knowledge base.
 
-    This function writes each document in the knowledge base to a file in the 'eurovoc'
-    directory with a sequential naming convention.
+    The new vocabulary is compared with the knowledge base saved in `folder_path` by
+    DESCRIPTEUR_ID and content hash. Only added or changed descriptors are encoded,
+    the vectors of unchanged ones are copied from the previous knowledge base.
 
     Args:
-        knowledge_base(list): The list of documents to be saved as JSON files.
+        file (pd.DataFrame): The DataFrame containing the data loaded from Excel.
+        folder_path (str): The folder containing the previous knowledge base.
+        batch_size (int): The number of sentences encoded per forward pass.
+        processes (int): The number of encoding processes, 0 to encode in-process.
+
+    Returns:
+        tuple: A tuple containing:
+            - np.ndarray: A float32 matrix with one embedding per row of the metadata
+            - pd.DataFrame: The metadata of each document (id, Label, Definition, content_hash)
+            - list: The ids of the added or changed documents
+            - list: The ids of the deleted documents
     """
-    path = os.getcwd()
-    id = 1
-    for doc in knowledge_base:
-        id += 1
-        file_path = os.path.join(path, 'eurovoc', f'eurovoc_{id}.json')
+    metadata, texts = prepare_knowledge_base(file)
+
+    previous_vectors, previous_metadata = load_knowledge_base(folder_path, columns=["id", "content_hash"])
+    previous = {
+        id: (position, content_hash)
+        for position, (id, content_hash) in enumerate(zip(previous_metadata.column("id").to_pylist(), previous_metadata.column("content_hash").to_pylist()))
+    }
+
+    vectors = np.empty((len(metadata), previous_vectors.shape[1]), dtype=np.float32)
+    changed = []
+    for position, (id, content_hash) in enumerate(zip(metadata["id"], metadata["content_hash"])):
+        if id in previous and previous[id][1] == content_hash:
+            vectors[position] = previous_vectors[previous[id][0]]
+        else:
+            changed.append(position)
 
-        # Write document data to JSON file
-        with open(file_path, "w") as file: 
-            json.dump(doc, file)
+    # Release the memory map of the previous knowledge base
+    del previous_vectors
 
+    if changed:
+        vectors[changed] = resources.get("model").encode([texts[position] for position in changed], batch_size=batch_size, processes=processes)
+
+    deleted = sorted(set(previous) - set(metadata["id"]))
+
+    return vectors, metadata, metadata["id"].iloc[changed].tolist(), deleted
 
 def create_or_update_index_on_Azure():
     """
@@ -143,48 +222,171 @@ def get_search_client():
     """
     return SearchClient(endpoint=search_endpoint, index_name=index_name, credential=credential)
 
-def upload_index_to_Azure(folder_path: str): 
+def batch_documents(documents, batch_size: int = UPLOAD_BATCH_SIZE, max_bytes: int = UPLOAD_MAX_BYTES):
+    """
+    Group documents into upload batches bounded by count and serialised size.
+
+    Args:
+        documents: An iterable of documents.
+        batch_size (int): The maximum number of documents per batch.
+        max_bytes (int): The maximum size of the JSON payload of a batch.
+
+    Yields:
+        list: Each batch of documents.
+    """
+    batch, size = [], 0
+    for document in documents:
+        document_size = len(json.dumps(document))
+        if batch and (len(batch) >= batch_size or size + document_size > max_bytes):
+            yield batch
+            batch, size = [], 0
+        batch.append(document)
+        size += document_size
+
+    if batch:
+        yield batch
+
+def upload_documents_to_Azure(documents, concurrency: int = UPLOAD_CONCURRENCY, max_rounds: int = 3) -> list:
     """
-    Upload JSON documents from a specified folder to Azure AI Search.
+    Upload documents to Azure AI Search in concurrent batches.
 
-    This function loads JSON files from the given folder and uploads each document
-    to the Azure search index. It logs any failures that occur during the upload process.
+    Each batch is a single request, retried with backoff on rate limits and transient
+    errors. Documents rejected by the service are reported individually, and only
+    those are uploaded again, for at most `max_rounds` rounds.
 
     Args:
-        folder_path (str): The path to the folder containing the JSON files to upload.
+        documents: An iterable of documents to upload.
+        concurrency (int): The number of batches uploaded concurrently.
+        max_rounds (int): The maximum number of upload rounds.
+
+    Returns:
+        list: The keys of the documents that could not be uploaded.
     """
     index_client = get_search_client()
-    index_entry_path = pathlib.Path(folder_path).glob("*")
-    failed_to_upload = [] # List to keep track of failed upload attempts
-    for entry_path in index_entry_path:
-        print(entry_path)
-        try:
-            with open(entry_path) as file:
-                index = json.load(file)
-                print(f"Uploading {index['id']}")
-                index_client.upload_documents(documents=[index])
 
+    def upload(batch):
+        try:
+            results = call_with_retry(index_client.upload_documents, documents=batch)
         except Exception as e:
-            print(entry_path)
-            print(e)
-            failed_to_upload.append(entry_path) # Record the path of the failed upload
+            # The whole batch failed: report every document
+            return [(document, str(e)) for document in batch]
+
+        failed_keys = {result.key: result.error_message for result in results if not result.succeeded}
+        return [(document, failed_keys[str(document["id"])]) for document in batch if str(document["id"]) in failed_keys]
+
+    for upload_round in range(max_rounds):
+        failed = []
+        batches = enumerate(batch_documents(documents))
+        for _, batch_failures, error in process_concurrently(batches, upload, concurrency):
+            if error is not None:
+                raise error
+            failed.extend(batch_failures)
+
+        for document, message in failed:
+            print(f"Failed to upload {document['id']}: {message}")
+
+        if not failed:
+            break
 
-    print(failed_to_upload)
+        # Retry only the documents that failed
+        documents = [document for document, _ in failed]
+        print(f"Upload round {upload_round + 1}: {len(failed)} documents failed")
 
-def create_index():
+    return [document["id"] for document, _ in failed]
+
+def upload_index_to_Azure(folder_path: str): 
+    """
+    Upload a knowledge base to Azure AI Search.
+
+    This function streams the documents of the knowledge base saved in the given
+    folder and uploads them in batches with `upload_documents_to_Azure`. It logs
+    the documents that could not be uploaded.
+
+    Args:
+        folder_path (str): The path to the folder containing the knowledge base to upload.
+    """
+    failed_to_upload = upload_documents_to_Azure(iter_documents(folder_path, columns=INDEX_FIELDS))
+
+    print(f"Failed to upload: {failed_to_upload}")
+
+def update_index_on_Azure(folder_path: str, changed: list, deleted: list):
+    """
+    Apply the changes of an incremental reindex to Azure AI Search.
+
+    Added and changed documents are upserted from the knowledge base saved in the
+    given folder, and deleted documents are removed from the index by key.
+
+    Args:
+        folder_path (str): The path to the folder containing the knowledge base.
+        changed (list): The ids of the added or changed documents.
+        deleted (list): The ids of the deleted documents.
+    """
+    changed = set(changed)
+    documents = (document for document in iter_documents(folder_path, columns=INDEX_FIELDS) if document["id"] in changed)
+    failed_to_upload = upload_documents_to_Azure(documents)
+    print(f"Failed to upload: {failed_to_upload}")
+
+    delete_documents_from_Azure(deleted)
+
+def delete_documents_from_Azure(ids: list):
+    """
+    Delete documents from Azure AI Search by key, in batches.
+
+    Args:
+        ids (list): The ids of the documents to delete.
+    """
+    index_client = get_search_client()
+    for start in range(0, len(ids), UPLOAD_BATCH_SIZE):
+        batch = [{"id": id} for id in ids[start:start + UPLOAD_BATCH_SIZE]]
+        results = call_with_retry(index_client.delete_documents, documents=batch)
+        failed_to_delete = [result.key for result in results if not result.succeeded]
+        if failed_to_delete:
+            print(f"Failed to delete: {failed_to_delete}")
+
+def delete_stale_documents_from_Azure(folder_path: str):
+    """
+    Delete the documents of the Azure index that are not in the knowledge base.
+
+    A full reindex upserts the documents over the existing index, so documents left by
+    a previous vocabulary, or by an earlier keying scheme such as positional ids, would
+    otherwise stay searchable.
+
+    Args:
+        folder_path (str): The path to the folder containing the knowledge base.
+    """
+    _, metadata = load_knowledge_base(folder_path, columns=["id"])
+    ids = set(metadata.column("id").to_pylist())
+
+    search_client = get_search_client()
+    index_ids = call_with_retry(lambda: [result["id"] for result in search_client.search(search_text="*", select=["id"])])
+    stale = sorted(id for id in index_ids if id not in ids)
+
+    print(f"{len(stale)} stale documents to delete")
+    delete_documents_from_Azure(stale)
+
+def create_index(incremental: bool = False):
     """
     Coordinate the creation of the Azure search index.
 
-    This function reads an Excel file, prepares the knowledge base by converting it
-    to JSON documents, creates or updates the Azure search index, and uploads the 
-    documents to Azure.
+    This function reads an Excel file, prepares the knowledge base and saves it
+    as a single artifact used by the local search backend. Unless SEARCH_BACKEND
+    is "local", it then creates or updates the Azure search index, and uploads the
+    documents of the knowledge base to Azure.
+
+    In incremental mode, the vocabulary is compared with the previous knowledge base:
+    only the added or changed descriptors are encoded and upserted, and the deleted
+    ones are removed from the index. The first run, or a knowledge base saved before
+    content hashes were recorded, falls back to a full reindex, which also deletes
+    the documents of the index missing from the new knowledge base.
 
     This is the main function that consolidates the steps necessary to set up
     the search infrastructure.
+
+    Args:
+        incremental (bool): Whether to only apply the changes since the previous run.
     """
     path = os.getcwd()
     
-    index_folder = os.path.join(path, 'eurovoc')
     eurovoc_path = os.path.join(path, 'EuroVoc.xlsx')
     
     # Load Excel file into DataFrame
@@ -192,9 +394,25 @@ def create_index():
 
     # Prepare knowledge base documents from Excel data
     print("DATA PREPARATION: create embedded_index")
-    knowledge_base = []
-    creating_index_from_excel(eurovoc, knowledge_base)
-    knowledge_base_to_json(knowledge_base)
+    incremental = incremental and "content_hash" in knowledge_base_columns(local_index_path)
+    if incremental:
+        vectors, metadata, changed, deleted = encode_knowledge_base_incrementally(eurovoc, local_index_path)
+        print(f"{len(changed)} descriptors added or changed, {len(deleted)} deleted")
+    else:
+        vectors, metadata = encode_knowledge_base(eurovoc)
+
+    # Save the knowledge base artifact
+    print("DATA PREPARATION: save_knowledge_base")
+    save_knowledge_base(vectors, metadata, local_index_path, dtype=KNOWLEDGE_BASE_DTYPE)
+
+    if search_backend_name == "local":
+        return
+
+    if incremental:
+        # Upsert and delete only the changed documents
+        print("DATA PREPARATION: update_index_on_azure")
+        update_index_on_Azure(local_index_path, changed, deleted)
+        return
 
     # Create or update the index on Azure
     print("DATA PREPARATION: create_or_update_index_on_azure")
@@ -202,7 +420,11 @@ def create_index():
 
     # Upload the index documents to Azure
     print("DATA PREPARATION: upload_index_to_azure")
-    upload_index_to_Azure(index_folder)
+    upload_index_to_Azure(local_index_path)
+
+    # Remove the documents that are no longer in the knowledge base
+    print("DATA PREPARATION: delete_stale_documents_from_azure")
+    delete_stale_documents_from_Azure(local_index_path)
 
 if __name__ == "__main__":
-    create_index()
\ No newline at end of file
+    create_index(incremental="--incremental" in sys.argv)
@@ -0,0 +1,385 @@
+import os
+import re
+import json
+import time
+import asyncio
+import logging
+import threading
+import functools
+import contextvars
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Span of the current thread or task, parent of the spans opened inside it
+_current_span = contextvars.ContextVar("current_span", default=None)
+_sinks = []
+_configured = False
+_lock = threading.Lock()
+
+class Span:
+    """
+    Timed stage of the pipeline, with attributes such as token counts, candidate
+    counts or cache hits. Spans are opened with `span` and nest through context
+    variables, across threads started with `to_thread` and across tasks.
+    """
+
+    def __init__(self, name: str, parent=None, **attributes):
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes
+        self.start_time = None
+        self.duration = None
+        self.error = None
+        self._start = None
+        self._token = None
+
+    def set(self, **attributes):
+        """Set attributes of the span."""
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        self._token = _current_span.set(self)
+        for sink in _sinks:
+            sink.start(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.perf_counter() - self._start
+        if exc_value is not None:
+            self.error = f"{exc_type.__name__}: {exc_value}"
+        _current_span.reset(self._token)
+        for sink in _sinks:
+            try:
+                sink.end(self)
+            except Exception as e:
+                print(f"Instrumentation sink {type(sink).__name__} failed: {e}")
+        return False
+
+    def to_dict(self) -> dict:
+        """Return the span as a JSON-serialisable dictionary."""
+        return {
+            "name": self.name,
+            "parent": self.parent.name if self.parent else None,
+            "start_time": self.start_time,
+            "duration_ms": round(self.duration * 1000, 3) if self.duration is not None else None,
+            "error": self.error,
+            **self.attributes,
+        }
+
+def span(name: str, **attributes) -> Span:
+    """
+    Open a span timing a stage of the pipeline, as a context manager.
+
+    Args:
+        name (str): The name of the stage, e.g. "llm.tags" or "search".
+        **attributes: The initial attributes of the span.
+
+    Returns:
+        Span: The span, child of the current span if any.
+    """
+    return Span(name, _current_span.get(), **attributes)
+
+async def to_thread(function, *args, **kwargs):
+    """
+    Run a function in the default thread pool of the event loop, in the current context
+    so that its spans nest under the current one (`asyncio.to_thread` before Python 3.9).
+
+    Args:
+        function: The function to call with the remaining arguments.
+
+    Returns:
+        The result of the function.
+    """
+    loop = asyncio.get_running_loop()
+    call = functools.partial(contextvars.copy_context().run, function, *args, **kwargs)
+    return await loop.run_in_executor(None, call)
+
+def annotate(**attributes):
+    """Set attributes of the current span, if any."""
+    current = _current_span.get()
+    if current is not None:
+        current.set(**attributes)
+
+def record_usage(response):
+    """Record the token usage and finish reason of a chat completion on the current span."""
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        annotate(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
+    if getattr(response, "choices", None):
+        annotate(finish_reason=response.choices[0].finish_reason)
+
+class Sink:
+    """Base class of the destinations of the spans."""
+
+    def start(self, span: Span):
+        """Called when a span is opened."""
+
+    def end(self, span: Span):
+        """Called when a span is closed, with its duration and final attributes."""
+
+class LoggingSink(Sink):
+    """Log each closed span as a line of JSON."""
+
+    def __init__(self, logger: logging.Logger = None):
+        if logger is None:
+            logger = logging.getLogger("semantic_tagging.instrumentation")
+            # Spans are logged even when the application does not configure logging
+            if not logger.handlers and not logging.getLogger().handlers:
+                logger.addHandler(logging.StreamHandler())
+                logger.setLevel(logging.INFO)
+        self.logger = logger
+
+    def end(self, span: Span):
+        self.logger.info(json.dumps(span.to_dict(), default=str))
+
+class PrometheusSink(Sink):
+    """
+    Aggregate the spans into Prometheus metrics: a histogram of the durations of each
+    span name, and a counter of each numeric or boolean attribute, e.g. the tokens
+    consumed or the cache hits of each stage. `render` returns the text exposition
+    format, served on /metrics by `serve`.
+
+    Processes serving the same application, e.g. forked workers, share a directory
+    with `share`: each writes its metrics there, and `render` returns their sum.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, prefix: str = "semantic_tagging"):
+        self.prefix = prefix
+        self.durations = {}
+        self.counters = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+        self.server = None
+        self.directory = None
+        self.path = None
+
+    def share(self, directory: str, interval: float = 5.0):
+        """
+        Aggregate the metrics of the processes sharing `directory`.
+
+        The metrics of this process are written to the directory every `interval`
+        seconds and when rendered, and the metrics recorded before, e.g. those a
+        forked worker inherits from its parent, are discarded. The files of exited
+        processes are kept, so that the counters never decrease.
+
+        Args:
+            directory (str): The directory shared by the processes.
+            interval (float): The number of seconds between two writes.
+        """
+        os.makedirs(directory, exist_ok=True)
+        with self.lock:
+            self.durations, self.counters, self.errors = {}, {}, {}
+            self.directory = directory
+            self.path = os.path.join(directory, f"metrics_{os.getpid()}_{time.time_ns()}.json")
+
+        def write_periodically():
+            while True:
+                time.sleep(interval)
+                self.write()
+
+        self.write()
+        threading.Thread(target=write_periodically, daemon=True).start()
+
+    def write(self):
+        """Write the metrics of this process to the shared directory."""
+        with self.lock:
+            data = json.dumps({
+                "durations": self.durations,
+                "errors": self.errors,
+                "counters": [[span_name, attribute, value] for (span_name, attribute), value in self.counters.items()],
+            })
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as file:
+            file.write(data)
+        os.replace(temporary_path, self.path)
+
+    def _aggregate(self):
+        """Return the durations, errors and counters summed over the shared directory."""
+        durations, errors, counters = {}, {}, {}
+        for name in os.listdir(self.directory):
+            if not (name.startswith("metrics_") and name.endswith(".json")):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), encoding="utf-8") as file:
+                    state = json.load(file)
+            except (OSError, ValueError):
+                continue
+            for span_name, histogram in state["durations"].items():
+                total = durations.setdefault(span_name, {"buckets": [0] * len(self.BUCKETS), "sum": 0.0, "count": 0})
+                total["buckets"] = [a + b for a, b in zip(total["buckets"], histogram["buckets"])]
+                total["sum"] += histogram["sum"]
+                total["count"] += histogram["count"]
+            for span_name, count in state["errors"].items():
+                errors[span_name] = errors.get(span_name, 0) + count
+            for span_name, attribute, value in state["counters"]:
+                counters[(span_name, attribute)] = counters.get((span_name, attribute), 0) + value
+        return durations, errors, counters
+
+    def end(self, span: Span):
+        with self.lock:
+            histogram = self.durations.setdefault(span.name, {"buckets": [0] * len(self.BUCKETS), "sum": 0.0, "count": 0})
+            for index, bound in enumerate(self.BUCKETS):
+                if span.duration <= bound:
+                    histogram["buckets"][index] += 1
+            histogram["sum"] += span.duration
+            histogram["count"] += 1
+
+            if span.error:
+                self.errors[span.name] = self.errors.get(span.name, 0) + 1
+
+            for attribute, value in span.attributes.items():
+                if isinstance(value, (bool, int, float)):
+                    key = (span.name, attribute)
+                    self.counters[key] = self.counters.get(key, 0) + float(value)
+
+    def render(self) -> str:
+        """Return the metrics in the Prometheus text exposition format, summed over the processes sharing them."""
+        if self.directory is not None:
+            # A process only reading the shared directory, e.g. the parent of the workers, has no file
+            if self.path is not None:
+                self.write()
+            durations, errors, counters = self._aggregate()
+        else:
+            with self.lock:
+                durations = {span_name: dict(histogram, buckets=list(histogram["buckets"])) for span_name, histogram in self.durations.items()}
+                errors, counters = dict(self.errors), dict(self.counters)
+
+        lines = []
+        name = f"{self.prefix}_span_duration_seconds"
+        lines += [f"# HELP {name} Duration of the stages of the pipeline.", f"# TYPE {name} histogram"]
+        for span_name, histogram in sorted(durations.items()):
+            for bound, count in zip(self.BUCKETS, histogram["buckets"]):
+                lines.append(f'{name}_bucket{{span="{span_name}",le="{bound}"}} {count}')
+            lines.append(f'{name}_bucket{{span="{span_name}",le="+Inf"}} {histogram["count"]}')
+            lines.append(f'{name}_sum{{span="{span_name}"}} {histogram["sum"]}')
+            lines.append(f'{name}_count{{span="{span_name}"}} {histogram["count"]}')
+
+        name = f"{self.prefix}_span_errors_total"
+        lines += [f"# HELP {name} Stages of the pipeline that raised an exception.", f"# TYPE {name} counter"]
+        for span_name, count in sorted(errors.items()):
+            lines.append(f'{name}{{span="{span_name}"}} {count}')
+
+        name = f"{self.prefix}_span_attribute_total"
+        lines += [f"# HELP {name} Sum of the numeric attributes of the stages, e.g. tokens or cache hits.", f"# TYPE {name} counter"]
+        for (span_name, attribute), value in sorted(counters.items()):
+            attribute = re.sub(r"[^a-zA-Z0-9_]", "_", attribute)
+            lines.append(f'{name}{{span="{span_name}",attribute="{attribute}"}} {value}')
+
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = "0.0.0.0"):
+        """Serve the metrics on http://host:port/metrics from a background thread."""
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = sink.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print(f"Serving Prometheus metrics on http://{host}:{port}/metrics")
+
+class OpenTelemetrySink(Sink):
+    """
+    Export the spans as OpenTelemetry spans, with their parents and attributes.
+    The tracer provider and exporters are configured by the application, e.g. with
+    `opentelemetry-instrument` or the OTEL_* environment variables.
+    """
+
+    def __init__(self, tracer_name: str = "semantic_tagging"):
+        from opentelemetry import trace
+
+        self.trace = trace
+        self.tracer = trace.get_tracer(tracer_name)
+        self.spans = {}
+
+    def start(self, span: Span):
+        parent = self.spans.get(id(span.parent)) if span.parent is not None else None
+        context = self.trace.set_span_in_context(parent) if parent is not None else None
+        self.spans[id(span)] = self.tracer.start_span(span.name, context=context, start_time=int(span.start_time * 1e9))
+
+    def end(self, span: Span):
+        otel_span = self.spans.pop(id(span), None)
+        if otel_span is None:
+            return
+        for attribute, value in span.attributes.items():
+            if isinstance(value, (bool, int, float, str)):
+                otel_span.set_attribute(attribute, value)
+        if span.error:
+            otel_span.set_status(self.trace.Status(self.trace.StatusCode.ERROR, span.error))
+        otel_span.end(end_time=int((span.start_time + span.duration) * 1e9))
+
+def add_sink(sink: Sink) -> Sink:
+    """Export the spans to the given sink, in addition to the configured ones."""
+    with _lock:
+        _sinks.append(sink)
+    return sink
+
+def remove_sink(sink: Sink):
+    """Stop exporting the spans to the given sink."""
+    with _lock:
+        if sink in _sinks:
+            _sinks.remove(sink)
+
+def configure(names: str = None):
+    """
+    Set up the sinks listed in INSTRUMENTATION_SINKS, once per process.
+
+    The Prometheus metrics are kept in memory: the entry points of the application
+    serve them with `serve_metrics`.
+
+    Args:
+        names (str): Comma-separated sinks among "logging", "prometheus" and "opentelemetry",
+            INSTRUMENTATION_SINKS by default. Without sinks, spans are only timed.
+    """
+    global _configured
+    with _lock:
+        if _configured:
+            return
+        _configured = True
+
+    if names is None:
+        names = os.environ.get("INSTRUMENTATION_SINKS", "")
+
+    for name in [name.strip().lower() for name in names.split(",") if name.strip()]:
+        if name == "logging":
+            add_sink(LoggingSink())
+        elif name == "prometheus":
+            add_sink(PrometheusSink())
+        elif name == "opentelemetry":
+            add_sink(OpenTelemetrySink())
+        else:
+            raise ValueError(f"Unknown instrumentation sink: {name}")
+
+def get_sink(sink_type: type):
+    """Return the first configured sink of the given type, or None."""
+    return next((sink for sink in _sinks if isinstance(sink, sink_type)), None)
+
+def serve_metrics(port: int = None):
+    """
+    Serve the metrics of the Prometheus sink on http://0.0.0.0:port/metrics, once per process.
+
+    Args:
+        port (int): The port serving the metrics, PROMETHEUS_PORT by default; 0 does not serve them.
+    """
+    if port is None:
+        port = int(os.environ.get("PROMETHEUS_PORT", 0))
+    configure()
+    sink = get_sink(PrometheusSink)
+    with _lock:
+        if port and sink is not None and sink.server is None:
+            sink.serve(port)
@@ -0,0 +1,188 @@
+import os
+import time
+import shutil
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Files making up a knowledge base folder: the embeddings as a .npy matrix that
+# can be memory-mapped, and the other columns as Parquet, row-aligned with it
+VECTORS_FILE = "Label_def_vector.npy"
+METADATA_FILE = "metadata.parquet"
+# Quantized copies of the embeddings: int8 codes with one scale per dimension,
+# and binary codes with one sign bit per dimension
+INT8_FILE = "Label_def_vector.int8.npy"
+INT8_SCALE_FILE = "Label_def_vector.int8_scale.npy"
+BINARY_FILE = "Label_def_vector.binary.npy"
+# Each save writes these files into a new version folder, then points the file
+# CURRENT at it, so that readers never see vectors and metadata of different saves
+CURRENT_FILE = "CURRENT"
+
+def version_path(folder_path: str) -> str:
+    """
+    Return the folder holding the current version of a knowledge base.
+
+    Args:
+        folder_path (str): The folder of the knowledge base.
+
+    Returns:
+        str: The version folder named in CURRENT, or the folder itself for a knowledge
+        base saved before versions were introduced.
+    """
+    current_path = os.path.join(folder_path, CURRENT_FILE)
+    if not os.path.exists(current_path):
+        return folder_path
+
+    with open(current_path) as file:
+        return os.path.join(folder_path, file.read().strip())
+
+def quantize_int8(vectors: np.ndarray) -> tuple:
+    """
+    Scalar quantize vectors to int8, with a symmetric scale per dimension.
+
+    Args:
+        vectors (np.ndarray): The float vectors, one row per document.
+
+    Returns:
+        tuple: The int8 codes and the float32 scale of each dimension.
+    """
+    scale = np.abs(vectors).max(axis=0) / 127 if len(vectors) else np.ones(vectors.shape[1])
+    scale = np.where(scale == 0, 1, scale).astype(np.float32)
+    codes = np.clip(np.round(vectors / scale), -127, 127).astype(np.int8)
+    return codes, scale
+
+def quantize_binary(vectors: np.ndarray) -> np.ndarray:
+    """
+    Quantize vectors to binary codes, one bit per dimension set for positive values.
+
+    Args:
+        vectors (np.ndarray): The float vectors, one row per query or document.
+
+    Returns:
+        np.ndarray: The codes packed in uint8, one row per vector.
+    """
+    return np.packbits(np.asarray(vectors) > 0, axis=1)
+
+def save_knowledge_base(vectors: np.ndarray, metadata, folder_path: str, dtype: str = "float32"):
+    """
+    Save the embedded knowledge base to a folder.
+
+    The vectors are normalised to unit length, so that cosine similarity becomes a
+    plain dot product, and stored as a float32 (or float16) .npy matrix, along with
+    their int8 and binary quantized codes. The ids, labels and definitions are stored
+    as a Parquet file with one row per vector.
+
+    The files are written into a new version folder, and the CURRENT pointer is then
+    replaced atomically, so a crash or a concurrent reader sees either the previous
+    or the new knowledge base as a whole. The previous version is kept for readers
+    that resolved it just before the switch, older ones are removed.
+
+    Args:
+        vectors (np.ndarray): The embeddings, one row per document.
+        metadata (pd.DataFrame): The metadata of each document (id, Label, Definition).
+        folder_path (str): The folder in which the knowledge base is written.
+        dtype (str): The type of the stored vectors, "float32" or "float16".
+    """
+    version = f"v{time.time_ns()}"
+    version_folder = os.path.join(folder_path, version)
+    os.makedirs(version_folder)
+
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors = vectors / np.where(norms == 0, 1, norms)
+
+    codes, scale = quantize_int8(vectors)
+    np.save(os.path.join(version_folder, INT8_FILE), codes)
+    np.save(os.path.join(version_folder, INT8_SCALE_FILE), scale)
+    np.save(os.path.join(version_folder, BINARY_FILE), quantize_binary(vectors))
+    np.save(os.path.join(version_folder, VECTORS_FILE), vectors.astype(dtype))
+    pq.write_table(pa.Table.from_pandas(metadata, preserve_index=False), os.path.join(version_folder, METADATA_FILE))
+
+    previous_folder = version_path(folder_path)
+    current_path = os.path.join(folder_path, CURRENT_FILE)
+    with open(current_path + ".tmp", "w") as file:
+        file.write(version)
+    os.replace(current_path + ".tmp", current_path)
+
+    for name in os.listdir(folder_path):
+        path = os.path.join(folder_path, name)
+        if name.startswith("v") and os.path.isdir(path) and path not in (version_folder, previous_folder):
+            # Memory maps of removed files stay valid in the processes holding them
+            shutil.rmtree(path, ignore_errors=True)
+
+def knowledge_base_columns(folder_path: str) -> list:
+    """
+    Return the metadata columns of a knowledge base.
+
+    Args:
+        folder_path (str): The folder containing the knowledge base.
+
+    Returns:
+        list: The names of the metadata columns, empty if there is no knowledge base.
+    """
+    metadata_path = os.path.join(version_path(folder_path), METADATA_FILE)
+    if not os.path.exists(metadata_path):
+        return []
+
+    return pq.read_schema(metadata_path).names
+
+def load_knowledge_base(folder_path: str, columns: list = None) -> tuple:
+    """
+    Load a knowledge base saved with `save_knowledge_base`.
+
+    Args:
+        folder_path (str): The folder containing the knowledge base.
+        columns (list): The metadata columns to read, all of them by default.
+
+    Returns:
+        tuple: A tuple containing:
+            - np.ndarray: The read-only, memory-mapped matrix of embeddings
+            - pa.Table: The metadata of each document
+    """
+    folder_path = version_path(folder_path)
+    vectors = np.load(os.path.join(folder_path, VECTORS_FILE), mmap_mode="r")
+    metadata = pq.read_table(os.path.join(folder_path, METADATA_FILE), columns=columns, memory_map=True)
+
+    return vectors, metadata
+
+def load_quantized_vectors(folder_path: str, quantization: str) -> tuple:
+    """
+    Load the quantized codes of a knowledge base in memory.
+
+    Args:
+        folder_path (str): The folder containing the knowledge base.
+        quantization (str): The type of codes, "int8" or "binary".
+
+    Returns:
+        tuple: The codes, and the scale of each dimension for int8 codes (None for binary ones).
+    """
+    folder_path = version_path(folder_path)
+    if quantization == "int8":
+        return np.load(os.path.join(folder_path, INT8_FILE)), np.load(os.path.join(folder_path, INT8_SCALE_FILE))
+    if quantization == "binary":
+        return np.load(os.path.join(folder_path, BINARY_FILE)), None
+    raise ValueError(f"Unknown quantization: {quantization}")
+
+def iter_documents(folder_path: str, columns: list = None, batch_size: int = 1024):
+    """
+    Stream the documents of a knowledge base, e.g. to upload them to Azure.
+
+    Args:
+        folder_path (str): The folder containing the knowledge base.
+        columns (list): The metadata columns of the documents, all of them by default.
+        batch_size (int): The number of rows read at a time.
+
+    Yields:
+        dict: Each document, with its float32 vector as a list in 'Label_def_vector'.
+    """
+    folder_path = version_path(folder_path)
+    vectors = np.load(os.path.join(folder_path, VECTORS_FILE), mmap_mode="r")
+    parquet_file = pq.ParquetFile(os.path.join(folder_path, METADATA_FILE))
+
+    start = 0
+    for record_batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+        batch_vectors = np.asarray(vectors[start:start + record_batch.num_rows], dtype=np.float32)
+        for document, vector in zip(record_batch.to_pylist(), batch_vectors):
+            document["Label_def_vector"] = vector.tolist()
+            yield document
+        start += record_batch.num_rows
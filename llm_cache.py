@@ -0,0 +1,122 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+
+class ResponseCache:
+    """
+    Disk-backed cache of deterministic LLM responses.
+
+    Responses are keyed by the deployment name, the version of the prompt template
+    and a hash of the request, and stored in SQLite. Entries expire after `ttl`
+    seconds, and the least recently used ones are evicted beyond `max_entries`.
+    """
+
+    def __init__(self, path: str, ttl: float = 30 * 24 * 3600, max_entries: int = 100000):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        self.connection = self._connect()
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, content TEXT, created REAL, accessed REAL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.connection.commit()
+        self.lock = threading.Lock()
+
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        # Wait for the writes of the other worker processes rather than failing, and let
+        # them read while one of them writes
+        connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def after_fork(self):
+        """Open a connection of the forked process, as SQLite connections cannot be shared."""
+        self.connection = self._connect()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(deployment_name: str, template_version: str, messages: list, **parameters) -> str:
+        """
+        Return the cache key of a chat completion request.
+
+        Args:
+            deployment_name (str): The name of the deployed model.
+            template_version (str): The version of the prompt template.
+            messages (list): The messages of the request.
+            parameters: The other parameters of the request (max_tokens, ...).
+
+        Returns:
+            str: The cache key.
+        """
+        request = json.dumps([deployment_name, template_version, messages, parameters], sort_keys=True)
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str:
+        """
+        Return the cached response of a key.
+
+        Args:
+            key (str): The cache key.
+
+        Returns:
+            str: The content of the response, or None if it is missing or expired.
+        """
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute("SELECT content, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                if row is not None:
+                    self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self.connection.commit()
+                    self.evictions += 1
+                self.misses += 1
+                return None
+
+            self.connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.connection.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, content: str):
+        """
+        Store the response of a key, evicting the least recently used entries if the cache is full.
+
+        Args:
+            key (str): The cache key.
+            content (str): The content of the response.
+        """
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, content, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, content, now, now),
+            )
+            excess = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self.connection.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed LIMIT ?)", (excess,)
+                )
+                self.evictions += excess
+            self.connection.commit()
+
+    def stats(self) -> dict:
+        """Return the hit, miss and eviction counts of the cache."""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total > 0 else 0,
+        }
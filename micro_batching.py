@@ -0,0 +1,173 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+import numpy as np
+from search_backends import SearchBackend
+
+class Overloaded(Exception):
+    """Raised when a request is rejected because the queue of a batcher is full."""
+
+class MicroBatcher:
+    """
+    Coalesce the items submitted concurrently by several threads into batches.
+
+    Worker threads wait for a first request, then collect the requests arriving
+    within `max_wait` seconds, up to `max_batch_size` items, and run `function`
+    once on all their items. At most `max_queue` requests wait for a worker:
+    further submissions raise `Overloaded` instead of queueing without bound.
+    """
+
+    def __init__(self, function, max_batch_size: int = 64, max_wait: float = 0.005, max_queue: int = 1024, workers: int = 1, name: str = "batcher"):
+        """
+        Start the worker threads of the batcher.
+
+        Args:
+            function: The function called with a list of items, returning one result per item.
+            max_batch_size (int): The maximum number of items per batch; a larger request is run alone.
+            max_wait (float): The time to wait for more requests after the first one, in seconds.
+            max_queue (int): The maximum number of requests waiting for a worker.
+            workers (int): The number of batches run concurrently.
+            name (str): The name of the worker threads.
+        """
+        self.function = function
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.batches = 0
+        self.items = 0
+        for index in range(workers):
+            threading.Thread(target=self._run, name=f"{name}-{index}", daemon=True).start()
+
+    def submit(self, items: list) -> Future:
+        """
+        Queue items to be processed in the next batch.
+
+        Args:
+            items (list): The items of the request.
+
+        Returns:
+            Future: The future list of results, one per item.
+
+        Raises:
+            Overloaded: If the queue is full.
+        """
+        future = Future()
+        if not items:
+            future.set_result([])
+            return future
+
+        try:
+            self.queue.put_nowait((list(items), future))
+        except queue.Full:
+            raise Overloaded(f"{self.queue.maxsize} requests are already waiting")
+        return future
+
+    def __call__(self, items: list) -> list:
+        """Process items in the next batch and wait for their results."""
+        return self.submit(items).result()
+
+    def _collect(self, head: tuple = None) -> tuple:
+        requests = [head if head is not None else self.queue.get()]
+        size = len(requests[0][0])
+        deadline = time.monotonic() + self.max_wait
+
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            # A request that would overflow the batch starts the next one
+            if size + len(request[0]) > self.max_batch_size:
+                return requests, request
+            requests.append(request)
+            size += len(request[0])
+
+        return requests, None
+
+    def _run(self):
+        carried = None
+        while True:
+            requests, carried = self._collect(carried)
+            items = [item for request_items, _ in requests for item in request_items]
+            try:
+                results = self.function(items)
+            except Exception as e:
+                for _, future in requests:
+                    future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.items += len(items)
+
+            start = 0
+            for request_items, future in requests:
+                future.set_result(results[start:start + len(request_items)])
+                start += len(request_items)
+
+    def stats(self) -> dict:
+        """Return the number of batches run, their mean size and the current queue depth."""
+        return {
+            "batches": self.batches,
+            "mean_batch_size": self.items / self.batches if self.batches else 0.0,
+            "queue_depth": self.queue.qsize(),
+        }
+
+class BatchingEncoder:
+    """
+    Encoder proxy sending the `encode` calls of concurrent threads to the model in shared batches.
+    Calls with options that may change the embeddings are sent to the model directly.
+    """
+
+    def __init__(self, encoder, max_batch_size: int = 64, max_wait: float = 0.005, max_queue: int = 1024):
+        self.encoder = encoder
+        self.batcher = MicroBatcher(self._encode_batch, max_batch_size, max_wait, max_queue, name="encode-batcher")
+
+    def __getattr__(self, name):
+        return getattr(self.encoder, name)
+
+    def _encode_batch(self, sentences: list) -> np.ndarray:
+        return self.encoder.encode(sentences, batch_size=self.batcher.max_batch_size)
+
+    def encode(self, sentences, batch_size: int = 32, processes: int = 0, **kwargs) -> np.ndarray:
+        """
+        Encode one or several sentences in the next batch.
+
+        Args:
+            sentences (str or list): The sentence or list of sentences to encode.
+            batch_size (int): The batch size of calls sent to the model directly.
+            processes (int): The number of processes of calls sent to the model directly.
+
+        Returns:
+            np.ndarray: The float32 embedding, or matrix of embeddings for a list.
+        """
+        kwargs.pop("convert_to_numpy", None)
+        kwargs.pop("show_progress_bar", None)
+        if kwargs or processes > 0:
+            return self.encoder.encode(sentences, batch_size=batch_size, processes=processes, **kwargs)
+
+        single = isinstance(sentences, str)
+        vectors = self.batcher([sentences] if single else list(sentences))
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.encoder.get_sentence_embedding_dimension())
+        return vectors[0] if single else vectors
+
+class BatchingSearchBackend(SearchBackend):
+    """
+    Search backend sending the queries of concurrent threads to another backend in shared batches.
+    Each batch is searched for the largest `k` of its queries, truncated for the others.
+    """
+
+    def __init__(self, backend: SearchBackend, max_batch_size: int = 64, max_wait: float = 0.005, max_queue: int = 1024, workers: int = 4):
+        self.backend = backend
+        self.batcher = MicroBatcher(self._search_batch, max_batch_size, max_wait, max_queue, workers, name="search-batcher")
+
+    def _search_batch(self, queries: list) -> list:
+        k = max(query_k for _, query_k in queries)
+        results = self.backend.search_batch_scored(np.stack([vector for vector, _ in queries]), k=k)
+        return [pairs[:query_k] for pairs, (_, query_k) in zip(results, queries)]
+
+    def search_batch_scored(self, vectors, k: int = 10) -> list:
+        return self.batcher([(np.asarray(vector, dtype=np.float32), k) for vector in vectors])
@@ -0,0 +1,225 @@
+import os
+import sys
+import json
+import numpy as np
+
+MODEL_FILE = "model.onnx"
+QUANTIZED_MODEL_FILE = "model_int8.onnx"
+TOKENIZER_FILE = "tokenizer.json"
+CONFIG_FILE = "encoder_config.json"
+
+# Sentences embedded by the PyTorch and ONNX models to check their parity
+PARITY_SENTENCES = [
+    "Renewable energy and energy policy of the European Union",
+    "protection of personal data",
+    "Common agricultural policy: direct payments to farmers in less-favoured areas",
+    "The Commission adopted a regulation on the interoperability of public services.",
+    "fishing quota",
+    "Free movement of workers, social security and recognition of professional qualifications across the Member States.",
+]
+
+class OnnxEncoder:
+    """
+    Sentence encoder running an exported SentenceTransformer model with ONNX Runtime,
+    with the `encode` interface of SentenceTransformer. It only depends on `tokenizers`
+    and `onnxruntime`, so serving processes never import torch.
+    """
+
+    def __init__(self, folder_path: str, quantized: bool = True, threads: int = 0):
+        """
+        Load an encoder exported by `export_onnx`.
+
+        Args:
+            folder_path (str): The folder of the exported model.
+            quantized (bool): Whether to run the int8 model rather than the float one.
+            threads (int): The number of intra-op threads, 0 for the ONNX Runtime default.
+        """
+        from tokenizers import Tokenizer
+
+        with open(os.path.join(folder_path, CONFIG_FILE)) as file:
+            self.config = json.load(file)
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(folder_path, TOKENIZER_FILE))
+        self.tokenizer.enable_truncation(max_length=self.config["max_seq_length"])
+        self.tokenizer.enable_padding(pad_id=self.config["pad_token_id"], pad_token=self.config["pad_token"])
+
+        self.model_path = os.path.join(folder_path, QUANTIZED_MODEL_FILE if quantized else MODEL_FILE)
+        self.threads = threads
+        self._create_session()
+
+    def _create_session(self):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if self.threads > 0:
+            options.intra_op_num_threads = self.threads
+        self.session = onnxruntime.InferenceSession(self.model_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+    def after_fork(self):
+        """Create the session of the forked process, as the thread pool of the parent's is not inherited."""
+        self._create_session()
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.config["dimension"]
+
+    def _encode_batch(self, sentences: list) -> np.ndarray:
+        encodings = self.tokenizer.encode_batch(sentences)
+        inputs = {
+            "input_ids": np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+            "attention_mask": np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64),
+            "token_type_ids": np.array([encoding.type_ids for encoding in encodings], dtype=np.int64),
+        }
+        token_embeddings = self.session.run(None, {name: value for name, value in inputs.items() if name in self.input_names})[0]
+
+        # Mean pooling over the tokens that are not padding
+        mask = inputs["attention_mask"][:, :, None].astype(np.float32)
+        vectors = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+        if self.config["normalize"]:
+            vectors /= np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+        return vectors.astype(np.float32)
+
+    def encode(self, sentences, batch_size: int = 32, **kwargs) -> np.ndarray:
+        """
+        Encode one or several sentences.
+
+        Options of SentenceTransformer such as `convert_to_numpy` or `show_progress_bar`
+        are accepted and ignored: embeddings are always returned as NumPy arrays.
+
+        Args:
+            sentences (str or list): The sentence or list of sentences to encode.
+            batch_size (int): The number of sentences encoded per inference.
+
+        Returns:
+            np.ndarray: The float32 embedding, or matrix of embeddings for a list.
+        """
+        single = isinstance(sentences, str)
+        sentences = [sentences] if single else list(sentences)
+
+        vectors = np.empty((len(sentences), self.get_sentence_embedding_dimension()), dtype=np.float32)
+        # Batch sentences of similar lengths together to limit the padding
+        order = np.argsort([-len(sentence) for sentence in sentences], kind="stable")
+        for start in range(0, len(sentences), batch_size):
+            positions = order[start:start + batch_size]
+            vectors[positions] = self._encode_batch([sentences[position] for position in positions])
+
+        return vectors[0] if single else vectors
+
+def export_onnx(model_name: str, folder_path: str, quantize: bool = True, opset: int = 14):
+    """
+    Export a SentenceTransformer model to ONNX, with a dynamically int8-quantized copy.
+
+    Only the transformer is exported: the mean pooling and normalisation are done by
+    `OnnxEncoder`. This is an offline step requiring torch and sentence-transformers.
+
+    Args:
+        model_name (str): The name of the SentenceTransformer model.
+        folder_path (str): The folder in which to save the model and tokenizer.
+        quantize (bool): Whether to also save the int8-quantized model.
+        opset (int): The ONNX opset version.
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(model_name, device="cpu")
+    transformer = model[0].auto_model.eval()
+    tokenizer = model.tokenizer
+
+    module_names = [type(module).__name__ for module in model]
+    pooling = model[1]
+    if not getattr(pooling, "pooling_mode_mean_tokens", False):
+        raise ValueError(f"Only models with mean pooling can be exported, not {module_names}")
+
+    os.makedirs(folder_path, exist_ok=True)
+
+    sample = tokenizer(["An example sentence to trace the model"], return_tensors="pt")
+    input_names = [name for name in ["input_ids", "attention_mask", "token_type_ids"] if name in sample]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["token_embeddings"] = {0: "batch", 1: "sequence"}
+
+    class TokenEmbeddings(torch.nn.Module):
+        def __init__(self, transformer):
+            super().__init__()
+            self.transformer = transformer
+
+        def forward(self, *inputs):
+            return self.transformer(**dict(zip(input_names, inputs)))[0]
+
+    with torch.no_grad():
+        torch.onnx.export(
+            TokenEmbeddings(transformer),
+            tuple(sample[name] for name in input_names),
+            os.path.join(folder_path, MODEL_FILE),
+            input_names=input_names,
+            output_names=["token_embeddings"],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset,
+        )
+
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+
+        quantize_dynamic(
+            os.path.join(folder_path, MODEL_FILE),
+            os.path.join(folder_path, QUANTIZED_MODEL_FILE),
+            weight_type=QuantType.QInt8,
+        )
+
+    tokenizer.backend_tokenizer.save(os.path.join(folder_path, TOKENIZER_FILE))
+    with open(os.path.join(folder_path, CONFIG_FILE), "w") as file:
+        json.dump({
+            "model_name": model_name,
+            "dimension": model.get_sentence_embedding_dimension(),
+            "max_seq_length": model.max_seq_length,
+            "pad_token": tokenizer.pad_token,
+            "pad_token_id": tokenizer.pad_token_id,
+            "normalize": "Normalize" in module_names,
+        }, file, indent=2)
+
+    print(f"Model {model_name} exported to {folder_path}")
+
+def check_parity(folder_path: str, quantized: bool = True, sentences: list = None, tolerance: float = 0.01) -> dict:
+    """
+    Compare the embeddings of the ONNX model with those of the PyTorch model.
+
+    Args:
+        folder_path (str): The folder of the exported model.
+        quantized (bool): Whether to check the int8 model rather than the float one.
+        sentences (list): The sentences to embed, PARITY_SENTENCES by default.
+        tolerance (float): The maximum tolerated cosine distance between two embeddings.
+
+    Returns:
+        dict: The minimum cosine similarity and maximum absolute difference of the embeddings.
+
+    Raises:
+        ValueError: If an embedding is further than `tolerance` from the PyTorch one.
+    """
+    from sentence_transformers import SentenceTransformer
+
+    sentences = sentences or PARITY_SENTENCES
+    encoder = OnnxEncoder(folder_path, quantized=quantized)
+    reference = SentenceTransformer(encoder.config["model_name"], device="cpu").encode(sentences, convert_to_numpy=True)
+    vectors = encoder.encode(sentences)
+
+    reference = reference / np.linalg.norm(reference, axis=1, keepdims=True)
+    similarities = np.sum(reference * (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)), axis=1)
+    report = {
+        "min_cosine_similarity": float(similarities.min()),
+        "max_abs_difference": float(np.abs(reference - vectors).max()),
+    }
+
+    if 1 - report["min_cosine_similarity"] > tolerance:
+        raise ValueError(f"The ONNX embeddings differ from the PyTorch ones beyond the tolerance of {tolerance}: {report}")
+    return report
+
+if __name__ == "__main__":
+    # Export the embedding model to ONNX and check the parity of both the float and int8 models
+    folder_path = os.environ.get("ONNX_MODEL_PATH", "onnx_model")
+    tolerance = float(os.environ.get("ONNX_PARITY_TOLERANCE", 0.01))
+    model_name = sys.argv[1] if len(sys.argv) > 1 else "all-MiniLM-L6-v2"
+
+    export_onnx(model_name, folder_path)
+    for quantized in (False, True):
+        report = check_parity(folder_path, quantized=quantized, tolerance=tolerance)
+        print(f"{'int8' if quantized else 'float32'} model parity: {report}")
@@ -0,0 +1,66 @@
+import io
+from concurrent.futures import ProcessPoolExecutor
+import PyPDF2
+
+# PDF reader of each worker process, opened once from the document bytes
+_worker_reader = None
+
+def _init_worker(data: bytes):
+    global _worker_reader
+    _worker_reader = PyPDF2.PdfReader(io.BytesIO(data))
+
+def _extract_pages(start: int, stop: int) -> list:
+    return [_worker_reader.pages[number].extract_text() for number in range(start, stop)]
+
+def iter_pdf_pages(file, processes: int = 0, min_pool_pages: int = 100, chunk_size: int = 8):
+    """
+    Extract the text of the pages of a PDF file lazily, in page order.
+
+    Pages are only extracted as they are consumed, so a caller can stop early.
+    Documents of at least `min_pool_pages` pages can be extracted by a pool of
+    `processes` worker processes, each working on chunks of `chunk_size` pages,
+    with at most one chunk per process extracted ahead of the consumer.
+
+    Args:
+        file: The PDF file, as a path or a binary file object.
+        processes (int): The number of extraction processes, 0 to extract in-process.
+        min_pool_pages (int): The minimum number of pages for using the process pool.
+        chunk_size (int): The number of pages extracted per task.
+
+    Yields:
+        str: The text of each page.
+    """
+    pdf_reader = PyPDF2.PdfReader(file)
+    number_of_pages = len(pdf_reader.pages)
+
+    if processes <= 0 or number_of_pages < min_pool_pages:
+        for page in pdf_reader.pages:
+            yield page.extract_text()
+        return
+
+    # Send the document to each worker once, rather than with every task
+    stream = pdf_reader.stream
+    stream.seek(0)
+    data = stream.read()
+
+    chunks = iter(range(0, number_of_pages, chunk_size))
+    executor = ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(data,))
+    in_flight = []
+    try:
+        for start in chunks:
+            in_flight.append(executor.submit(_extract_pages, start, min(start + chunk_size, number_of_pages)))
+            if len(in_flight) >= processes:
+                break
+
+        while in_flight:
+            pages = in_flight.pop(0).result()
+            start = next(chunks, None)
+            if start is not None:
+                in_flight.append(executor.submit(_extract_pages, start, min(start + chunk_size, number_of_pages)))
+            yield from pages
+    finally:
+        # Drop the chunks not consumed when the caller stops early (shutdown only
+        # cancels pending futures itself from Python 3.9)
+        for future in in_flight:
+            future.cancel()
+        executor.shutdown(wait=False)
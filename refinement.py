@@ -0,0 +1,119 @@
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of tokens of a text, at about 4 characters per token."""
+    return len(text) // 4 + 1
+
+def truncate_to_tokens(text: str, budget: int) -> str:
+    """Truncate a text to about `budget` tokens, at a word boundary."""
+    text = " ".join(text.split())
+    if estimate_tokens(text) <= budget:
+        return text
+    return text[:budget * 4].rsplit(" ", 1)[0] + " ..."
+
+def tag_diff(old_tags: list, new_tags: list) -> dict:
+    """
+    Compare two lists of tags.
+
+    Args:
+        old_tags (list): The tags before a change.
+        new_tags (list): The tags after the change.
+
+    Returns:
+        dict: The "added" and "removed" tags, in the order of their list.
+    """
+    return {
+        "added": [tag for tag in new_tags if tag not in old_tags],
+        "removed": [tag for tag in old_tags if tag not in new_tags],
+    }
+
+class RollingContext:
+    """
+    Bounded history of the turns of a refinement session.
+
+    The latest turns are kept verbatim, each as the user's comment and the resulting
+    tag diff. Older turns, and recent ones when they exceed the token budget, are
+    compacted into a summary of their comments and of the net tag changes, itself
+    bounded by dropping the oldest comments. The rendered context thus stays within
+    about `token_budget` tokens however long the session.
+    """
+
+    def __init__(self, token_budget: int = 1000, recent_turns: int = 4, comment_tokens: int = 40):
+        """
+        Args:
+            token_budget (int): The maximum number of tokens of the rendered context.
+            recent_turns (int): The maximum number of turns kept verbatim.
+            comment_tokens (int): The tokens kept from each comment in the summary.
+        """
+        self.token_budget = token_budget
+        self.recent_turns = recent_turns
+        self.comment_tokens = comment_tokens
+        self.turns = []
+        self.earlier_comments = []
+        self.net_added = []
+        self.net_removed = []
+        self.compacted_turns = 0
+
+    # Attributes holding the turns, saved by `to_dict`
+    STATE = ["turns", "earlier_comments", "net_added", "net_removed", "compacted_turns"]
+
+    def to_dict(self) -> dict:
+        """Return the turns of the context as a JSON-serialisable dictionary."""
+        return {name: getattr(self, name) for name in self.STATE}
+
+    def load_dict(self, state: dict):
+        """Restore the turns saved by `to_dict`."""
+        for name in self.STATE:
+            setattr(self, name, state[name])
+
+    @staticmethod
+    def render_turn(turn: dict) -> str:
+        changes = [f"+{tag}" for tag in turn["added"]] + [f"-{tag}" for tag in turn["removed"]]
+        return f"User: {turn['comment']}\nChanges: {', '.join(changes) or 'none'}"
+
+    def render_summary(self) -> str:
+        if not self.compacted_turns:
+            return ""
+        return (
+            f"Summary of {self.compacted_turns} earlier refinements. "
+            f"Requests: {' | '.join(self.earlier_comments) or 'omitted'}. "
+            f"Net changes: added {', '.join(self.net_added) or 'none'}; removed {', '.join(self.net_removed) or 'none'}."
+        )
+
+    def render(self) -> str:
+        """Return the context as text, the summary of the older turns first."""
+        parts = [self.render_summary()] + [self.render_turn(turn) for turn in self.turns]
+        return "\n\n".join(part for part in parts if part)
+
+    def _compact_oldest(self):
+        turn = self.turns.pop(0)
+        self.compacted_turns += 1
+        self.earlier_comments.append(truncate_to_tokens(turn["comment"], self.comment_tokens))
+
+        # A tag added then removed, or removed then added, is no net change
+        for tag in turn["added"]:
+            if tag in self.net_removed:
+                self.net_removed.remove(tag)
+            elif tag not in self.net_added:
+                self.net_added.append(tag)
+        for tag in turn["removed"]:
+            if tag in self.net_added:
+                self.net_added.remove(tag)
+            elif tag not in self.net_removed:
+                self.net_removed.append(tag)
+
+    def add(self, comment: str, diff: dict):
+        """
+        Record a turn and compact the context back within its budget.
+
+        Args:
+            comment (str): The comment of the user.
+            diff (dict): The "added" and "removed" tags of the turn, as returned by `tag_diff`.
+        """
+        comment = truncate_to_tokens(comment, self.token_budget // 2)
+        self.turns.append({"comment": comment, "added": list(diff["added"]), "removed": list(diff["removed"])})
+
+        while len(self.turns) > self.recent_turns or (len(self.turns) > 1 and estimate_tokens(self.render()) > self.token_budget):
+            self._compact_oldest()
+
+        # Drop the oldest comments of the summary, keeping its net changes
+        while self.earlier_comments and estimate_tokens(self.render()) > self.token_budget:
+            self.earlier_comments.pop(0)
@@ -0,0 +1,148 @@
+import numpy as np
+
+class Reranker:
+    """Base class for the local models scoring the relevance of descriptors to a document."""
+
+    def score(self, document: str, candidates: list) -> np.ndarray:
+        """
+        Score the relevance of candidate descriptors to a document.
+
+        Args:
+            document (str): The document, or its summary.
+            candidates (list): The (label, definition) pairs of the descriptors.
+
+        Returns:
+            np.ndarray: A relevance probability between 0 and 1 per candidate.
+        """
+        raise NotImplementedError
+
+def descriptor_text(label: str, definition: str) -> str:
+    """Return the text describing a descriptor, as embedded in the knowledge base."""
+    return f"{label}: {definition}" if definition else label
+
+class CrossEncoderReranker(Reranker):
+    """
+    Scores (document, descriptor) pairs in batches with a small cross-encoder running on CPU.
+
+    Models such as ms-marco-MiniLM-L-6-v2 are configured to return raw logits, so a
+    sigmoid is set explicitly as the activation of their single output, making the
+    scores relevance probabilities comparable to the thresholds.
+    """
+
+    def __init__(self, model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2", batch_size: int = 32):
+        import torch
+        from sentence_transformers import CrossEncoder
+
+        self.model = CrossEncoder(model_name, device="cpu", default_activation_function=torch.nn.Sigmoid())
+        self.batch_size = batch_size
+
+    def score(self, document: str, candidates: list) -> np.ndarray:
+        if not candidates:
+            return np.empty(0, dtype=np.float32)
+
+        pairs = [(document, descriptor_text(label, definition)) for label, definition in candidates]
+        return np.asarray(self.model.predict(pairs, batch_size=self.batch_size, show_progress_bar=False), dtype=np.float32)
+
+def pair_features(document_vector: np.ndarray, candidate_vectors: np.ndarray) -> np.ndarray:
+    """
+    Build the features of (document, descriptor) pairs from their embeddings.
+
+    Args:
+        document_vector (np.ndarray): The embedding of the document.
+        candidate_vectors (np.ndarray): The embeddings of the descriptors, one row each.
+
+    Returns:
+        np.ndarray: The element-wise product, absolute difference and cosine similarity of each pair.
+    """
+    document_vector = document_vector / (np.linalg.norm(document_vector) or 1)
+    norms = np.linalg.norm(candidate_vectors, axis=1, keepdims=True)
+    candidate_vectors = candidate_vectors / np.where(norms == 0, 1, norms)
+
+    return np.hstack([
+        candidate_vectors * document_vector,
+        np.abs(candidate_vectors - document_vector),
+        (candidate_vectors @ document_vector)[:, np.newaxis],
+    ])
+
+class LinearHeadReranker(Reranker):
+    """
+    Logistic regression trained on the MiniLM embeddings of the document and descriptors.
+
+    It reuses the encoder (and its embedding cache) of the retrieval stage, so scoring
+    costs one encoding of the document on top of a dot product per candidate.
+    """
+
+    def __init__(self, encoder, weights_path: str):
+        weights = np.load(weights_path)
+        self.encoder = encoder
+        self.coefficients = weights["coefficients"]
+        self.intercept = float(weights["intercept"])
+
+    def score(self, document: str, candidates: list) -> np.ndarray:
+        if not candidates:
+            return np.empty(0, dtype=np.float32)
+
+        vectors = self.encoder.encode([document] + [descriptor_text(label, definition) for label, definition in candidates])
+        logits = pair_features(vectors[0], vectors[1:]) @ self.coefficients + self.intercept
+        return (1 / (1 + np.exp(-logits))).astype(np.float32)
+
+def train_linear_head(encoder, examples: list, weights_path: str):
+    """
+    Train the logistic regression of a `LinearHeadReranker`.
+
+    Args:
+        encoder: The encoder used for the embeddings.
+        examples (list): (document, label, definition, relevant) tuples, where relevant
+            is 1 for descriptors of the ground truth and 0 for other candidates.
+        weights_path (str): The .npz file in which the weights are saved.
+    """
+    from sklearn.linear_model import LogisticRegression
+
+    documents = sorted({document for document, _, _, _ in examples})
+    document_vectors = dict(zip(documents, encoder.encode(documents)))
+    candidate_vectors = encoder.encode([descriptor_text(label, definition) for _, label, definition, _ in examples])
+
+    features = np.vstack([
+        pair_features(document_vectors[document], candidate_vector[np.newaxis, :])
+        for (document, _, _, _), candidate_vector in zip(examples, candidate_vectors)
+    ])
+    targets = np.array([relevant for _, _, _, relevant in examples])
+
+    classifier = LogisticRegression(max_iter=1000, class_weight="balanced").fit(features, targets)
+    np.savez(weights_path, coefficients=classifier.coef_[0].astype(np.float32), intercept=classifier.intercept_[0])
+
+def select_candidates(candidates: list, scores: np.ndarray, threshold: float, top_k: int) -> list:
+    """
+    Keep the best scored candidates.
+
+    Args:
+        candidates (list): The labels of the candidates.
+        scores (np.ndarray): The score of each candidate.
+        threshold (float): The minimum score of a selected candidate.
+        top_k (int): The maximum number of selected candidates.
+
+    Returns:
+        list: The selected labels, best scored first.
+    """
+    order = np.argsort(-scores, kind="stable")
+    return [candidates[i] for i in order if scores[i] >= threshold][:top_k]
+
+def split_ambiguous(candidates: list, scores: np.ndarray, low: float, high: float) -> tuple:
+    """
+    Split candidates into accepted and ambiguous ones.
+
+    Args:
+        candidates (list): The labels of the candidates.
+        scores (np.ndarray): The score of each candidate.
+        low (float): The score below which candidates are rejected.
+        high (float): The score from which candidates are accepted.
+
+    Returns:
+        tuple: A tuple containing:
+            - list: The accepted labels, best scored first
+            - list: The labels scored between `low` and `high`, best scored first
+    """
+    order = np.argsort(-scores, kind="stable")
+    accepted = [candidates[i] for i in order if scores[i] >= high]
+    ambiguous = [candidates[i] for i in order if low <= scores[i] < high]
+    return accepted, ambiguous
@@ -0,0 +1,107 @@
+import os
+import threading
+
+# Loaders of the shared resources, and the resources loaded so far. They live in
+# their own module so that they survive the re-execution of the Streamlit script.
+_loaders = {}
+_resources = {}
+_lock = threading.RLock()
+# Resources that cannot be inherited by a forked process, reloaded by the children
+_fork_unsafe = set()
+
+def register(name: str, loader, fork_safe: bool = True):
+    """
+    Register the loader of a resource, unless one is already registered under this name.
+
+    Args:
+        name (str): The name of the resource.
+        loader: A function without arguments returning the resource.
+        fork_safe (bool): Whether a forked process can keep using the resource, after
+            calling its `after_fork` method if it has one. Other resources are reloaded.
+    """
+    with _lock:
+        _loaders.setdefault(name, loader)
+        if not fork_safe:
+            _fork_unsafe.add(name)
+
+def override(name: str, resource):
+    """
+    Replace a resource with the given instance, e.g. a stub in a benchmark.
+
+    Args:
+        name (str): The name of the resource.
+        resource: The instance to use from now on.
+    """
+    with _lock:
+        _resources[name] = resource
+
+def get(name: str):
+    """
+    Return a resource, loading it on first use.
+
+    Args:
+        name (str): The name of the resource.
+
+    Returns:
+        The loaded resource.
+    """
+    try:
+        return _resources[name]
+    except KeyError:
+        pass
+
+    with _lock:
+        if name not in _resources:
+            _resources[name] = _loaders[name]()
+        return _resources[name]
+
+def is_loaded(name: str) -> bool:
+    """Return whether a resource has already been loaded."""
+    return name in _resources
+
+def after_fork():
+    """
+    Prepare the resources inherited from the parent process for use in a forked child.
+
+    Resources with an `after_fork` method reopen what cannot be shared across processes,
+    such as SQLite connections or thread pools, and fork-unsafe ones are dropped to be
+    reloaded on first use. The memory of the others stays shared with the parent.
+    """
+    with _lock:
+        for name in list(_resources):
+            if name in _fork_unsafe:
+                del _resources[name]
+            elif hasattr(_resources[name], "after_fork"):
+                _resources[name].after_fork()
+
+def warm_up(*names):
+    """
+    Load resources ahead of their first use.
+
+    Args:
+        names (str): The names of the resources to load, all the registered ones by default.
+    """
+    for name in names or list(_loaders):
+        get(name)
+
+def load_model():
+    """
+    Load the SentenceTransformer model used for text embeddings, behind the embedding cache.
+
+    ENCODER_BACKEND selects PyTorch ("pytorch") or ONNX Runtime ("onnx"), the latter running
+    the model exported to ONNX_MODEL_PATH, int8-quantized unless ONNX_QUANTIZED is 0.
+
+    Returns:
+        CachedEncoder: The model wrapped with the embedding cache.
+    """
+    from embedding_cache import load_encoder
+
+    return load_encoder(
+        'all-MiniLM-L6-v2',
+        os.environ.get("EMBEDDING_CACHE_PATH", ".cache/embeddings.sqlite"),
+        backend=os.environ.get("ENCODER_BACKEND", "pytorch"),
+        onnx_path=os.environ.get("ONNX_MODEL_PATH", "onnx_model"),
+        quantized=os.environ.get("ONNX_QUANTIZED", "1") != "0",
+    )
+
+register("model", load_model)
@@ -0,0 +1,118 @@
+# Methods aggregating the scores of a candidate retrieved by several queries
+FUSION_METHODS = ("max", "sum", "rrf")
+
+def chunk_text(text: str, chunk_size: int = 100, overlap: int = 20, max_chunks: int = 16) -> list:
+    """
+    Split a text into overlapping chunks of words, to be encoded as search queries.
+
+    Args:
+        text (str): The text to split.
+        chunk_size (int): The number of words per chunk.
+        overlap (int): The number of words shared by consecutive chunks.
+        max_chunks (int): The maximum number of chunks, taken from the start of the text.
+
+    Returns:
+        list: The chunks, in the order of the text.
+    """
+    words = text.split()
+    if not words:
+        return []
+
+    step = max(chunk_size - overlap, 1)
+    chunks = []
+    for start in range(0, len(words), step):
+        chunks.append(" ".join(words[start:start + chunk_size]))
+        if start + chunk_size >= len(words) or len(chunks) >= max_chunks:
+            break
+    return chunks
+
+def reciprocal_rank_fusion(rankings: list, k: int = 60) -> list:
+    """
+    Merge rankings with reciprocal rank fusion: each item scores the sum of
+    1 / (k + rank) over the rankings it appears in, its rank starting at 1.
+
+    Args:
+        rankings (list): The rankings to merge, each a list of items, best first.
+        k (int): The constant damping the weight of the top ranks.
+
+    Returns:
+        list: The unique items, best fused score first, ties broken by item so
+        that the order is deterministic.
+    """
+    scores = {}
+    for ranking in rankings:
+        seen = set()
+        for rank, item in enumerate(ranking, start=1):
+            # An item repeated within a ranking only counts at its best rank
+            if item in seen:
+                continue
+            seen.add(item)
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank)
+
+    return sorted(scores, key=lambda item: (-scores[item], item))
+
+def fuse_candidates(results: list, method: str = "max", rrf_k: int = 60) -> list:
+    """
+    Aggregate the descriptors retrieved by several queries into scored candidates.
+
+    Args:
+        results (list): (source, pairs) tuples, where source describes the query (e.g.
+            "tag:energy policy" or "chunk:2") and pairs are its (label, score) results, best first.
+        method (str): "max" scores each candidate with its best score, "sum" with the sum
+            of its scores, rewarding descriptors found by several queries, and "rrf" by
+            reciprocal rank fusion, ignoring the scores.
+        rrf_k (int): The constant of the reciprocal rank fusion.
+
+    Returns:
+        list: The candidates as dictionaries with their "label", fused "score" and the
+        "sources" that retrieved them, best score first, ties broken by label so that
+        the order is deterministic.
+    """
+    if method not in FUSION_METHODS:
+        raise ValueError(f"Unknown fusion method: {method}")
+
+    candidates = {}
+    for source, pairs in results:
+        seen = set()
+        for rank, (label, score) in enumerate(pairs, start=1):
+            # A label repeated within the results of a query only counts at its best rank
+            if label in seen:
+                continue
+            seen.add(label)
+
+            if method == "rrf":
+                score = 1.0 / (rrf_k + rank)
+            candidate = candidates.setdefault(label, {"label": label, "score": None, "sources": []})
+            candidate["sources"].append(source)
+            if candidate["score"] is None:
+                candidate["score"] = float(score)
+            elif method == "max":
+                candidate["score"] = max(candidate["score"], float(score))
+            else:
+                candidate["score"] += float(score)
+
+    return sorted(candidates.values(), key=lambda candidate: (-candidate["score"], candidate["label"]))
+
+def budget_candidates(labels: list, token_budget: int, estimate_tokens) -> list:
+    """
+    Keep the first candidates whose list fits in a token budget.
+
+    Args:
+        labels (list): The candidate labels, best first.
+        token_budget (int): The maximum number of tokens of the list, 0 for no limit.
+        estimate_tokens: The function estimating the number of tokens of a text.
+
+    Returns:
+        list: The longest prefix of the labels within the budget.
+    """
+    if token_budget <= 0:
+        return list(labels)
+
+    kept, tokens = [], 0
+    for label in labels:
+        # One line per candidate in the prompt
+        tokens += estimate_tokens(f"- {label}\n")
+        if tokens > token_budget:
+            break
+        kept.append(label)
+    return kept
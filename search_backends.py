@@ -0,0 +1,267 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from azure.search.documents import SearchClient
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
+from azure.search.documents.models import RawVectorQuery
+from instrumentation import to_thread
+from knowledge_base import load_knowledge_base, load_quantized_vectors, quantize_binary, version_path
+
+def labels_of(results: list) -> list:
+    """Drop the scores of lists of (label, score) pairs."""
+    return [[label for label, _ in pairs] for pairs in results]
+
+class SearchBackend:
+    """
+    Base class for the backends used to retrieve EuroVoc descriptors from a query vector.
+
+    Backends implement `search_scored`, or `search_batch_scored` to search several
+    queries at once; the methods returning labels only are derived from them.
+    """
+
+    def search_scored(self, vector, k: int = 10) -> list:
+        """
+        Return the descriptors closest to the query vector, with their similarity scores.
+
+        Args:
+            vector: The embedding of the query.
+            k (int): The number of descriptors to return.
+
+        Returns:
+            list: The (label, score) pairs of the top k descriptors, most similar first.
+        """
+        return self.search_batch_scored([vector], k=k)[0]
+
+    def search_batch_scored(self, vectors, k: int = 10) -> list:
+        """
+        Return the descriptors closest to each query vector, with their similarity scores.
+
+        Args:
+            vectors: The embeddings of the queries, one row per query.
+            k (int): The number of descriptors to return per query.
+
+        Returns:
+            list: One list of (label, score) pairs per query, in the order of the queries.
+        """
+        return [self.search_scored(vector, k=k) for vector in vectors]
+
+    async def asearch_batch_scored(self, vectors, k: int = 10) -> list:
+        """
+        Asynchronous version of `search_batch_scored`, run in a worker thread by default.
+
+        Args:
+            vectors: The embeddings of the queries, one row per query.
+            k (int): The number of descriptors to return per query.
+
+        Returns:
+            list: One list of (label, score) pairs per query, in the order of the queries.
+        """
+        return await to_thread(self.search_batch_scored, vectors, k)
+
+    def search(self, vector, k: int = 10) -> list:
+        """
+        Return the labels of the descriptors closest to the query vector.
+
+        Args:
+            vector: The embedding of the query.
+            k (int): The number of descriptors to return.
+
+        Returns:
+            list: The labels of the top k descriptors, most similar first.
+        """
+        return [label for label, _ in self.search_scored(vector, k=k)]
+
+    def search_batch(self, vectors, k: int = 10) -> list:
+        """
+        Return the labels of the descriptors closest to each query vector.
+
+        Args:
+            vectors: The embeddings of the queries, one row per query.
+            k (int): The number of descriptors to return per query.
+
+        Returns:
+            list: One list of labels per query, in the order of the queries.
+        """
+        return labels_of(self.search_batch_scored(vectors, k=k))
+
+    async def asearch_batch(self, vectors, k: int = 10) -> list:
+        """
+        Asynchronous version of `search_batch`.
+
+        Args:
+            vectors: The embeddings of the queries, one row per query.
+            k (int): The number of descriptors to return per query.
+
+        Returns:
+            list: One list of labels per query, in the order of the queries.
+        """
+        return labels_of(await self.asearch_batch_scored(vectors, k=k))
+
+class AzureSearchBackend(SearchBackend):
+    """
+    Vector search on an Azure AI Search index.
+
+    A request with several vector queries returns a single fused ranking, so batches
+    are sent as one request per query, issued concurrently by at most `max_workers`
+    threads, or coroutines for `asearch_batch`.
+    """
+
+    def __init__(self, endpoint: str, index_name: str, credential, vector_field: str = "Label_def_vector", max_workers: int = 8):
+        self.endpoint = endpoint
+        self.index_name = index_name
+        self.credential = credential
+        self.search_client = SearchClient(endpoint=endpoint, index_name=index_name, credential=credential)
+        self.vector_field = vector_field
+        self.max_workers = max_workers
+
+    def after_fork(self):
+        """Create a client of the forked process, rather than sharing the pooled connections of the parent."""
+        self.search_client = SearchClient(endpoint=self.endpoint, index_name=self.index_name, credential=self.credential)
+
+    def vector_query(self, vector, k: int) -> RawVectorQuery:
+        """Build the vector query of an embedding."""
+        return RawVectorQuery(vector=np.asarray(vector).tolist(), k=k, fields=self.vector_field)
+
+    def search_scored(self, vector, k: int = 10) -> list:
+        search_results = self.search_client.search(
+            search_text=None,
+            vector_queries=[self.vector_query(vector, k)],
+            top=k,
+        )
+
+        tags = []
+        for item in search_results:
+            tags.append((item["Label"], item["@search.score"]))
+            if len(tags) >= k:
+                break # Limit to the top k tags
+        return tags
+
+    def search_batch_scored(self, vectors, k: int = 10) -> list:
+        if len(vectors) <= 1:
+            return super().search_batch_scored(vectors, k=k)
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(vectors))) as executor:
+            return list(executor.map(lambda vector: self.search_scored(vector, k=k), vectors))
+
+    async def asearch_batch_scored(self, vectors, k: int = 10) -> list:
+        semaphore = asyncio.Semaphore(self.max_workers)
+
+        async with AsyncSearchClient(endpoint=self.endpoint, index_name=self.index_name, credential=self.credential) as search_client:
+
+            async def search(vector):
+                async with semaphore:
+                    search_results = await search_client.search(
+                        search_text=None,
+                        vector_queries=[self.vector_query(vector, k)],
+                        top=k,
+                    )
+
+                    tags = []
+                    async for item in search_results:
+                        tags.append((item["Label"], item["@search.score"]))
+                        if len(tags) >= k:
+                            break # Limit to the top k tags
+                    return tags
+
+            return list(await asyncio.gather(*(search(vector) for vector in vectors)))
+
+# Number of set bits of each byte value, to compute Hamming distances between binary codes
+POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Return the indices of the k highest scores of each row, highest first.
+
+    Args:
+        scores (np.ndarray): The scores, one row per query.
+        k (int): The number of indices per row, at most the number of columns.
+
+    Returns:
+        np.ndarray: The indices, one row per query.
+    """
+    # Select the top k of each row in linear time, then sort only those
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    return np.take_along_axis(top, np.argsort(-top_scores, axis=1), axis=1)
+
+class LocalSearchBackend(SearchBackend):
+    """
+    Vector search on a knowledge base saved by `indexation.py`.
+
+    The embeddings are memory-mapped and ranked by dot product with the
+    normalised query, which is the cosine similarity used by the Azure index.
+
+    With int8 or binary quantization, only the quantized codes are loaded in memory.
+    They rank every descriptor approximately, and the `rescore_candidates` best ones
+    are then rescored exactly with their float vectors, read from the memory map.
+    Binary codes are coarser, so more candidates are rescored by default.
+    """
+
+    # Default number of candidates rescored for each type of quantization
+    RESCORE_CANDIDATES = {"int8": 100, "binary": 1000}
+
+    def __init__(self, folder_path: str, quantization: str = "none", rescore_candidates: int = None, block_size: int = 4096):
+        # Read every file from the same version of the knowledge base
+        folder_path = version_path(folder_path)
+        self.vectors, metadata = load_knowledge_base(folder_path, columns=["Label"])
+        self.labels = metadata.column("Label").to_pylist()
+
+        self.quantization = quantization
+        self.rescore_candidates = rescore_candidates or self.RESCORE_CANDIDATES.get(quantization, 0)
+        self.block_size = block_size
+        if quantization != "none":
+            self.codes, self.scale = load_quantized_vectors(folder_path, quantization)
+
+    def approximate_scores(self, queries: np.ndarray) -> np.ndarray:
+        """
+        Score every descriptor against the queries with the quantized codes.
+
+        Args:
+            queries (np.ndarray): The normalised queries, one row per query.
+
+        Returns:
+            np.ndarray: The approximate scores, one row per query.
+        """
+        scores = np.empty((len(queries), len(self.codes)), dtype=np.float32)
+
+        if self.quantization == "int8":
+            # Fold the scale of each dimension into the queries
+            scaled_queries = queries * self.scale
+            for start in range(0, len(self.codes), self.block_size):
+                block = self.codes[start:start + self.block_size].astype(np.float32)
+                scores[:, start:start + self.block_size] = scaled_queries @ block.T
+        else:
+            # Rank by the opposite of the Hamming distance between binary codes
+            query_codes = quantize_binary(queries)
+            for row, query_code in enumerate(query_codes):
+                scores[row] = -POPCOUNT[np.bitwise_xor(self.codes, query_code)].sum(axis=1, dtype=np.int32)
+
+        return scores
+
+    def search_batch_scored(self, vectors, k: int = 10) -> list:
+        queries = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries = queries / np.where(norms == 0, 1, norms)
+
+        k = min(k, len(self.labels))
+        if k <= 0:
+            return [[] for _ in range(len(queries))]
+
+        if self.quantization == "none":
+            # One matrix multiply scores every query against every descriptor
+            scores = queries @ self.vectors.T
+            top = top_k_indices(scores, k)
+            top_scores = np.take_along_axis(scores, top, axis=1)
+        else:
+            candidates = top_k_indices(self.approximate_scores(queries), max(k, min(self.rescore_candidates, len(self.labels))))
+
+            # Rescore the candidates with their float vectors
+            exact_scores = np.einsum("bd,bcd->bc", queries, np.asarray(self.vectors[candidates], dtype=np.float32))
+            best = top_k_indices(exact_scores, k)
+            top = np.take_along_axis(candidates, best, axis=1)
+            top_scores = np.take_along_axis(exact_scores, best, axis=1)
+
+        return [
+            [(self.labels[i], float(score)) for i, score in zip(row, row_scores)]
+            for row, row_scores in zip(top, top_scores)
+        ]
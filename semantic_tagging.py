@@ -1,18 +1,26 @@
 import os
 import re
-import json
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import streamlit as st
 from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
-from azure.search.documents.models import RawVectorQuery
-import PyPDF2
 import re
-from sentence_transformers import SentenceTransformer
-from openai import AzureOpenAI
+from openai import AzureOpenAI, AsyncAzureOpenAI
+import resources
+import instrumentation
+from instrumentation import span, annotate, record_usage, to_thread
+from pdf_extraction import iter_pdf_pages
+from retrieval import FUSION_METHODS, chunk_text, reciprocal_rank_fusion, fuse_candidates, budget_candidates
+from search_backends import labels_of
+from refinement import RollingContext, estimate_tokens, tag_diff, truncate_to_tokens
+from vocabulary import load_vocabulary, resolve_tags
 
 # Load environment variables from a .env file
 load_dotenv(override=True)
+# Export the timings of the pipeline stages to the sinks of INSTRUMENTATION_SINKS
+instrumentation.configure()
 search_endpoint = os.environ.get("SEACRH_ENDPOINT")
 index_name = os.environ.get("INDEX_NAME")
 api_key = os.environ.get("API_KEY")
@@ -22,12 +30,167 @@ azure_openai_api_endpoint = os.environ.get("AZURE_OPENAI_ENDPOINT")
 deployment_name = os.environ.get("DEPLOYMENT_NAME")
 api_version = os.environ.get("API_VERSION")
 
-# Initialise Azure Key Credential and Search Client
-credential = AzureKeyCredential(api_key)
-search_client = SearchClient(endpoint=search_endpoint, index_name=index_name, credential=credential)
+# Search backend used to map tags to EuroVoc descriptors: "azure" or "local"
+search_backend_name = os.environ.get("SEARCH_BACKEND", "azure")
+local_index_path = os.environ.get("LOCAL_INDEX_PATH", "eurovoc_index")
+# Maximum number of concurrent requests to the search service
+search_concurrency = int(os.environ.get("SEARCH_CONCURRENCY", 8))
+
+# Maximum length of the text sent to GPT to generate a summary, and number of
+# pages of a PDF searched for an abstract or executive summary
+SUMMARY_MAX_LENGTH = 3000 * 4
+SUMMARY_SEARCH_PAGES = int(os.environ.get("SUMMARY_SEARCH_PAGES", 20))
+# Number of processes extracting the pages of large PDFs (0 extracts in-process)
+pdf_processes = int(os.environ.get("PDF_PROCESSES", 0))
+
+# Stage filtering the candidate descriptors: "llm", or a local "cross-encoder" or "linear" reranker
+reranker_name = os.environ.get("RERANKER", "llm")
+# With a local reranker, "local" keeps the RERANK_TOP_K candidates scored above RERANK_THRESHOLD,
+# while "escalate" keeps those scored above RERANK_HIGH and lets the LLM filter those
+# scored between RERANK_LOW and RERANK_HIGH
+rerank_mode = os.environ.get("RERANK_MODE", "local")
+rerank_threshold = float(os.environ.get("RERANK_THRESHOLD", 0.5))
+rerank_low = float(os.environ.get("RERANK_LOW", 0.2))
+rerank_high = float(os.environ.get("RERANK_HIGH", 0.8))
+rerank_top_k = int(os.environ.get("RERANK_TOP_K", 10))
+
+# Candidate descriptors are also retrieved from at most DOCUMENT_CHUNKS chunks of
+# CHUNK_SIZE words of the document (0 disables it), concurrently with the LLM
+# proposing tags, and fused with the search results of these tags
+document_chunks = int(os.environ.get("DOCUMENT_CHUNKS", 16))
+chunk_size = int(os.environ.get("CHUNK_SIZE", 100))
+chunk_overlap = int(os.environ.get("CHUNK_OVERLAP", 20))
+# Aggregation of the candidates retrieved by several queries: "max" or "sum" of their
+# similarity scores, or "rrf" for reciprocal rank fusion with the constant RRF_K
+candidate_fusion = os.environ.get("CANDIDATE_FUSION", "max")
+if candidate_fusion not in FUSION_METHODS:
+    raise ValueError(f"CANDIDATE_FUSION must be one of {', '.join(FUSION_METHODS)}, not {candidate_fusion!r}")
+rrf_k = int(os.environ.get("RRF_K", 60))
+# Maximum number of fused candidates sent to the filter stage, and maximum number of
+# tokens of their list in the filter prompt (0 keeps them all)
+max_candidates = int(os.environ.get("MAX_CANDIDATES", 50))
+filter_token_budget = int(os.environ.get("FILTER_TOKEN_BUDGET", 400))
+
+# Token budgets of the document excerpt and of the rolling context of the previous
+# turns sent with each refinement, turns kept verbatim in this context, and number
+# of retrieved descriptors suggested to the LLM
+refine_document_tokens = int(os.environ.get("REFINE_DOCUMENT_TOKENS", 1500))
+refine_context_tokens = int(os.environ.get("REFINE_CONTEXT_TOKENS", 800))
+refine_recent_turns = int(os.environ.get("REFINE_RECENT_TURNS", 4))
+refine_candidates = int(os.environ.get("REFINE_CANDIDATES", 20))
+
+# Versions of the prompt templates, part of the key of cached LLM responses:
+# bump a version when its prompt or the parsing of its response changes
+PROMPT_TEMPLATE_VERSIONS = {
+    "tags": "1",
+    "filter": "2",
+    "refine": "1",
+}
+
+def pipeline_config():
+    """
+    Return the settings that change the predictions of `predict_tags`, e.g. to tell
+    apart the results of evaluations run with different configurations.
+
+    Returns:
+        dict: The JSON-serialisable settings of the models, prompts, retrieval and filter stage.
+    """
+    return {
+        "deployment_name": deployment_name,
+        "prompt_template_versions": PROMPT_TEMPLATE_VERSIONS,
+        "encoder_backend": os.environ.get("ENCODER_BACKEND", "pytorch"),
+        "onnx_quantized": os.environ.get("ONNX_QUANTIZED", "1"),
+        "search_backend": search_backend_name,
+        "index": local_index_path if search_backend_name == "local" else index_name,
+        "quantization": os.environ.get("LOCAL_INDEX_QUANTIZATION", "none"),
+        "rescore_candidates": os.environ.get("RESCORE_CANDIDATES", ""),
+        "document_chunks": [document_chunks, chunk_size, chunk_overlap],
+        "candidate_fusion": [candidate_fusion, rrf_k, max_candidates, filter_token_budget],
+        "reranker": [reranker_name, rerank_mode, rerank_threshold, rerank_low, rerank_high, rerank_top_k],
+    }
+
+def load_search_backend():
+    """
+    Initialise the configured search backend.
+
+    Returns:
+        SearchBackend: The local or Azure AI Search backend.
+    """
+    from search_backends import AzureSearchBackend, LocalSearchBackend
+
+    if search_backend_name == "local":
+        return LocalSearchBackend(
+            local_index_path,
+            quantization=os.environ.get("LOCAL_INDEX_QUANTIZATION", "none"),
+            rescore_candidates=int(os.environ.get("RESCORE_CANDIDATES", 0)) or None,
+        )
+
+    # Initialise Azure Key Credential and Search Client
+    credential = AzureKeyCredential(api_key)
+    return AzureSearchBackend(search_endpoint, index_name, credential, max_workers=search_concurrency)
+
+def load_openai_client():
+    """Initialise Azure OpenAI client for GPT-4."""
+    return AzureOpenAI(api_key=azure_openai_api_key, azure_endpoint=azure_openai_api_endpoint, api_version=api_version)
+
+def load_llm_cache():
+    """
+    Initialise the cache of deterministic LLM responses.
+
+    Returns:
+        ResponseCache: The cache, or None if LLM_CACHE_PATH is empty.
+    """
+    from llm_cache import ResponseCache
+
+    path = os.environ.get("LLM_CACHE_PATH", ".cache/llm_responses.sqlite")
+    if not path:
+        return None
+
+    return ResponseCache(
+        path,
+        ttl=float(os.environ.get("LLM_CACHE_TTL_DAYS", 30)) * 24 * 3600,
+        max_entries=int(os.environ.get("LLM_CACHE_MAX_ENTRIES", 100000)),
+    )
+
+def load_reranker():
+    """
+    Load the configured local reranker.
+
+    Returns:
+        Reranker: The local reranker, or None if candidates are filtered by the LLM only.
+    """
+    if reranker_name == "cross-encoder":
+        from reranker import CrossEncoderReranker
+        return CrossEncoderReranker(os.environ.get("CROSS_ENCODER_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2"))
+
+    if reranker_name == "linear":
+        from reranker import LinearHeadReranker
+        return LinearHeadReranker(resources.get("model"), os.environ.get("LINEAR_HEAD_PATH", "reranker_linear_head.npz"))
+
+    return None
+
+def load_eurovoc():
+    """
+    Load the compiled EuroVoc vocabulary used to validate and resolve tags.
+
+    The vocabulary is compiled from EuroVoc.json and the non-descriptors on first use.
+    """
+    return load_vocabulary(
+        os.environ.get("VOCABULARY_PATH", "eurovoc_vocabulary"),
+        non_descriptors_path=os.environ.get("NON_DESCRIPTORS_PATH", "EuroVoc_UF.json"),
+    )
+
+# Resources are loaded on first use, and shared by every rerun of the Streamlit script
+resources.register("search_backend", load_search_backend)
+resources.register("openai_client", load_openai_client, fork_safe=False)
+resources.register("llm_cache", load_llm_cache)
+resources.register("eurovoc", load_eurovoc)
+resources.register("reranker", load_reranker)
 
-# Load the pre-trained SentenceTransformer model for text embeddings
-model = SentenceTransformer('all-MiniLM-L6-v2')
+@st.cache_resource
+def warm_up_resources():
+    """Load the model, clients and vocabulary once per Streamlit server, before the first request."""
+    resources.warm_up()
 
 def generate_summary_with_gpt(text):
     """
@@ -41,7 +204,7 @@ def generate_summary_with_gpt(text):
     """
     text = re.sub(r'\s+', ' ', text).strip() # Clean up whitespace
 
-    max_length = 3000 * 4  # Set maximum length for the text
+    max_length = SUMMARY_MAX_LENGTH  # Set maximum length for the text
 
     # Truncate text if it exceeds the maximum length
     if len(text) > max_length:
@@ -56,15 +219,17 @@ def generate_summary_with_gpt(text):
     )
 
     # Generate completion using GPT model
-    response = client.chat.completions.create(
-        model = deployment_name,
-        messages = [
-            {"role": "system", "content": "You are a helpful assistant that summarizes texts"},
-            {"role": "user", "content": prompt}
-        ],
-        max_tokens=150,
-        temperature=0.7
-    )
+    with span("llm.summary", characters=len(text)):
+        response = resources.get("openai_client").chat.completions.create(
+            model = deployment_name,
+            messages = [
+                {"role": "system", "content": "You are a helpful assistant that summarizes texts"},
+                {"role": "user", "content": prompt}
+            ],
+            max_tokens=150,
+            temperature=0.7
+        )
+        record_usage(response)
 
     return response.choices[0].message.content.strip()
 
@@ -72,35 +237,49 @@ def read_pdf(file):
     """
     Extract text from a PDF file.
 
+    Pages are extracted lazily and the extraction stops as soon as the abstract or
+    executive summary is located. Without a summary, it stops once the pages likely
+    to contain one were searched and enough text was collected to generate one.
+
     Args:
         file: The PDF file to extract text from.
 
     Returns:
         str: The extracted summary or generated summary if no summary found.
     """
-    pdf_reader = PyPDF2.PdfReader(file)
-    
     count = 0
-    only_abstract = []
+    only_abstract = False
 
     summary = ""
     text = []
+    length = 0
 
     # Iterate through each page in the PDF
-    for page in pdf_reader.pages:
-        page_content = page.extract_text()
-        text.append(page_content)
-
-        # Check for executive summary or abstract
-        if "executive summary" in page_content.lower() or "abstract" in page_content.lower():
-            if count > 0:
-                summary = page_content
-                if "executive summary" in page_content.lower() or only_abstract:
-                    break # Stop collecting if we find a second summary
-            if "executive summary" not in page_content.lower() and "abstract" in page_content.lower():
-                only_abstract = True
-            
-            count += 1
+    with span("pdf_extraction") as extraction:
+        for page_number, page_content in enumerate(iter_pdf_pages(file, processes=pdf_processes)):
+            extraction.set(pages=page_number + 1)
+
+            # Only keep the text that can be sent to GPT to generate a summary
+            if length < SUMMARY_MAX_LENGTH:
+                text.append(page_content)
+                length += len(" ".join(page_content.split()))
+
+            # Check for executive summary or abstract
+            if "executive summary" in page_content.lower() or "abstract" in page_content.lower():
+                if count > 0:
+                    summary = page_content
+                    if "executive summary" in page_content.lower() or only_abstract:
+                        break # Stop collecting if we find a second summary
+                if "executive summary" not in page_content.lower() and "abstract" in page_content.lower():
+                    only_abstract = True
+
+                count += 1
+
+            # Stop once the first pages were searched and a summary or enough text was found
+            if page_number + 1 >= SUMMARY_SEARCH_PAGES and (summary or length >= SUMMARY_MAX_LENGTH):
+                break
+
+        extraction.set(summary_found=bool(summary))
 
     # If no summary is found, generate one using GPT
     if summary == "": 
@@ -111,210 +290,626 @@ def read_pdf(file):
 
 def perform_search(query):
     """
-    Perform semantic search on the Azure index and return relevant tags.
+    Perform semantic search on the configured search backend and return relevant tags.
 
     Args:
         query (str): The search query as a string
 
     Returns:
-        list: A list of the top 10 relevant tags or an empty list if an error occurs.
-    """
-    try: 
-        vector_query = RawVectorQuery(vector=model.encode(query).tolist(), k=10, fields="Label_def_vector")
-        
-        search_results = search_client.search(
-            search_text=None, 
-            vector_queries=[vector_query],
-            top=10,
-             
-        )
-        
-        tags = []
-        for item in search_results:
-            # Assuming that the search result has the field Label
-            tags.append(item["Label"])
-            if len(tags) >= 10:
-                break # Limit to the top 10 tags
-        return tags
-    except Exception as e:
-        st.error(f"An error occurred: {e}")
+        list: A list of the top 10 relevant tags.
+    """
+    return perform_search_batch([query])[0]
+
+def perform_search_batch(queries, with_scores=False):
+    """
+    Perform semantic search for several queries at once.
+
+    All the queries are encoded in a single call to the model and sent to the
+    search backend as one batch.
+
+    Args:
+        queries (list): The search queries as strings
+        with_scores (bool): Whether to return (tag, similarity score) pairs rather than tags.
+
+    Returns:
+        list: One list of the top 10 relevant tags per query.
+
+    Raises:
+        Exception: The errors of the encoder and search backend are not caught, so
+        that a failing backend is reported rather than returning no candidates.
+    """
+    if not queries:
         return []
-    
-# Initialise Azure OpenAI client for GPT-4
-client = AzureOpenAI(api_key=azure_openai_api_key, azure_endpoint=azure_openai_api_endpoint, api_version=api_version)
 
-def filter_with_LLM(user_input, search_results):
+    with span("encode", texts=len(queries)):
+        vectors = resources.get("model").encode(list(queries), convert_to_numpy=True)
+    with span("search", queries=len(queries), backend=search_backend_name):
+        results = resources.get("search_backend").search_batch_scored(vectors, k=10)
+    return results if with_scores else labels_of(results)
+
+def retrieve_from_document(text, with_scores=False):
     """
-    Use GPT-4 to filter the search results based on relevance.
+    Search for descriptors close to the chunks of a document, without waiting for the LLM.
 
     Args:
-        user_input (str): The user's input to assess relevance.
-        search_results (str): The list of tags returned from search.
+        text (str): The input text for which tags are to be generated
+        with_scores (bool): Whether to return (tag, similarity score) pairs rather than tags.
 
     Returns:
-        list: A list of relevant tags based on the user's input.
+        list: One list of the top 10 relevant tags per chunk.
     """
-    prompt = (
-        f"Based on the following document summary: '{user_input}', "
-        f"evaluate the following EuroVoc descriptors and return only the relevant ones for annotating the document: {search_results}."
-        f"Provide your answer as a list of maximum 10 relevant descriptors separated by commas."
-    )
+    if document_chunks <= 0:
+        return []
 
-    response = client.chat.completions.create(
-        model = deployment_name, 
-        messages = [
-            {"role": "system", "content": "Hello! You are a linguistic expert in charge of annotating documents with relevant tags from the EuroVoc thesaurus"},
-            {"role": "user", "content": prompt}
-        ], 
-        max_tokens=150, 
-        temperature=0
-    )
+    chunks = chunk_text(text, chunk_size, chunk_overlap, document_chunks)
+    with span("document_retrieval", chunks=len(chunks)):
+        return perform_search_batch(chunks, with_scores=with_scores)
+
+async def aretrieve_from_document(text, with_scores=False):
+    """
+    Asynchronous version of `retrieve_from_document`.
+
+    Args:
+        text (str): The input text for which tags are to be generated
+        with_scores (bool): Whether to return (tag, similarity score) pairs rather than tags.
+
+    Returns:
+        list: One list of the top 10 relevant tags per chunk.
+    """
+    if document_chunks <= 0:
+        return []
+
+    chunks = chunk_text(text, chunk_size, chunk_overlap, document_chunks)
+    with span("document_retrieval", chunks=len(chunks)):
+        return await aperform_search_batch(chunks, with_scores=with_scores)
+
+async def aperform_search_batch(queries, with_scores=False):
+    """
+    Asynchronous version of `perform_search_batch`.
+
+    Args:
+        queries (list): The search queries as strings
+        with_scores (bool): Whether to return (tag, similarity score) pairs rather than tags.
+
+    Returns:
+        list: One list of the top 10 relevant tags per query.
+    """
+    if not queries:
+        return []
+
+    with span("encode", texts=len(queries)):
+        vectors = await to_thread(resources.get("model").encode, list(queries))
+    with span("search", queries=len(queries), backend=search_backend_name):
+        results = await resources.get("search_backend").asearch_batch_scored(vectors, k=10)
+    return results if with_scores else labels_of(results)
+
+def async_openai_client():
+    """
+    Create an asynchronous Azure OpenAI client for GPT-4.
+
+    Returns:
+        AsyncAzureOpenAI: A client to be used as an async context manager.
+    """
+    return AsyncAzureOpenAI(api_key=azure_openai_api_key, azure_endpoint=azure_openai_api_endpoint, api_version=api_version)
+
+def chat_completion(messages, template, max_tokens=150, temperature=0):
+    """
+    Call GPT-4, reusing the cached response of identical deterministic requests.
+
+    Args:
+        messages (list): The messages of the request.
+        template (str): The name of the prompt template, whose version is part of the cache key.
+        max_tokens (int): The maximum number of tokens of the response.
+        temperature (float): The sampling temperature; only requests at 0 are cached.
 
+    Returns:
+        str: The content of the response.
+    """
+    with span(f"llm.{template}", cache_hit=False):
+        cache = resources.get("llm_cache") if temperature == 0 else None
+        if cache is not None:
+            key = cache.key(deployment_name, PROMPT_TEMPLATE_VERSIONS[template], messages, max_tokens=max_tokens)
+            content = cache.get(key)
+            if content is not None:
+                annotate(cache_hit=True)
+                return content
+
+        response = resources.get("openai_client").chat.completions.create(
+            model = deployment_name, 
+            messages = messages, 
+            max_tokens=max_tokens, 
+            temperature=temperature
+        )
+        record_usage(response)
+        content = response.choices[0].message.content
+
+        if cache is not None and content is not None:
+            cache.put(key, content)
+        return content
+
+async def achat_completion(messages, template, async_client, max_tokens=150, temperature=0):
+    """
+    Asynchronous version of `chat_completion`.
+
+    Args:
+        messages (list): The messages of the request.
+        template (str): The name of the prompt template, whose version is part of the cache key.
+        async_client (AsyncAzureOpenAI): The client used to call GPT-4.
+        max_tokens (int): The maximum number of tokens of the response.
+        temperature (float): The sampling temperature; only requests at 0 are cached.
+
+    Returns:
+        str: The content of the response.
+    """
+    with span(f"llm.{template}", cache_hit=False):
+        cache = resources.get("llm_cache") if temperature == 0 else None
+        if cache is not None:
+            key = cache.key(deployment_name, PROMPT_TEMPLATE_VERSIONS[template], messages, max_tokens=max_tokens)
+            content = await to_thread(cache.get, key)
+            if content is not None:
+                annotate(cache_hit=True)
+                return content
+
+        response = await async_client.chat.completions.create(
+            model = deployment_name, 
+            messages = messages, 
+            max_tokens=max_tokens, 
+            temperature=temperature
+        )
+        record_usage(response)
+        content = response.choices[0].message.content
+
+        if cache is not None and content is not None:
+            await to_thread(cache.put, key, content)
+        return content
+
+def parse_tags(content):
+    """
+    Parse the comma-separated list of tags of a GPT-4 response.
+
+    Args:
+        content (str): The content of the response returned by the LLM.
+
+    Returns:
+        list: The tags of the response, or an empty list if it cannot be parsed.
+    """
     try:
         # Parse the response from the LLM to extract relevant tags
-        print(response.choices[0])
-        relevant_tags = response.choices[0].message.content.strip().split(',')
+        relevant_tags = content.strip().split(',')
         relevant_tags = [tag.strip() for tag in relevant_tags if tag.strip()]
         return relevant_tags
     except Exception as e:
         st.error(f"Error processing with GPT-4: {e}")
         return []
 
-def tags_with_LLM(user_input):
+def filter_messages(user_input, search_results):
     """
-    Propose EuroVoc descriptors for tagging a document using GPT-4.
+    Build the messages asking GPT-4 to filter the search results.
+
+    The candidates are listed one per line, in their order of relevance, and only
+    the best ones fitting in FILTER_TOKEN_BUDGET tokens are sent.
+    """
+    candidates = budget_candidates(search_results, filter_token_budget, estimate_tokens)
+    annotate(filter_candidates=len(candidates), dropped_candidates=len(search_results) - len(candidates))
+    candidate_list = "\n".join(f"- {candidate}" for candidate in candidates)
+
+    prompt = (
+        f"Based on the following document summary: '{user_input}', "
+        f"evaluate the following EuroVoc descriptors, listed from the most to the least similar to the document, "
+        f"and return only the relevant ones for annotating the document:\n{candidate_list}\n"
+        f"Provide your answer as a list of maximum 10 relevant descriptors separated by commas."
+    )
+
+    return [
+        {"role": "system", "content": "Hello! You are a linguistic expert in charge of annotating documents with relevant tags from the EuroVoc thesaurus"},
+        {"role": "user", "content": prompt}
+    ]
+
+def filter_with_LLM(user_input, search_results):
+    """
+    Use GPT-4 to filter the search results based on relevance.
 
     Args:
-        user_input (str): A summary of the document content.
+        user_input (str): The user's input to assess relevance.
+        search_results (str): The list of tags returned from search.
 
     Returns:
-        list: A list of proposed Euro<voc descriptors.
+        list: A list of relevant tags based on the user's input.
+    """
+    return parse_tags(chat_completion(filter_messages(user_input, search_results), "filter"))
+
+async def afilter_with_LLM(user_input, search_results, async_client):
+    """
+    Asynchronous version of `filter_with_LLM`.
+
+    Args:
+        user_input (str): The user's input to assess relevance.
+        search_results (str): The list of tags returned from search.
+        async_client (AsyncAzureOpenAI): The client used to call GPT-4.
+
+    Returns:
+        list: A list of relevant tags based on the user's input.
     """
+    return parse_tags(await achat_completion(filter_messages(user_input, search_results), "filter", async_client))
+
+def tags_messages(user_input):
+    """Build the messages asking GPT-4 to propose EuroVoc descriptors."""
     prompt = (
         f"Can you propose EuroVoc descriptors for tagging this document with meaningful metadata about its content, based on its summary: '{user_input}', "
         f"Provide your answer as a list of relevant EuroVoc descriptors separated by commas. Avoid proposing descriptors about country or region names (ex: Turkye, Maghreb, ...)"
         )
-    
 
-    response = client.chat.completions.create(
-        model = deployment_name, 
-        messages = [
-            {"role": "system", "content": "Hello! You are a linguistic expert in charge of annotating documents with relevant descriptors from the EuroVoc thesaurus"},
-            {"role": "user", "content": prompt}
-        ], 
-        max_tokens=150, 
-        temperature=0
-    )
+    return [
+        {"role": "system", "content": "Hello! You are a linguistic expert in charge of annotating documents with relevant descriptors from the EuroVoc thesaurus"},
+        {"role": "user", "content": prompt}
+    ]
 
-    try:
-        # Parse the response from the LLM to extract relevant tags
-        print(response.choices[0])
-        relevant_tags = response.choices[0].message.content.strip().split(',')
-        relevant_tags = [tag.strip() for tag in relevant_tags if tag.strip()]
-        return relevant_tags
-    except Exception as e:
-        st.error(f"Error processing with GPT-4: {e}")
-        return []
+def tags_with_LLM(user_input):
+    """
+    Propose EuroVoc descriptors for tagging a document using GPT-4.
 
-import json
+    Args:
+        user_input (str): A summary of the document content.
 
-# Load EuroVoc descriptors from a JSON file for validation
-with open("EuroVoc.json") as json_file:
-    EUROVOC = json.load(json_file)
+    Returns:
+        list: A list of proposed EuroVoc descriptors.
+    """
+    return parse_tags(chat_completion(tags_messages(user_input), "tags"))
 
-def predict_tags(text):
+async def atags_with_LLM(user_input, async_client):
     """
-    Predict relevant tags for the provided text using a combination of searching and LLM filtering.
+    Asynchronous version of `tags_with_LLM`.
+
+    Args:
+        user_input (str): A summary of the document content.
+        async_client (AsyncAzureOpenAI): The client used to call GPT-4.
+
+    Returns:
+        list: A list of proposed EuroVoc descriptors.
+    """
+    return parse_tags(await achat_completion(tags_messages(user_input), "tags", async_client))
+
+def rerank_candidates(text, tags):
+    """
+    Score the candidate descriptors with the local reranker.
 
     Args:
         text (str): The input text for which tags are to be generated
+        tags (list): The candidate descriptors.
 
     Returns:
-        list: a list of relevant tags.
+        tuple: A tuple containing:
+            - list: The relevant descriptors, best scored first
+            - list: The ambiguous descriptors to be escalated to the LLM, best scored first
+    """
+    from reranker import select_candidates, split_ambiguous
+
+    with span("rerank", candidates=len(tags), reranker=reranker_name) as rerank:
+        vocabulary = resources.get("eurovoc")
+        scores = resources.get("reranker").score(text, [(tag, vocabulary.definition(tag)) for tag in tags])
+
+        if rerank_mode == "escalate":
+            relevant_tags, ambiguous_tags = split_ambiguous(tags, scores, rerank_low, rerank_high)
+        else:
+            relevant_tags, ambiguous_tags = select_candidates(tags, scores, rerank_threshold, rerank_top_k), []
+
+        rerank.set(relevant=len(relevant_tags), ambiguous=len(ambiguous_tags))
+        return relevant_tags, ambiguous_tags
+
+def kept_candidates(tags, candidates):
+    """
+    Return the candidates of the tags kept by the filter stage, in the order of the tags.
+
+    Args:
+        tags (list): The tags kept by the filter stage.
+        candidates (list): The candidates as returned by `collect_candidates`.
+
+    Returns:
+        list: The candidate of each tag, with its score and sources; tags that were not
+        candidates have no score nor source.
+    """
+    by_label = {candidate["label"]: candidate for candidate in candidates}
+    return [by_label.get(tag, {"label": tag, "score": None, "sources": []}) for tag in tags]
+
+def filter_candidates(text, candidates):
+    """
+    Filter the candidate descriptors with the LLM, or the local reranker if one is configured.
+
+    Args:
+        text (str): The input text for which tags are to be generated
+        candidates (list): The candidates as returned by `collect_candidates`, best first.
+
+    Returns:
+        list: The relevant candidates, with their score and sources.
+    """
+    tags = [candidate["label"] for candidate in candidates]
+    if resources.get("reranker") is None:
+        return kept_candidates(filter_with_LLM(text, tags), candidates)
+
+    relevant_tags, ambiguous_tags = rerank_candidates(text, tags)
+
+    # Only the ambiguous candidates are sent to the LLM
+    if ambiguous_tags:
+        relevant_tags += [tag for tag in filter_with_LLM(text, ambiguous_tags) if tag not in relevant_tags]
+
+    return kept_candidates(relevant_tags[:rerank_top_k], candidates)
+
+async def afilter_candidates(text, candidates, async_client):
     """
-    # Get tags using the LLM based on the user input
-    tags = tags_with_LLM(user_input=text) 
+    Asynchronous version of `filter_candidates`.
 
-    mapped_tags = []
+    Args:
+        text (str): The input text for which tags are to be generated
+        candidates (list): The candidates as returned by `collect_candidates`, best first.
+        async_client (AsyncAzureOpenAI): The client used to call GPT-4.
+
+    Returns:
+        list: The relevant candidates, with their score and sources.
+    """
+    tags = [candidate["label"] for candidate in candidates]
+    if resources.get("reranker") is None:
+        return kept_candidates(await afilter_with_LLM(text, tags, async_client), candidates)
 
-    # Search for mappings to EuroVoc based on the initial tags obtained
-    for tag in tags: 
-        searched_tags = perform_search(tag)
+    relevant_tags, ambiguous_tags = await to_thread(rerank_candidates, text, tags)
 
-        for item in searched_tags:
-            mapped_tags.append(item)
+    # Only the ambiguous candidates are sent to the LLM
+    if ambiguous_tags:
+        relevant_tags += [tag for tag in await afilter_with_LLM(text, ambiguous_tags, async_client) if tag not in relevant_tags]
 
-    tags = tags + mapped_tags
+    return kept_candidates(relevant_tags[:rerank_top_k], candidates)
+
+def collect_candidates(resolved_tags, searched_tags, search_results, document_results=()):
+    """
+    Gather the candidate descriptors to be filtered by the LLM.
+
+    The resolved tags, the search results of each other tag and of each chunk of the
+    document are fused with CANDIDATE_FUSION: by their best or summed similarity score,
+    or by reciprocal rank fusion. Each candidate records the queries that retrieved it.
+
+    Args:
+        resolved_tags (list): The descriptors resolved without search.
+        searched_tags (list): The tags searched for, one per list of search results.
+        search_results (list): The lists of (tag, similarity score) pairs returned by search.
+        document_results (list): The lists of (tag, similarity score) pairs retrieved from the chunks of the document.
+
+    Returns:
+        list: The unique EuroVoc descriptors among the candidates, as dictionaries with their
+        "label", "score" and "sources", best first, at most MAX_CANDIDATES.
+    """
+    # The resolved tags are exact matches
+    results = [("llm", [(tag, 1.0) for tag in resolved_tags])]
+    results += [(f"tag:{tag}", pairs) for tag, pairs in zip(searched_tags, search_results)]
+    results += [(f"chunk:{index}", pairs) for index, pairs in enumerate(document_results)]
 
     # Filter out non-EuroVoc descriptors
-    tags = [item for item in tags if item in EUROVOC]
-    # Drop duplicates
-    tags = list(set(tags))
+    eurovoc = resources.get("eurovoc")
+    results = [(source, [pair for pair in pairs if pair[0] in eurovoc]) for source, pairs in results]
 
-    # Use an LLM to filter the results
-    relevant_tags = filter_with_LLM(text, tags)
+    # Fuse the results, in a deterministic order so that the filter prompt can be cached
+    candidates = fuse_candidates(results, method=candidate_fusion, rrf_k=rrf_k)
+    return candidates[:max_candidates] if max_candidates > 0 else candidates
 
-    return relevant_tags
+def document_only(candidates):
+    """Return the number of candidates only retrieved from the chunks of the document."""
+    return sum(bool(candidate["sources"]) and all(source.startswith("chunk:") for source in candidate["sources"]) for candidate in candidates)
 
-def refine_tags(user_input, tags, initial_text, chat_history):
+def predict_tags(text, with_provenance=False):
     """
-    Refine the list of EuroVoc descriptors based on the user feedback.
+    Predict relevant tags for the provided text using a combination of searching and LLM filtering.
 
     Args:
-        user_input (str): The user's comment for refining the tags.
-        tags (list): The initial list of tags to be refined.
-        initial_text (str): The summary of the document.
-        chat_history (list): The history of previous interactions.
+        text (str): The input text for which tags are to be generated
+        with_provenance (bool): Whether to return the candidates of the relevant tags, with
+            their fused score and the sources that retrieved them ("llm", "tag:<tag>" or
+            "chunk:<index>"), rather than the tags.
 
     Returns:
-        list: The updated list of EuroVoc descriptors after refinement.
+        list: a list of relevant tags.
     """
+    with span("predict_tags", characters=len(text)) as prediction, ThreadPoolExecutor(max_workers=1) as executor:
+        # Retrieve descriptors from the document itself while the LLM proposes tags
+        document_results = executor.submit(contextvars.copy_context().run, retrieve_from_document, text, True)
 
-    system_prompt = (
-        f"You are an expert in the EuroVoc thesaurus, and you are here to help refine a list of EuroVoc descriptors used to describe a document. "
-        f"The user will provide you with their comment about an initial list of descriptors, and you need to update this list based on these comments. "
-        f"Provide your answer as an updated list of EuroVoc descriptors separated by commas based on the comment from the user. "
-        f"The user has provided the summary of a document, along with EuroVoc descriptors (tags) that where generated for it. "
-        f"**User Text:**{initial_text}"
-        f"**Initial EuroVoc Tags:**{', '.join(tags)}"
-    )
+        # Get tags using the LLM based on the user input
+        tags = tags_with_LLM(user_input=text) 
 
-    prompt_text = [
-        {"role": "system", "content": system_prompt},
-        {"role": "assistant", "content": f"The refinement history up until this point: \n{chat_history}"},
-        {"role": "user", "content": f"The user's latest input:\n{user_input}"}
-    ]
+        # Resolve the tags that already are EuroVoc descriptors, or their normalised
+        # forms and non-descriptors, without searching
+        resolved_tags, unresolved_tags = resolve_tags(tags, resources.get("eurovoc"))
+        prediction.set(proposed_tags=len(tags), resolved_tags=len(resolved_tags))
 
-    response = client.chat.completions.create(
-        model = deployment_name,
-        messages = prompt_text,
-        temperature=0,
-        extra_body={
-            "data_sources":[
-                {
-                    "type": "azure_search",
-                    "parameters": {
-                        "endpoint": search_endpoint,
-                        "index_name": index_name,
-                        "authentication": {
-                            "type": "api_key",
-                            "key": api_key,
-                        }
-                    }
-                }
-            ],
+        # Search for mappings to EuroVoc based on the remaining tags, and fuse them
+        # with the descriptors retrieved from the document
+        search_results = perform_search_batch(unresolved_tags, with_scores=True)
+        candidates = collect_candidates(resolved_tags, unresolved_tags, search_results, document_results.result())
+        prediction.set(candidates=len(candidates), top_score=candidates[0]["score"] if candidates else None)
+
+        # Use an LLM, or a local reranker, to filter the results, best candidates first
+        relevant = filter_candidates(text, candidates)
+        prediction.set(relevant_tags=len(relevant), document_only_tags=document_only(relevant))
+
+        return relevant if with_provenance else [candidate["label"] for candidate in relevant]
+
+async def apredict_tags(text, with_provenance=False):
+    """
+    Asynchronous version of `predict_tags`.
+
+    The LLM calls use the asynchronous OpenAI client, the retrieval from the document
+    runs concurrently with the LLM proposing tags, and the searches of the proposed
+    tags run concurrently, bounded by SEARCH_CONCURRENCY.
+
+    Args:
+        text (str): The input text for which tags are to be generated
+        with_provenance (bool): Whether to return the candidates of the relevant tags
+            rather than the tags, as in `predict_tags`.
+
+    Returns:
+        list: a list of relevant tags.
+    """
+    with span("predict_tags", characters=len(text)) as prediction:
+        async with async_openai_client() as async_client:
+            # Retrieve descriptors from the document itself while the LLM proposes tags
+            document_results = asyncio.create_task(aretrieve_from_document(text, with_scores=True))
+
+            # Get tags using the LLM based on the user input
+            tags = await atags_with_LLM(text, async_client)
+
+            # Resolve the tags that already are EuroVoc descriptors without searching
+            resolved_tags, unresolved_tags = resolve_tags(tags, resources.get("eurovoc"))
+            prediction.set(proposed_tags=len(tags), resolved_tags=len(resolved_tags))
+
+            # Search for mappings to EuroVoc based on the remaining tags, and fuse them
+            # with the descriptors retrieved from the document
+            search_results = await aperform_search_batch(unresolved_tags, with_scores=True)
+            candidates = collect_candidates(resolved_tags, unresolved_tags, search_results, await document_results)
+            prediction.set(candidates=len(candidates), top_score=candidates[0]["score"] if candidates else None)
+
+            # Use an LLM, or a local reranker, to filter the results, best candidates first
+            relevant = await afilter_candidates(text, candidates, async_client)
+            prediction.set(relevant_tags=len(relevant), document_only_tags=document_only(relevant))
+
+            return relevant if with_provenance else [candidate["label"] for candidate in relevant]
+
+def run_predict_tags(text):
+    """
+    Run `apredict_tags` from synchronous code such as the Streamlit app.
+
+    Args:
+        text (str): The input text for which tags are to be generated
+
+    Returns:
+        list: a list of relevant tags.
+    """
+    return asyncio.run(apredict_tags(text))
+
+class RefinementSession:
+    """
+    Conversation refining the EuroVoc descriptors of a document.
+
+    Every turn sends a prompt of bounded size: an excerpt of the document limited to
+    REFINE_DOCUMENT_TOKENS, the current tags, a rolling context of the previous turns
+    limited to REFINE_CONTEXT_TOKENS, and at most REFINE_CANDIDATES descriptors retrieved
+    for the document and the comment. Turns are recorded as tag diffs, older ones being
+    compacted into a summary, and retrievals are cached for the whole session, so the
+    cost of a turn does not grow with the length of the session.
+    """
+
+    def __init__(self, text, tags):
+        """
+        Start a session.
+
+        Args:
+            text (str): The summary of the document.
+            tags (list): The tags generated for the document.
+        """
+        self.document = truncate_to_tokens(text, refine_document_tokens)
+        self.tags = list(tags)
+        self.context = RollingContext(refine_context_tokens, refine_recent_turns)
+        self.history = []
+        self.document_candidates = None
+        self.search_cache = {}
+
+    def to_dict(self):
+        """Return the state of the session as a JSON-serialisable dictionary, e.g. to store it between requests."""
+        return {
+            "document": self.document,
+            "tags": self.tags,
+            "context": self.context.to_dict(),
+            "history": self.history,
+            "document_candidates": self.document_candidates,
+            "search_cache": self.search_cache,
         }
-    )
 
-    try:
-        # Parse the response from the LLM
-        relevant_tags = response.choices[0].message.content.strip().split(',')
-        relevant_tags = [tag.strip() for tag in relevant_tags if tag.strip()]
-        return relevant_tags
-    except Exception as e:
-        st.error(f"Error processing with GPT-4: {e}")
-        return []
+    @classmethod
+    def from_dict(cls, state):
+        """
+        Restore a session saved with `to_dict`.
+
+        Args:
+            state (dict): The state of the session.
+
+        Returns:
+            RefinementSession: The session.
+        """
+        session = cls("", state["tags"])
+        session.document = state["document"]
+        session.context.load_dict(state["context"])
+        session.history = state["history"]
+        session.document_candidates = state["document_candidates"]
+        session.search_cache = state["search_cache"]
+        return session
+
+    def search(self, queries):
+        """Search for descriptors close to each query, reusing the results cached by the session."""
+        missing = [query for query in dict.fromkeys(queries) if query not in self.search_cache]
+        results = dict(zip(missing, perform_search_batch(missing)))
+
+        # Empty results are not cached, so that they are searched again by the next turn
+        self.search_cache.update((query, tags) for query, tags in results.items() if tags)
+        return [results[query] if query in results else self.search_cache[query] for query in queries]
+
+    def candidates(self, comment):
+        """
+        Return the descriptors retrieved for the document and the comment, apart from the current tags.
+
+        The descriptors of the document are retrieved once per session.
+        """
+        if self.document_candidates is None:
+            self.document_candidates = reciprocal_rank_fusion(retrieve_from_document(self.document), k=rrf_k)
+
+        ranking = reciprocal_rank_fusion([self.search([comment])[0], self.document_candidates], k=rrf_k)
+        return [tag for tag in ranking if tag not in self.tags][:refine_candidates]
+
+    def messages(self, comment):
+        """Build the messages asking GPT-4 to refine the tags following a comment."""
+        system_prompt = (
+            f"You are an expert in the EuroVoc thesaurus, and you are here to help refine a list of EuroVoc descriptors used to describe a document. "
+            f"The user will provide you with their comment about the current list of descriptors, and you need to update this list based on these comments. "
+            f"Provide your answer as an updated list of EuroVoc descriptors separated by commas based on the comment from the user. "
+            f"The user has provided the summary of a document, along with EuroVoc descriptors (tags) that where generated for it. "
+            f"**User Text:**{self.document}"
+            f"**Current EuroVoc Tags:**{', '.join(self.tags)}"
+        )
 
+        messages = [{"role": "system", "content": system_prompt}]
+        history = self.context.render()
+        if history:
+            messages.append({"role": "assistant", "content": f"The refinement history up until this point: \n{history}"})
+
+        candidates = self.candidates(comment)
+        messages.append({"role": "user", "content": (
+            f"The user's latest input:\n{comment}"
+            + (f"\n\nEuroVoc descriptors related to the document and the input: {', '.join(candidates)}" if candidates else "")
+        )})
+        return messages
+
+    def resolve(self, tags):
+        """Map the tags of the response to EuroVoc descriptors, searching for those that are not."""
+        resolved_tags, unresolved_tags = resolve_tags(tags, resources.get("eurovoc"))
+        searched_tags = [results[0] for results in self.search(unresolved_tags) if results]
+        return list(dict.fromkeys(resolved_tags + searched_tags))
+
+    def refine(self, comment):
+        """
+        Refine the tags following a comment of the user.
+
+        Args:
+            comment (str): The user's comment for refining the tags.
+
+        Returns:
+            list: The updated list of EuroVoc descriptors after refinement.
+        """
+        comment = comment.strip()
+        with span("refine", turn=len(self.history) + 1) as refinement:
+            messages = self.messages(comment)
+            refinement.set(estimated_prompt_tokens=sum(estimate_tokens(message["content"]) for message in messages))
+            tags = self.resolve(parse_tags(chat_completion(messages, "refine", max_tokens=300)))
+
+        diff = tag_diff(self.tags, tags)
+        self.context.add(comment, diff)
+        self.history.append({"comment": comment, **diff})
+        self.tags = tags
+        return tags
 
 @st.dialog("Ask for refinements")
 def refine():
@@ -322,28 +917,23 @@ def refine():
     st.write("How can we improve the proposed list?")
     user_comment = st.text_input("Ask for refinements about the generated tags")
     if st.button("Run"):
-        st.session_state.chat_history.append({"role": "user", "content": user_comment.strip()})
-        refined_tags = refine_tags(
-            user_comment,
-            st.session_state.generated_tags,
-            st.session_state.input_text,
-            st.session_state.chat_history
-        )
-        st.session_state.generated_tags = refined_tags
-        st.session_state.chat_history.append({"role": "assistant", "content": ", ".join(refined_tags)})
+        st.session_state.generated_tags = st.session_state.refinement.refine(user_comment)
         st.rerun()
 
 def main():
     """Main function to run the Streamlit application for semantic tagging."""
     st.title("Semantic Tagging Solution")
 
+    warm_up_resources()
+    instrumentation.serve_metrics()
+
     if 'generated_tags' not in st.session_state:
         st.session_state.generated_tags = []
         st.session_state.input_text = ""
     if 'user_text' not in st.session_state:
         st.session_state.user_text = ""
-    if 'chat_history' not in st.session_state:
-        st.session_state.chat_history = []
+    if 'refinement' not in st.session_state:
+        st.session_state.refinement = None
     if "show_refine" not in st.session_state:
         st.session_state.show_refine = False
 
@@ -372,7 +962,12 @@ def main():
 
         # Update session state with parsed text and generated tags
         st.session_state.input_text = text
-        st.session_state.generated_tags = predict_tags(text)
+        try:
+            st.session_state.generated_tags = run_predict_tags(text)
+        except Exception as e:
+            st.error(f"An error occurred: {e}")
+            return
+        st.session_state.refinement = RefinementSession(text, st.session_state.generated_tags)
 
     # Display tags and refine button
     if st.session_state.generated_tags:
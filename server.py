@@ -0,0 +1,369 @@
+import os
+import gc
+import json
+import sys
+import time
+import signal
+import uuid
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import resources
+import instrumentation
+from instrumentation import span
+import semantic_tagging
+from micro_batching import BatchingEncoder, BatchingSearchBackend, Overloaded
+from session_store import SessionStore
+
+SERVER_HOST = os.environ.get("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.environ.get("SERVER_PORT", 8080))
+# Number of worker processes forked from a parent holding the resources, 1 serves in-process
+SERVER_WORKERS = int(os.environ.get("SERVER_WORKERS", 1))
+# Maximum number of requests processed at once: further requests are answered 503
+MAX_INFLIGHT_REQUESTS = int(os.environ.get("MAX_INFLIGHT_REQUESTS", 64))
+# Connections waiting to be accepted: beyond them, the kernel resets new connections
+# before the admission control can answer 503
+SERVER_BACKLOG = int(os.environ.get("SERVER_BACKLOG", 128))
+MAX_BODY_BYTES = int(os.environ.get("MAX_BODY_BYTES", 10 * 2 ** 20))
+# Concurrent encode and search calls arriving within BATCH_MAX_WAIT_MS are run as one
+# batch of at most BATCH_MAX_SIZE texts, with at most BATCH_MAX_QUEUE calls waiting
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", 64))
+BATCH_MAX_WAIT_MS = float(os.environ.get("BATCH_MAX_WAIT_MS", 5))
+BATCH_MAX_QUEUE = int(os.environ.get("BATCH_MAX_QUEUE", 1024))
+MAX_SEARCH_K = 50
+# Store of the refinement sessions, shared by the worker processes, with the maximum
+# number of sessions kept and their lifetime since their last turn
+REFINE_SESSIONS_PATH = os.environ.get("REFINE_SESSIONS_PATH", ".cache/refine_sessions.sqlite")
+REFINE_MAX_SESSIONS = int(os.environ.get("REFINE_MAX_SESSIONS", 1000))
+REFINE_SESSION_TTL_HOURS = float(os.environ.get("REFINE_SESSION_TTL_HOURS", 24))
+# Time a turn may take before another turn of the same session can start
+REFINE_LEASE_SECONDS = float(os.environ.get("REFINE_LEASE_SECONDS", 120))
+# Directory where the worker processes write their Prometheus metrics, summed on /metrics;
+# cleared when the server starts, so each server needs its own
+PROMETHEUS_MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR", ".cache/prometheus")
+
+class BadRequest(Exception):
+    """Raised when the body of a request is invalid."""
+
+class Conflict(Exception):
+    """Raised when a request conflicts with a concurrent one."""
+
+def _field(body: dict, name: str, field_type, default=None):
+    value = body.get(name, default)
+    if value is None or not isinstance(value, field_type):
+        raise BadRequest(f"'{name}' must be a {field_type.__name__}")
+    return value
+
+def tag(body: dict) -> dict:
+    """
+    Predict the EuroVoc descriptors of {"text": ...}. With {"provenance": true}, also
+    returns the candidate of each tag, with its fused score and the sources that retrieved it.
+    """
+    text = _field(body, "text", str)
+    provenance = _field(body, "provenance", bool, False)
+    if not text.strip():
+        raise BadRequest("'text' is empty")
+
+    candidates = semantic_tagging.predict_tags(text, with_provenance=True)
+    result = {"tags": [candidate["label"] for candidate in candidates]}
+    if provenance:
+        result["candidates"] = candidates
+    return result
+
+def search(body: dict) -> dict:
+    """Return the descriptors closest to each of {"queries": [...], "k": 10}."""
+    queries = _field(body, "queries", list)
+    k = _field(body, "k", int, 10)
+    if not all(isinstance(query, str) for query in queries):
+        raise BadRequest("'queries' must be a list of strings")
+    if not 0 < k <= MAX_SEARCH_K:
+        raise BadRequest(f"'k' must be between 1 and {MAX_SEARCH_K}")
+
+    vectors = resources.get("model").encode(queries)
+    return {"results": resources.get("search_backend").search_batch(vectors, k=k) if queries else []}
+
+def load_session_store() -> SessionStore:
+    """Open the store of the refinement sessions."""
+    return SessionStore(REFINE_SESSIONS_PATH, ttl=REFINE_SESSION_TTL_HOURS * 3600, max_sessions=REFINE_MAX_SESSIONS)
+
+resources.register("session_store", load_session_store)
+
+def refine(body: dict) -> dict:
+    """
+    Refine tags following {"comment": ...}, in the session {"session_id": ...} or in a new
+    session for the {"tags": [...]} of {"text": ...}. Returns the session id, the refined
+    tags and the tags added and removed by this turn.
+
+    Sessions are kept in a store shared by the worker processes, so any of them can
+    apply the next turn. A turn claims the session before calling the LLM, so that a
+    turn sent while another of the same session is in progress is rejected at once
+    rather than overwriting it.
+    """
+    comment = _field(body, "comment", str)
+    session_id = body.get("session_id")
+    store = resources.get("session_store")
+
+    state, version = store.get(session_id) if session_id is not None else (None, 0)
+    lease = None
+    if state is None:
+        if session_id is not None and "text" not in body:
+            raise BadRequest(f"Unknown or expired session {session_id}: start a new one with 'text' and 'tags'")
+        session_id = uuid.uuid4().hex
+        tags = _field(body, "tags", list)
+        if not all(isinstance(tag, str) for tag in tags):
+            raise BadRequest("'tags' must be a list of strings")
+        session = semantic_tagging.RefinementSession(_field(body, "text", str), tags)
+    else:
+        session = semantic_tagging.RefinementSession.from_dict(state)
+        lease = store.claim(session_id, version, REFINE_LEASE_SECONDS)
+        if lease is None:
+            raise Conflict(f"Session {session_id} is being refined by another request: retry with the latest tags")
+
+    try:
+        tags = session.refine(comment)
+    except BaseException:
+        if lease is not None:
+            store.release(session_id, lease)
+        raise
+    turn = session.history[-1]
+    if not store.put(session_id, session.to_dict(), version, lease):
+        raise Conflict(f"Session {session_id} was refined by another request: retry with the latest tags")
+    return {"session_id": session_id, "tags": tags, "added": turn["added"], "removed": turn["removed"]}
+
+ROUTES = {
+    "/tag": tag,
+    "/search": search,
+    "/refine": refine,
+}
+
+def install_batching():
+    """Wrap the encoder and search backend with micro-batching schedulers, once per process."""
+    model = resources.get("model")
+    if not isinstance(model, BatchingEncoder):
+        resources.override("model", BatchingEncoder(model, BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS / 1000, BATCH_MAX_QUEUE))
+
+    backend = resources.get("search_backend")
+    if not isinstance(backend, BatchingSearchBackend):
+        resources.override("search_backend", BatchingSearchBackend(
+            backend, BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS / 1000, BATCH_MAX_QUEUE, workers=semantic_tagging.search_concurrency
+        ))
+
+class TaggingHandler(BaseHTTPRequestHandler):
+    """JSON API around the tagging pipeline, rejecting requests beyond MAX_INFLIGHT_REQUESTS."""
+
+    protocol_version = "HTTP/1.1"
+    admission = threading.BoundedSemaphore(MAX_INFLIGHT_REQUESTS)
+
+    def _send(self, status: int, body: bytes, content_type: str = "application/json", headers: dict = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, payload: dict, headers: dict = None):
+        self._send(status, json.dumps(payload).encode("utf-8"), headers=headers)
+
+    def do_GET(self):
+        if self.path == "/health":
+            stats = {
+                name: resources.get(name).batcher.stats()
+                for name in ("model", "search_backend")
+                if resources.is_loaded(name) and hasattr(resources.get(name), "batcher")
+            }
+            self._send_json(200, {"status": "ok", "batching": stats})
+        elif self.path == "/metrics" and instrumentation.get_sink(instrumentation.PrometheusSink):
+            self._send(200, instrumentation.get_sink(instrumentation.PrometheusSink).render().encode("utf-8"), "text/plain; version=0.0.4")
+        else:
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        route = ROUTES.get(self.path)
+        if route is None:
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            if length < 0:
+                raise ValueError
+        except ValueError:
+            # The end of the body is unknown, so the connection cannot be reused
+            self.close_connection = True
+            self._send_json(400, {"error": "Invalid Content-Length header"})
+            return
+        if length > MAX_BODY_BYTES:
+            self.close_connection = True
+            self._send_json(413, {"error": f"The body exceeds {MAX_BODY_BYTES} bytes"})
+            return
+
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(body, dict):
+                raise ValueError("the body must be a JSON object")
+        except ValueError as e:
+            self._send_json(400, {"error": f"Invalid JSON: {e}"})
+            return
+
+        # Shed the load rather than queueing requests that would time out
+        if not self.admission.acquire(blocking=False):
+            self._send_json(503, {"error": "Too many requests in progress"}, {"Retry-After": "1"})
+            return
+
+        try:
+            with span(f"http{self.path}") as request:
+                try:
+                    status, payload, headers = 200, route(body), None
+                except BadRequest as e:
+                    status, payload, headers = 400, {"error": str(e)}, None
+                except Conflict as e:
+                    status, payload, headers = 409, {"error": str(e)}, None
+                except Overloaded as e:
+                    status, payload, headers = 503, {"error": f"Overloaded: {e}"}, {"Retry-After": "1"}
+                except Exception as e:
+                    status, payload, headers = 500, {"error": str(e)}, None
+                request.set(status=status)
+            self._send_json(status, payload, headers)
+        finally:
+            self.admission.release()
+
+class TaggingServer(ThreadingHTTPServer):
+    """Threading HTTP server with a listen backlog of SERVER_BACKLOG connections, at least MAX_INFLIGHT_REQUESTS."""
+
+    request_queue_size = max(SERVER_BACKLOG, MAX_INFLIGHT_REQUESTS)
+    daemon_threads = True
+
+def make_server(host: str = SERVER_HOST, port: int = SERVER_PORT) -> TaggingServer:
+    """
+    Load the resources, set up micro-batching and create the HTTP server.
+
+    Args:
+        host (str): The address to listen on.
+        port (int): The port to listen on.
+
+    Returns:
+        TaggingServer: The server, handling each connection in a thread.
+    """
+    resources.warm_up()
+    install_batching()
+
+    return TaggingServer((host, port), TaggingHandler)
+
+def _run_worker(server: TaggingServer, workers: int):
+    """Serve requests in a forked worker process, until it is terminated."""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    resources.after_fork()
+
+    # Write the metrics of the worker where /metrics sums those of all the workers
+    sink = instrumentation.get_sink(instrumentation.PrometheusSink)
+    if sink is not None:
+        sink.share(PROMETHEUS_MULTIPROC_DIR)
+
+    # Share the cores between the workers rather than oversubscribing them
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(max(1, (os.cpu_count() or 1) // workers))
+
+    # The threads of the schedulers are not inherited, so each worker starts its own
+    install_batching()
+    server.serve_forever()
+
+def serve_prefork(workers: int, host: str = SERVER_HOST, port: int = SERVER_PORT):
+    """
+    Serve the API with several worker processes sharing the memory of their parent.
+
+    The parent loads the resources and binds the socket, then forks the workers, which
+    accept connections on the shared socket. The encoder weights are shared copy-on-write,
+    and the vocabulary and local index are memory-mapped, so each additional worker only
+    costs its own interpreter state. Workers that exit are replaced until the parent is
+    interrupted or terminated, which then terminates them.
+
+    Args:
+        workers (int): The number of worker processes.
+        host (str): The address to listen on.
+        port (int): The port to listen on.
+    """
+    resources.warm_up()
+    server = TaggingServer((host, port), TaggingHandler)
+
+    # Move the objects loaded so far out of the tracked generations, so that the garbage
+    # collections of the workers do not write to their pages and copy them
+    gc.collect()
+    gc.freeze()
+
+    # Sum the metrics of the workers, including those that exited, on /metrics and on
+    # PROMETHEUS_PORT, which the parent serves
+    sink = instrumentation.get_sink(instrumentation.PrometheusSink)
+    if sink is not None:
+        os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+        for name in os.listdir(PROMETHEUS_MULTIPROC_DIR):
+            if name.startswith("metrics_"):
+                os.remove(os.path.join(PROMETHEUS_MULTIPROC_DIR, name))
+        sink.directory = PROMETHEUS_MULTIPROC_DIR
+        instrumentation.serve_metrics()
+
+    children = set()
+    stopping = False
+
+    def fork_worker():
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                _run_worker(server, workers)
+            except BaseException:
+                status = 1
+            finally:
+                os._exit(status)
+        children.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(workers):
+        fork_worker()
+    print(f"Serving the tagging API on http://{host}:{port} with {workers} worker processes")
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        children.discard(pid)
+        if not stopping:
+            print(f"Worker {pid} exited with status {status}, starting a new one")
+            time.sleep(1) # Avoid a fork loop when workers fail on startup
+            fork_worker()
+
+    server.server_close()
+
+def main():
+    """Serve the tagging pipeline over HTTP: POST /tag, /search and /refine, GET /health and /metrics."""
+    if SERVER_WORKERS > 1:
+        serve_prefork(SERVER_WORKERS)
+        return
+
+    server = make_server()
+    instrumentation.serve_metrics()
+    print(f"Serving the tagging API on http://{SERVER_HOST}:{SERVER_PORT}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
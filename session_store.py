@@ -0,0 +1,139 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+
+class SessionStore:
+    """
+    Disk-backed store of the refinement sessions of the HTTP service.
+
+    The state of each session is stored as JSON in SQLite, so that the worker processes
+    of the service share the sessions whichever of them receives a turn. Each save
+    increments the version of the session, and a save based on an outdated version is
+    rejected, so that concurrent turns of one session do not overwrite each other. A
+    turn first claims the version it was derived from with `claim`, so that a concurrent
+    turn is rejected before doing its work rather than when saving it. Sessions expire after `ttl` seconds, and the least recently used ones are evicted
+    beyond `max_sessions`.
+    """
+
+    def __init__(self, path: str, ttl: float = 24 * 3600, max_sessions: int = 1000):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        self.connection = self._connect()
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, state TEXT, version INTEGER, accessed REAL, lease TEXT, leased_until REAL)"
+        )
+        # Stores created before the leases lack their columns
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(sessions)")]
+        if "lease" not in columns:
+            self.connection.execute("ALTER TABLE sessions ADD COLUMN lease TEXT")
+            self.connection.execute("ALTER TABLE sessions ADD COLUMN leased_until REAL")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS sessions_accessed ON sessions (accessed)")
+        self.connection.commit()
+        self.lock = threading.Lock()
+
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+
+    def _connect(self) -> sqlite3.Connection:
+        # Wait for the writes of the other worker processes rather than failing
+        return sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+
+    def after_fork(self):
+        """Open a connection of the forked process, as SQLite connections cannot be shared."""
+        self.connection = self._connect()
+        self.lock = threading.Lock()
+
+    def get(self, session_id: str) -> tuple:
+        """
+        Return the state of a session.
+
+        Args:
+            session_id (str): The id of the session.
+
+        Returns:
+            tuple: The state and its version, or (None, 0) if the session is unknown or expired.
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT state, version, accessed FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        if row is None or time.time() - row[2] > self.ttl:
+            return None, 0
+        return json.loads(row[0]), row[1]
+
+    def claim(self, session_id: str, version: int, duration: float) -> str:
+        """
+        Lease a version of a session to the turn deriving its next state.
+
+        Args:
+            session_id (str): The id of the session.
+            version (int): The version the turn derives its state from.
+            duration (float): The number of seconds after which the lease expires, e.g. if
+                its worker died, and another turn can claim the version.
+
+        Returns:
+            str: The lease to save the state with, or None if the session was saved since this
+                version was read, or another turn holds an unexpired lease of it.
+        """
+        lease = uuid.uuid4().hex
+        now = time.time()
+        with self.lock:
+            cursor = self.connection.execute(
+                "UPDATE sessions SET lease = ?, leased_until = ? "
+                "WHERE id = ? AND version = ? AND (leased_until IS NULL OR leased_until < ?)",
+                (lease, now + duration, session_id, version, now),
+            )
+            self.connection.commit()
+        return lease if cursor.rowcount == 1 else None
+
+    def release(self, session_id: str, lease: str):
+        """Give up a lease without saving, e.g. when the turn failed, so that the next turn can claim the version."""
+        with self.lock:
+            self.connection.execute(
+                "UPDATE sessions SET lease = NULL, leased_until = NULL WHERE id = ? AND lease = ?", (session_id, lease)
+            )
+            self.connection.commit()
+
+    def put(self, session_id: str, state: dict, version: int, lease: str = None) -> bool:
+        """
+        Save the state of a session, evicting the least recently used sessions if the store is full.
+
+        Args:
+            session_id (str): The id of the session.
+            state (dict): The JSON-serialisable state of the session.
+            version (int): The version the state was derived from, 0 for a new session.
+            lease (str): The lease of the version returned by `claim`, required to save an
+                existing session.
+
+        Returns:
+            bool: False if the session was saved by another turn since this version was read,
+                or the lease expired and was claimed by another turn.
+        """
+        now = time.time()
+        content = json.dumps(state)
+        with self.lock:
+            if version == 0:
+                cursor = self.connection.execute(
+                    "INSERT OR IGNORE INTO sessions (id, state, version, accessed) VALUES (?, ?, 1, ?)",
+                    (session_id, content, now),
+                )
+            else:
+                cursor = self.connection.execute(
+                    "UPDATE sessions SET state = ?, version = version + 1, accessed = ?, lease = NULL, leased_until = NULL "
+                    "WHERE id = ? AND version = ? AND lease = ?",
+                    (content, now, session_id, version, lease),
+                )
+            saved = cursor.rowcount == 1
+
+            self.connection.execute("DELETE FROM sessions WHERE accessed < ?", (now - self.ttl,))
+            excess = self.connection.execute("SELECT COUNT(*) FROM sessions").fetchone()[0] - self.max_sessions
+            if excess > 0:
+                self.connection.execute(
+                    "DELETE FROM sessions WHERE id IN (SELECT id FROM sessions ORDER BY accessed LIMIT ?)", (excess,)
+                )
+            self.connection.commit()
+        return saved
@@ -0,0 +1,252 @@
+import os
+import sys
+import json
+import time
+import glob
+import argparse
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import instrumentation
+from batch_runner import process_concurrently
+
+# Number of documents tagged concurrently
+CONCURRENCY = int(os.environ.get("TAG_CONCURRENCY", 8))
+# Number of rows read at once from CSV and Parquet inputs
+READ_BATCH_SIZE = 1000
+
+def iter_jsonl(path: str, id_field: str, text_field: str):
+    """Yield the (id, payload) pairs of a JSONL file, one document per line."""
+    with open(path) as file:
+        for number, line in enumerate(file):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            yield str(record.get(id_field, number)), {"text": record[text_field]}
+
+def iter_csv(path: str, id_field: str, text_field: str):
+    """Yield the (id, payload) pairs of a CSV file, read in chunks."""
+    number = 0
+    for chunk in pd.read_csv(path, chunksize=READ_BATCH_SIZE, dtype={id_field: str}):
+        for _, row in chunk.iterrows():
+            document_id = row[id_field] if id_field in chunk.columns and pd.notna(row[id_field]) else number
+            yield str(document_id), {"text": "" if pd.isna(row[text_field]) else str(row[text_field])}
+            number += 1
+
+def iter_parquet(path: str, id_field: str, text_field: str):
+    """Yield the (id, payload) pairs of a Parquet file, read in record batches."""
+    parquet_file = pq.ParquetFile(path)
+    columns = [column for column in [id_field, text_field] if column in parquet_file.schema_arrow.names]
+    number = 0
+    for batch in parquet_file.iter_batches(batch_size=READ_BATCH_SIZE, columns=columns):
+        batch = batch.to_pydict()
+        for index, text in enumerate(batch[text_field]):
+            document_id = batch[id_field][index] if id_field in batch else number
+            yield str(document_id), {"text": text or ""}
+            number += 1
+
+def iter_pdf_directory(path: str):
+    """Yield the (id, payload) pairs of the PDF files of a directory, identified by their relative path."""
+    for pdf_path in sorted(glob.glob(os.path.join(path, "**", "*.pdf"), recursive=True)):
+        yield os.path.relpath(pdf_path, path), {"pdf": pdf_path}
+
+def iter_documents(path: str, id_field: str = "id", text_field: str = "text"):
+    """
+    Stream the documents to tag from a JSONL, CSV or Parquet file, or a directory of PDFs.
+
+    Args:
+        path (str): The input file or directory.
+        id_field (str): The column holding the identifier of each document; the row
+            number is used if it is missing.
+        text_field (str): The column holding the text of each document.
+
+    Yields:
+        tuple: (id, payload) pairs, the payload holding either the "text" or the "pdf" path.
+    """
+    if os.path.isdir(path):
+        return iter_pdf_directory(path)
+
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".jsonl", ".ndjson"):
+        return iter_jsonl(path, id_field, text_field)
+    if extension == ".csv":
+        return iter_csv(path, id_field, text_field)
+    if extension == ".parquet":
+        return iter_parquet(path, id_field, text_field)
+    raise ValueError(f"Unsupported input format: {path}")
+
+def tag_document(payload: dict) -> list:
+    """
+    Predict the EuroVoc descriptors of a document.
+
+    Args:
+        payload (dict): The "text" of the document, or the "pdf" path from which its
+            summary is extracted.
+
+    Returns:
+        list: The predicted tags.
+    """
+    from semantic_tagging import predict_tags, read_pdf
+
+    if "pdf" in payload:
+        with open(payload["pdf"], "rb") as file:
+            text = read_pdf(file)
+    else:
+        text = payload["text"]
+
+    if not text.strip():
+        return []
+    return predict_tags(text)
+
+class JsonlWriter:
+    """Append the results to a JSONL file, one line per document, flushed as they complete."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def done_ids(self) -> set:
+        """Return the ids of the documents already written."""
+        done = set()
+        if not os.path.exists(self.path):
+            return done
+        with open(self.path) as file:
+            for line in file:
+                try:
+                    done.add(json.loads(line)["id"])
+                except (json.JSONDecodeError, KeyError):
+                    continue # Ignore a line truncated by a crash
+        return done
+
+    def __enter__(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(self.path, "a")
+        return self
+
+    def write(self, document_id: str, tags: list):
+        self.file.write(json.dumps({"id": document_id, "tags": tags}) + "\n")
+        self.file.flush()
+
+    def __exit__(self, *exc_info):
+        self.file.close()
+        return False
+
+class ParquetWriter:
+    """
+    Write the results to a directory of Parquet files, in row groups of `row_group_size`
+    documents. Each file is closed after `rows_per_file` documents, so an interrupted
+    run only loses the documents of its last, unreadable file.
+    """
+
+    SCHEMA = pa.schema([("id", pa.string()), ("tags", pa.list_(pa.string()))])
+
+    def __init__(self, path: str, row_group_size: int = 1000, rows_per_file: int = 50000):
+        self.path = path
+        self.row_group_size = row_group_size
+        self.rows_per_file = rows_per_file
+        self.writer = None
+        self.rows = []
+        self.rows_in_file = 0
+
+    def done_ids(self) -> set:
+        """Return the ids of the documents already written."""
+        done = set()
+        for part in sorted(glob.glob(os.path.join(self.path, "*.parquet"))):
+            try:
+                done.update(pq.read_table(part, columns=["id"]).column("id").to_pylist())
+            except (pa.ArrowInvalid, OSError):
+                print(f"Ignoring the incomplete file {part}: its documents will be tagged again")
+                os.replace(part, part + ".incomplete")
+        return done
+
+    def __enter__(self):
+        os.makedirs(self.path, exist_ok=True)
+        return self
+
+    def _flush(self):
+        if not self.rows:
+            return
+        if self.writer is None:
+            name = f"part-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{len(glob.glob(os.path.join(self.path, 'part-*')))}.parquet"
+            self.writer = pq.ParquetWriter(os.path.join(self.path, name), self.SCHEMA)
+        self.writer.write_table(pa.Table.from_pylist(self.rows, schema=self.SCHEMA))
+        self.rows_in_file += len(self.rows)
+        self.rows = []
+
+        if self.rows_in_file >= self.rows_per_file:
+            self.writer.close()
+            self.writer = None
+            self.rows_in_file = 0
+
+    def write(self, document_id: str, tags: list):
+        self.rows.append({"id": document_id, "tags": tags})
+        if len(self.rows) >= self.row_group_size:
+            self._flush()
+
+    def __exit__(self, *exc_info):
+        self._flush()
+        if self.writer is not None:
+            self.writer.close()
+        return False
+
+def open_writer(path: str):
+    """Return the writer for a .jsonl output file, or a directory of Parquet files otherwise."""
+    if os.path.splitext(path)[1].lower() in (".jsonl", ".ndjson"):
+        return JsonlWriter(path)
+    return ParquetWriter(path)
+
+def main():
+    """
+    Tag a stream of documents with EuroVoc descriptors.
+
+    Documents are read lazily from a JSONL, CSV or Parquet file, or a directory of PDFs,
+    tagged concurrently with `predict_tags`, and written as they complete to a JSONL file
+    or a directory of Parquet files. Documents already in the output are skipped, so an
+    interrupted run resumes where it stopped; failed documents are reported and tagged
+    again by the next run.
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("input", help="JSONL, CSV or Parquet file, or directory of PDFs")
+    parser.add_argument("output", help="JSONL file, or directory of Parquet files")
+    parser.add_argument("--id-field", default="id", help="column identifying the documents")
+    parser.add_argument("--text-field", default="text", help="column holding the text of the documents")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help="number of documents tagged concurrently")
+    parser.add_argument("--limit", type=int, default=None, help="maximum number of documents to tag")
+    args = parser.parse_args()
+    instrumentation.serve_metrics()
+
+    writer = open_writer(args.output)
+    done = writer.done_ids()
+    if done:
+        print(f"Resuming {args.output}: {len(done)} documents already tagged")
+
+    pending = (
+        (document_id, payload)
+        for document_id, payload in iter_documents(args.input, args.id_field, args.text_field)
+        if document_id not in done
+    )
+    if args.limit is not None:
+        pending = (item for item, _ in zip(pending, range(args.limit)))
+
+    tagged, failed = 0, []
+    start = time.perf_counter()
+    with writer:
+        for document_id, tags, error in process_concurrently(pending, tag_document, args.concurrency):
+            if error is not None:
+                print(f"Failed to tag {document_id}: {error}")
+                failed.append(document_id)
+                continue
+
+            writer.write(document_id, tags)
+            tagged += 1
+            if tagged % 100 == 0:
+                print(f"{tagged} documents tagged ({tagged / (time.perf_counter() - start):.2f} documents/s)")
+
+    print(f"{tagged} documents tagged in {time.perf_counter() - start:.1f}s, results saved to {args.output}")
+    if failed:
+        print(f"{len(failed)} documents failed and will be tagged again on the next run")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
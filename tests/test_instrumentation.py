@@ -0,0 +1,34 @@
+from instrumentation import PrometheusSink, Span
+
+def record(sink, name, duration, **attributes):
+    span = Span(name, **attributes)
+    span.duration = duration
+    sink.end(span)
+
+def test_shared_sinks_render_the_sum_of_the_processes(tmp_path):
+    first, second, reader = PrometheusSink(), PrometheusSink(), PrometheusSink()
+    record(first, "search", 1.0)
+    first.share(str(tmp_path), interval=3600)
+    second.share(str(tmp_path), interval=3600)
+    reader.directory = str(tmp_path)
+
+    record(first, "search", 0.01, queries=2)
+    record(second, "search", 0.2, queries=3)
+    second.write()
+
+    lines = first.render().splitlines()
+
+    # The span recorded before sharing, e.g. inherited from a parent, is discarded
+    assert 'semantic_tagging_span_duration_seconds_count{span="search"} 2' in lines
+    assert 'semantic_tagging_span_duration_seconds_bucket{span="search",le="0.01"} 1' in lines
+    assert 'semantic_tagging_span_attribute_total{span="search",attribute="queries"} 5.0' in lines
+    assert reader.render() == first.render()
+
+def test_unshared_sink_renders_its_own_metrics():
+    sink = PrometheusSink()
+    record(sink, "encode", 0.5, cache_hits=1)
+
+    lines = sink.render().splitlines()
+
+    assert 'semantic_tagging_span_duration_seconds_count{span="encode"} 1' in lines
+    assert 'semantic_tagging_span_attribute_total{span="encode",attribute="cache_hits"} 1.0' in lines
@@ -0,0 +1,109 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from micro_batching import MicroBatcher, Overloaded
+
+def test_results_are_sliced_per_request():
+    batcher = MicroBatcher(lambda items: [item * 10 for item in items], max_batch_size=64, max_wait=0.05)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        requests = [list(range(start, start + size)) for start, size in [(0, 1), (10, 3), (20, 2), (30, 5)] * 4]
+        results = list(executor.map(batcher, requests))
+
+    assert results == [[item * 10 for item in request] for request in requests]
+
+def test_concurrent_requests_share_a_batch():
+    calls = []
+    batcher = MicroBatcher(lambda items: calls.append(list(items)) or items, max_batch_size=64, max_wait=0.2)
+
+    futures = [batcher.submit([index]) for index in range(3)]
+
+    assert [future.result(timeout=5) for future in futures] == [[0], [1], [2]]
+    assert calls == [[0, 1, 2]]
+    assert batcher.stats()["mean_batch_size"] == 3
+
+def test_batches_are_bounded_by_max_batch_size():
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def function(items):
+        calls.append(list(items))
+        started.set()
+        release.wait(5)
+        return items
+
+    batcher = MicroBatcher(function, max_batch_size=2, max_wait=0.05)
+    first = batcher.submit(["a"])
+    assert started.wait(5)
+    # Queued while the first batch runs: they are collected two items at a time
+    rest = [batcher.submit([item]) for item in "bcd"]
+    release.set()
+
+    assert first.result(timeout=5) == ["a"]
+    assert [future.result(timeout=5) for future in rest] == [["b"], ["c"], ["d"]]
+    assert calls == [["a"], ["b", "c"], ["d"]]
+
+def test_errors_are_raised_by_every_request_of_the_batch():
+    def function(items):
+        raise RuntimeError("search failed")
+
+    batcher = MicroBatcher(function, max_wait=0.2)
+    futures = [batcher.submit([index]) for index in range(2)]
+
+    for future in futures:
+        with pytest.raises(RuntimeError, match="search failed"):
+            future.result(timeout=5)
+
+    # The worker keeps serving after a failure
+    batcher.function = lambda items: items
+    assert batcher(["ok"]) == ["ok"]
+
+def test_full_queue_raises_overloaded():
+    started = threading.Event()
+    release = threading.Event()
+
+    def function(items):
+        started.set()
+        release.wait(5)
+        return items
+
+    batcher = MicroBatcher(function, max_wait=0, max_queue=1)
+    running = batcher.submit([1])
+    assert started.wait(5)
+    waiting = batcher.submit([2])
+
+    with pytest.raises(Overloaded):
+        batcher.submit([3])
+
+    release.set()
+    assert running.result(timeout=5) == [1]
+    assert waiting.result(timeout=5) == [2]
+
+def test_empty_request_is_not_queued():
+    batcher = MicroBatcher(lambda items: items, max_queue=1)
+
+    assert batcher.submit([]).result(timeout=0) == []
+    assert batcher.stats()["batches"] == 0
+
+def test_mixed_request_sizes_never_overflow_a_batch():
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def function(items):
+        calls.append(list(items))
+        started.set()
+        release.wait(5)
+        return items
+
+    batcher = MicroBatcher(function, max_batch_size=4, max_wait=0.05)
+    first = batcher.submit(["a"])
+    assert started.wait(5)
+    requests = [["b"] * 3, ["c"] * 2, ["d"], ["e"] * 4, ["f"]]
+    futures = [batcher.submit(request) for request in requests]
+    release.set()
+
+    assert first.result(timeout=5) == ["a"]
+    assert [future.result(timeout=5) for future in futures] == requests
+    assert calls[1:] == [["b"] * 3, ["c", "c", "d"], ["e"] * 4, ["f"]]
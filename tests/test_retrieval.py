@@ -0,0 +1,63 @@
+import pytest
+from retrieval import budget_candidates, chunk_text, fuse_candidates, reciprocal_rank_fusion
+
+RESULTS = [
+    ("llm", [("a", 1.0)]),
+    ("tag:x", [("b", 0.8), ("a", 0.5)]),
+    ("chunk:0", [("b", 0.7), ("c", 0.9)]),
+]
+
+def labels(candidates):
+    return [candidate["label"] for candidate in candidates]
+
+def test_max_fusion_ranks_by_best_score():
+    candidates = fuse_candidates(RESULTS, method="max")
+
+    assert labels(candidates) == ["a", "c", "b"]
+    assert [candidate["score"] for candidate in candidates] == [1.0, 0.9, 0.8]
+
+def test_sum_fusion_breaks_ties_by_label():
+    candidates = fuse_candidates(RESULTS, method="sum")
+
+    assert labels(candidates) == ["a", "b", "c"]
+    assert candidates[0]["score"] == candidates[1]["score"] == 1.5
+
+def test_rrf_fusion_ignores_scores():
+    candidates = fuse_candidates(RESULTS, method="rrf", rrf_k=60)
+
+    assert labels(candidates) == ["b", "a", "c"]
+    assert candidates[0]["score"] == pytest.approx(2 / 61)
+
+def test_fusion_records_sources():
+    sources = {candidate["label"]: candidate["sources"] for candidate in fuse_candidates(RESULTS)}
+
+    assert sources == {"a": ["llm", "tag:x"], "b": ["tag:x", "chunk:0"], "c": ["chunk:0"]}
+
+def test_repeated_label_counts_once_per_query():
+    candidates = fuse_candidates([("tag:x", [("a", 0.9), ("a", 0.4)])], method="sum")
+
+    assert candidates == [{"label": "a", "score": 0.9, "sources": ["tag:x"]}]
+
+def test_unknown_fusion_method():
+    with pytest.raises(ValueError):
+        fuse_candidates(RESULTS, method="mean")
+
+def test_reciprocal_rank_fusion_is_deterministic():
+    assert reciprocal_rank_fusion([["b", "a"], ["a", "b"]]) == ["a", "b"]
+    assert reciprocal_rank_fusion([["c", "a", "c"], ["a"]]) == ["a", "c"]
+
+def test_budget_keeps_the_best_prefix():
+    estimate_tokens = lambda text: len(text)
+    candidates = ["aaa", "bb", "c"]
+
+    # Each candidate costs its line "- label\n"
+    assert budget_candidates(candidates, 11, estimate_tokens) == ["aaa", "bb"]
+    assert budget_candidates(candidates, 5, estimate_tokens) == []
+    assert budget_candidates(candidates, 0, estimate_tokens) == candidates
+
+def test_chunk_text_overlaps_and_bounds_chunks():
+    words = " ".join(str(index) for index in range(10))
+
+    assert chunk_text(words, chunk_size=4, overlap=2, max_chunks=16) == ["0 1 2 3", "2 3 4 5", "4 5 6 7", "6 7 8 9"]
+    assert chunk_text(words, chunk_size=4, overlap=2, max_chunks=2) == ["0 1 2 3", "2 3 4 5"]
+    assert chunk_text("   ") == []
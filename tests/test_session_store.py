@@ -0,0 +1,29 @@
+from session_store import SessionStore
+
+def test_claimed_version_rejects_concurrent_turns(tmp_path):
+    store = SessionStore(str(tmp_path / "sessions.sqlite"))
+    assert store.put("session", {"tags": ["a"]}, 0)
+    state, version = store.get("session")
+
+    lease = store.claim("session", version, 60)
+
+    assert lease is not None
+    assert store.claim("session", version, 60) is None
+    assert store.put("session", {"tags": ["a", "b"]}, version, lease)
+    assert store.get("session") == ({"tags": ["a", "b"]}, version + 1)
+    # The saved version can no longer be claimed or saved
+    assert store.claim("session", version, 60) is None
+    assert not store.put("session", {"tags": []}, version, lease)
+
+def test_released_and_expired_leases_can_be_claimed(tmp_path):
+    store = SessionStore(str(tmp_path / "sessions.sqlite"))
+    store.put("session", {"tags": []}, 0)
+
+    store.release("session", store.claim("session", 1, 60))
+    expired = store.claim("session", 1, -1)
+    lease = store.claim("session", 1, 60)
+
+    assert lease is not None
+    # The turn whose lease expired cannot overwrite the turn that claimed it since
+    assert not store.put("session", {"tags": ["a"]}, 1, expired)
+    assert store.put("session", {"tags": ["b"]}, 1, lease)
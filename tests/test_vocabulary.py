@@ -0,0 +1,83 @@
+import os
+import vocabulary
+from vocabulary import StringTable, CompiledVocabulary, compile_vocabulary, extract_non_descriptors, load_vocabulary
+
+def string_table(strings):
+    return StringTable(*StringTable.build(strings))
+
+def test_find_returns_positions():
+    strings = ["energy policy", "", "énergie renouvelable", "水", "e"]
+    table = string_table(strings)
+
+    assert len(table) == len(strings)
+    assert list(table) == strings
+    for position, string in enumerate(strings):
+        assert table.find(string) == position
+    assert table.find("energy") == -1
+    assert table.find("energy policy ") == -1
+
+def test_empty_table():
+    table = string_table([])
+
+    assert len(table) == 0
+    assert table.find("") == -1
+    assert table.find("anything") == -1
+
+def test_find_with_colliding_hashes(monkeypatch):
+    # Every key hashes to the same slot, so lookups rely on linear probing
+    monkeypatch.setattr(vocabulary, "_hash", lambda key: 7)
+    strings = ["a", "b", "", "ab", "ba"]
+    table = string_table(strings)
+
+    for position, string in enumerate(strings):
+        assert table.find(string) == position
+    assert table.find("c") == -1
+
+def test_pack_keeps_duplicates():
+    blob, offsets = StringTable.pack(["", "x", "", "yz"])
+
+    assert offsets.tolist() == [0, 0, 1, 1, 3]
+    assert bytes(blob) == b"xyz"
+
+def test_compiled_vocabulary(tmp_path):
+    eurovoc = {
+        "environmental protection": {"DESCRIPTEUR_ID": 1, "DEF": "protection of the environment"},
+        "renewable energy": {"DESCRIPTEUR_ID": float("nan"), "DEF": None},
+    }
+    compile_vocabulary(eurovoc, {"environmental policy": "environmental protection"}, str(tmp_path))
+    compiled = CompiledVocabulary(str(tmp_path))
+
+    assert list(compiled) == list(eurovoc)
+    assert "renewable energy" in compiled and "energy" not in compiled
+    assert compiled.resolve("Renewable-Energy") == "renewable energy"
+    assert compiled.resolve("Environmental policy") == "environmental protection"
+    assert compiled.resolve("unknown") is None
+    assert compiled.descriptor_id("environmental protection") == 1
+    assert compiled.descriptor_id("renewable energy") is None
+    assert compiled.definition("environmental protection") == "protection of the environment"
+    assert compiled.definition("renewable energy") == ""
+
+def test_load_vocabulary_recompiles_changed_sources(tmp_path):
+    eurovoc_path = tmp_path / "EuroVoc.json"
+    folder_path = str(tmp_path / "compiled")
+    eurovoc_path.write_text('{"fishery": {"DEF": "fishing"}}')
+
+    assert list(load_vocabulary(folder_path, str(eurovoc_path), str(tmp_path / "missing.json"))) == ["fishery"]
+
+    eurovoc_path.write_text('{"fishery": {"DEF": "fishing"}, "aquaculture": {"DEF": "fish farming"}}')
+    os.utime(eurovoc_path, ns=(0, 0))
+    assert list(load_vocabulary(folder_path, str(eurovoc_path), str(tmp_path / "missing.json"))) == ["fishery", "aquaculture"]
+
+def test_extract_non_descriptors_from_the_xml_export(tmp_path):
+    export_path = tmp_path / "uf_en.xml"
+    export_path.write_text(
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        "<DATAROOT>"
+        "<RECORD><DESCRIPTEUR_ID>1000</DESCRIPTEUR_ID><UF><UF_EL>funding</UF_EL><UF_EL TYPE=\"TR\">finance</UF_EL></UF></RECORD>"
+        "<RECORD><DESCRIPTEUR_ID>99</DESCRIPTEUR_ID><UF><UF_EL>unknown descriptor</UF_EL></UF></RECORD>"
+        "</DATAROOT>",
+        encoding="utf-8",
+    )
+    eurovoc = {"financing": {"DESCRIPTEUR_ID": 1000.0}}
+
+    assert extract_non_descriptors(str(export_path), eurovoc) == {"funding": "financing", "finance": "financing"}
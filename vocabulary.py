@@ -0,0 +1,393 @@
+import os
+import re
+import json
+import math
+import hashlib
+import argparse
+import unicodedata
+import xml.etree.ElementTree as ElementTree
+import numpy as np
+
+def normalize_label(label: str) -> str:
+    """
+    Return the case and diacritic insensitive form of a label.
+
+    Accents are removed, the text is case-folded, hyphens and repeated whitespace
+    become single spaces and surrounding punctuation is dropped.
+
+    Args:
+        label (str): The label to normalise.
+
+    Returns:
+        str: The normalised label.
+    """
+    text = unicodedata.normalize("NFKD", label)
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    text = re.sub(r"[\s\-‐–_]+", " ", text.casefold())
+    return text.strip(" .,;:'\"")
+
+def load_non_descriptors(path: str) -> dict:
+    """
+    Load the non-descriptors (USE/UF relations) of the thesaurus.
+
+    The file is a JSON object mapping each non-descriptor to the descriptor to
+    use instead, e.g. {"environmental policy": "environmental protection"}, as
+    written by `extract_non_descriptors`.
+
+    Args:
+        path (str): The path of the JSON file.
+
+    Returns:
+        dict: The descriptor to use for each non-descriptor, empty if the file does not exist.
+    """
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as json_file:
+        return json.load(json_file)
+
+def extract_non_descriptors(export_path: str, eurovoc: dict) -> dict:
+    """
+    Extract the non-descriptors from the "used for" file of the EuroVoc XML export.
+
+    The export (e.g. uf_en.xml for English) lists a RECORD per descriptor, with its
+    DESCRIPTEUR_ID and the UF_EL elements of its non-descriptors:
+    <RECORD><DESCRIPTEUR_ID>1000</DESCRIPTEUR_ID><UF><UF_EL>funding</UF_EL></UF></RECORD>.
+    Non-descriptors of descriptors missing from `eurovoc` are skipped.
+
+    Args:
+        export_path (str): The path of the XML file.
+        eurovoc (dict): The descriptors, as loaded from EuroVoc.json.
+
+    Returns:
+        dict: The descriptor to use for each non-descriptor.
+    """
+    labels = {int(float(entry["DESCRIPTEUR_ID"])): label for label, entry in eurovoc.items()}
+
+    non_descriptors = {}
+    for record in ElementTree.parse(export_path).getroot().iter("RECORD"):
+        descriptor_id = record.findtext("DESCRIPTEUR_ID")
+        descriptor = labels.get(int(float(descriptor_id))) if descriptor_id else None
+        if descriptor is None:
+            continue
+        for element in record.iter("UF_EL"):
+            label = (element.text or "").strip()
+            if label and label not in eurovoc:
+                non_descriptors[label] = descriptor
+    return non_descriptors
+
+def build_label_index(descriptors, non_descriptors: dict = None) -> dict:
+    """
+    Build the index of normalised labels used to resolve tags lexically.
+
+    Args:
+        descriptors: The labels of the EuroVoc descriptors.
+        non_descriptors (dict): The descriptor to use for each non-descriptor.
+
+    Returns:
+        dict: The descriptor for each normalised descriptor or non-descriptor label.
+    """
+    label_index = {}
+    for non_descriptor, descriptor in (non_descriptors or {}).items():
+        label_index[normalize_label(non_descriptor)] = descriptor
+
+    # Descriptors take precedence over non-descriptors sharing the same normalised form
+    for descriptor in descriptors:
+        label_index[normalize_label(descriptor)] = descriptor
+
+    return label_index
+
+def _hash(key: bytes) -> int:
+    """Return a 64-bit hash of a key, stable across processes."""
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+class StringTable:
+    """
+    Read-only table of strings stored in flat arrays.
+
+    The strings are concatenated as UTF-8 in a byte array with an array of offsets,
+    and an open-addressing hash table maps each string to its position, so that
+    lookups are O(1) without a Python object per string.
+    """
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray, table: np.ndarray):
+        self.blob = blob
+        self.offsets = offsets
+        self.table = table
+        self.mask = len(table) - 1
+
+    @staticmethod
+    def pack(strings: list) -> tuple:
+        """
+        Concatenate strings, which need not be unique, into a blob and offsets.
+
+        Args:
+            strings (list): The strings, in the order of their positions.
+
+        Returns:
+            tuple: The blob and offsets arrays.
+        """
+        encoded = [string.encode("utf-8") for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(key) for key in encoded])
+        return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+    @staticmethod
+    def build(strings: list) -> tuple:
+        """
+        Build the arrays of a table of unique strings.
+
+        Args:
+            strings (list): The strings, in the order of their positions.
+
+        Returns:
+            tuple: The blob, offsets and hash table arrays.
+        """
+        blob, offsets = StringTable.pack(strings)
+        encoded = [string.encode("utf-8") for string in strings]
+
+        # Keep the load factor of the hash table below 0.5
+        table = np.full(2 ** max(1, math.ceil(math.log2(2 * len(encoded) + 1))), -1, dtype=np.int32)
+        mask = len(table) - 1
+        for position, key in enumerate(encoded):
+            slot = _hash(key) & mask
+            while table[slot] != -1:
+                slot = (slot + 1) & mask
+            table[slot] = position
+
+        return blob, offsets, table
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, position: int) -> str:
+        return bytes(self.blob[self.offsets[position]:self.offsets[position + 1]]).decode("utf-8")
+
+    def __iter__(self):
+        return (self[position] for position in range(len(self)))
+
+    def find(self, string: str) -> int:
+        """
+        Return the position of a string.
+
+        Args:
+            string (str): The string to look up.
+
+        Returns:
+            int: The position of the string, or -1 if it is not in the table.
+        """
+        key = string.encode("utf-8")
+        slot = _hash(key) & self.mask
+        while True:
+            position = int(self.table[slot])
+            if position == -1:
+                return -1
+            if self.offsets[position + 1] - self.offsets[position] == len(key) and bytes(self.blob[self.offsets[position]:self.offsets[position + 1]]) == key:
+                return position
+            slot = (slot + 1) & self.mask
+
+class CompiledVocabulary:
+    """
+    Compact, memory-mapped EuroVoc vocabulary built by `compile_vocabulary`.
+
+    It holds the descriptor labels with their DESCRIPTEUR_ID and definition, and the
+    normalised forms of the descriptors and non-descriptors with the descriptor they
+    resolve to. Every array is memory-mapped, so worker processes share its pages.
+    """
+
+    # Arrays making up a compiled vocabulary folder
+    ARRAYS = [
+        "label_blob", "label_offsets", "label_table",
+        "normalized_blob", "normalized_offsets", "normalized_table", "normalized_targets",
+        "definition_blob", "definition_offsets", "ids",
+    ]
+
+    def __init__(self, folder_path: str):
+        arrays = {name: np.load(os.path.join(folder_path, f"{name}.npy"), mmap_mode="r") for name in self.ARRAYS}
+        self.labels = StringTable(arrays["label_blob"], arrays["label_offsets"], arrays["label_table"])
+        self.normalized = StringTable(arrays["normalized_blob"], arrays["normalized_offsets"], arrays["normalized_table"])
+        self.normalized_targets = arrays["normalized_targets"]
+        self.definition_blob = arrays["definition_blob"]
+        self.definition_offsets = arrays["definition_offsets"]
+        self.ids = arrays["ids"]
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def __iter__(self):
+        return iter(self.labels)
+
+    def __contains__(self, label) -> bool:
+        return isinstance(label, str) and self.labels.find(label) != -1
+
+    def resolve(self, tag: str) -> str:
+        """
+        Resolve a tag to a descriptor by exact, then normalised match.
+
+        Args:
+            tag (str): The tag to resolve.
+
+        Returns:
+            str: The label of the descriptor, or None if the tag cannot be resolved.
+        """
+        if self.labels.find(tag) != -1:
+            return tag
+
+        position = self.normalized.find(normalize_label(tag))
+        if position == -1:
+            return None
+        return self.labels[int(self.normalized_targets[position])]
+
+    def descriptor_id(self, label: str) -> int:
+        """Return the DESCRIPTEUR_ID of a descriptor, or None if it has none or is unknown."""
+        position = self.labels.find(label)
+        if position == -1 or self.ids[position] < 0:
+            return None
+        return int(self.ids[position])
+
+    def definition(self, label: str) -> str:
+        """Return the definition of a descriptor, empty if it has none or is unknown."""
+        position = self.labels.find(label)
+        if position == -1:
+            return ""
+        return bytes(self.definition_blob[self.definition_offsets[position]:self.definition_offsets[position + 1]]).decode("utf-8")
+
+def source_fingerprint(*paths: str) -> dict:
+    """
+    Identify the versions of the source files of a compiled vocabulary.
+
+    Args:
+        paths (str): The paths of the source files.
+
+    Returns:
+        dict: The size and modification time of each file, None for missing files.
+    """
+    fingerprint = {}
+    for path in paths:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            fingerprint[path] = [stat.st_size, stat.st_mtime_ns]
+        else:
+            fingerprint[path] = None
+    return fingerprint
+
+def compile_vocabulary(eurovoc: dict, non_descriptors: dict, folder_path: str, sources: dict = None):
+    """
+    Compile the EuroVoc vocabulary into the arrays of a `CompiledVocabulary`.
+
+    Args:
+        eurovoc (dict): The descriptors, as loaded from EuroVoc.json.
+        non_descriptors (dict): The descriptor to use for each non-descriptor.
+        folder_path (str): The folder in which the arrays are written.
+        sources (dict): The `source_fingerprint` of the files the vocabulary was loaded from.
+    """
+    labels = list(eurovoc)
+    positions = {label: position for position, label in enumerate(labels)}
+    label_index = {
+        normalized: positions[descriptor]
+        for normalized, descriptor in build_label_index(labels, non_descriptors).items()
+        if descriptor in positions
+    }
+
+    arrays = {}
+    arrays["label_blob"], arrays["label_offsets"], arrays["label_table"] = StringTable.build(labels)
+    arrays["normalized_blob"], arrays["normalized_offsets"], arrays["normalized_table"] = StringTable.build(list(label_index))
+    arrays["normalized_targets"] = np.array(list(label_index.values()), dtype=np.int32)
+
+    # Missing definitions and ids are stored as empty strings and -1
+    definitions = [entry.get("DEF") if isinstance(entry.get("DEF"), str) else "" for entry in eurovoc.values()]
+    # Definitions are only read by position, so they need no hash table
+    arrays["definition_blob"], arrays["definition_offsets"] = StringTable.pack(definitions)
+    arrays["ids"] = np.array([
+        int(entry["DESCRIPTEUR_ID"]) if isinstance(entry.get("DESCRIPTEUR_ID"), (int, float)) and not math.isnan(entry["DESCRIPTEUR_ID"]) else -1
+        for entry in eurovoc.values()
+    ], dtype=np.int64)
+
+    # Write to temporary files then rename them, so that running processes keep a consistent version
+    os.makedirs(folder_path, exist_ok=True)
+    for name, array in arrays.items():
+        path = os.path.join(folder_path, f"{name}.npy")
+        with open(path + ".tmp", "wb") as file:
+            np.save(file, array)
+        os.replace(path + ".tmp", path)
+
+    # Written last, so that an interrupted compilation is redone
+    path = os.path.join(folder_path, "sources.json")
+    with open(path + ".tmp", "w") as json_file:
+        json.dump(sources or {}, json_file)
+    os.replace(path + ".tmp", path)
+
+def load_vocabulary(folder_path: str, eurovoc_path: str = "EuroVoc.json", non_descriptors_path: str = "EuroVoc_UF.json") -> CompiledVocabulary:
+    """
+    Load the compiled vocabulary, compiling it first if it does not exist yet or if
+    the source files changed since it was compiled.
+
+    Args:
+        folder_path (str): The folder of the compiled vocabulary.
+        eurovoc_path (str): The JSON file of the descriptors, used to compile the vocabulary.
+        non_descriptors_path (str): The JSON file of the non-descriptors, used to compile the vocabulary.
+
+    Returns:
+        CompiledVocabulary: The memory-mapped vocabulary.
+    """
+    sources = source_fingerprint(eurovoc_path, non_descriptors_path)
+    sources_path = os.path.join(folder_path, "sources.json")
+    compiled_sources = None
+    if os.path.exists(sources_path):
+        with open(sources_path) as json_file:
+            compiled_sources = json.load(json_file)
+
+    # Without its source, a vocabulary compiled beforehand is used as is
+    if compiled_sources is None or (sources[eurovoc_path] is not None and compiled_sources != sources):
+        if compiled_sources is not None:
+            print(f"The sources of {folder_path} changed, compiling the vocabulary again")
+        with open(eurovoc_path) as json_file:
+            eurovoc = json.load(json_file)
+        compile_vocabulary(eurovoc, load_non_descriptors(non_descriptors_path), folder_path, sources)
+
+    return CompiledVocabulary(folder_path)
+
+def resolve_tags(tags: list, vocabulary: CompiledVocabulary) -> tuple:
+    """
+    Resolve tags to EuroVoc descriptors without vector search.
+
+    A tag is resolved by exact match, then by normalised match against the
+    descriptors and non-descriptors of the vocabulary.
+
+    Args:
+        tags (list): The tags to resolve.
+        vocabulary (CompiledVocabulary): The EuroVoc vocabulary.
+
+    Returns:
+        tuple: A tuple containing:
+            - list: The descriptors of the resolved tags
+            - list: The tags that could not be resolved
+    """
+    resolved, unresolved = [], []
+    for tag in tags:
+        descriptor = vocabulary.resolve(tag)
+        if descriptor is not None:
+            resolved.append(descriptor)
+        else:
+            unresolved.append(tag)
+
+    return resolved, unresolved
+
+if __name__ == "__main__":
+    # Build step: compile EuroVoc.json (and the optional non-descriptors) into the vocabulary folder
+    parser = argparse.ArgumentParser(description="Compile EuroVoc.json and the non-descriptors into a vocabulary folder.")
+    parser.add_argument("folder", nargs="?", default=os.environ.get("VOCABULARY_PATH", "eurovoc_vocabulary"))
+    parser.add_argument("--uf-export", help="'used for' file of the EuroVoc XML export (e.g. uf_en.xml) to extract the non-descriptors from first")
+    args = parser.parse_args()
+    folder_path = args.folder
+    non_descriptors_path = os.environ.get("NON_DESCRIPTORS_PATH", "EuroVoc_UF.json")
+    with open("EuroVoc.json") as json_file:
+        eurovoc = json.load(json_file)
+
+    if args.uf_export:
+        non_descriptors = extract_non_descriptors(args.uf_export, eurovoc)
+        with open(non_descriptors_path, "w") as json_file:
+            json.dump(non_descriptors, json_file, indent=4)
+        print(f"Extracted {len(non_descriptors)} non-descriptors into {non_descriptors_path}")
+    compile_vocabulary(eurovoc, load_non_descriptors(non_descriptors_path), folder_path, source_fingerprint("EuroVoc.json", non_descriptors_path))
+    print(f"Compiled {len(eurovoc)} descriptors into {folder_path}")